@@ -0,0 +1,234 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is a part of IoT-LAB oml-plot-tools
+# Copyright (C) 2015 INRIA (Contact: admin@iot-lab.info)
+# Contributor(s) : see AUTHORS file
+#
+# This software is governed by the CeCILL license under French law
+# and abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# http://www.cecill.info.
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+
+"""
+usage: plot_oml_batch [-h] [-k {consum,radio,traj}] [-j JOBS] [-d DIR]
+                      [-f FORMAT] [-s] [--no-cache] [--rebuild-cache]
+                      DATA [DATA ...]
+
+Render or summarize many iot-lab OML files in parallel
+
+positional arguments:
+  DATA                  OML files, directories or glob patterns
+
+optional arguments:
+  -h, --help            show this help message and exit
+  -k {consum,radio,traj}, --kind {consum,radio,traj}
+                        OML files measures kind
+  -j JOBS, --jobs JOBS  Number of processes, default to number of CPUs
+  -d DIR, --output-dir DIR
+                        Rendered files directory
+  -f FORMAT, --format FORMAT
+                        Rendered files format
+  -s, --summary         Print a JSON summary instead of rendering files
+  --no-cache            Do not use parsed files cache
+  --rebuild-cache       Rebuild parsed files cache
+"""
+
+import os
+import sys
+import glob
+import json
+import argparse
+import multiprocessing
+
+import numpy
+
+from . import common
+from . import cache
+from . import consum
+from . import radio
+from . import traj
+
+
+# kind: (module, figures function, default selection)
+KINDS = {
+    'consum': (consum, consum.consumption_figures, ['all']),
+    'radio': (radio, radio.radio_figures, ['joined']),
+    'traj': (traj, traj.trajectory_figures, ['traj', 'angle']),
+}
+
+
+def oml_files(inputs):
+    """ Expand directories and glob patterns to sorted oml files """
+    files = set()
+    for path in inputs:
+        if os.path.isdir(path):
+            files.update(glob.glob(os.path.join(path, '*.oml')))
+        else:
+            files.update(glob.glob(path) or [path])
+    return sorted(files)
+
+
+def output_names(files):
+    """ Rendered files names, without extension
+
+    Files base names, or their path from the files common directory
+    joined with '_' when several files have the same base name. """
+    names = [os.path.splitext(os.path.basename(f))[0] for f in files]
+    if len(set(names)) == len(names):
+        return names
+
+    paths = [os.path.abspath(f) for f in files]
+    common_dir = os.path.commonprefix([os.path.dirname(p) + os.sep
+                                       for p in paths])
+    common_dir = common_dir[:common_dir.rfind(os.sep) + 1]
+    return [os.path.splitext(path[len(common_dir):])[0].replace(os.sep, '_')
+            for path in paths]
+
+
+def render(args):
+    """ Render 'filename' figures to 'outdir', run in worker process
+    Any error is reported for this file only, not to abort the batch.
+
+    :returns: (filename, saved files) or (filename, error message) """
+    kind, filename, name, outdir, fmt, cache_mode = args
+    module, figures_func, selection = KINDS[kind]
+    output = os.path.join(outdir, '%s.%s' % (name, fmt))
+    try:
+        data = module.oml_load(filename, cache_mode)
+        if kind == 'traj':
+            figures = figures_func(data, name, None, None, selection) or []
+        else:
+            figures = figures_func(data, name, selection)
+        return filename, common.plot_save(figures, output)
+    except Exception as err:  # pylint:disable=broad-except
+        import matplotlib.pyplot as plt
+        plt.close('all')
+        return filename, str(err) or err.__class__.__name__
+
+
+def summarize(args):
+    """ Summary values of 'filename', run in worker process
+    :returns: summary dict, with 'error' if file could not be loaded,
+        measures without values are None """
+    kind, filename, cache_mode = args
+    module = KINDS[kind][0]
+    summary = {'file': filename}
+    try:
+        data = module.oml_load(filename, cache_mode)
+    except ValueError as err:
+        summary['error'] = str(err)
+        return summary
+
+    summary['rows'] = len(data)
+    summary['start'] = float(data['timestamp'][0])
+    summary['end'] = float(data['timestamp'][-1])
+    for name in module.MEASURES_D:
+        values = data[name][numpy.isfinite(data[name])]
+        summary[name] = None if not values.size else {
+            'min': float(values.min()),
+            'max': float(values.max()),
+            'mean': float(values.mean()),
+        }
+    return summary
+
+
+def batch_render(kind, files, outdir,  # pylint:disable=too-many-arguments
+                 fmt='png', cache_mode=cache.USE, jobs=None):
+    """ Render all 'files' in parallel in 'jobs' processes
+    :returns: list of (filename, saved files or error message) """
+    common.plot_headless()
+    tasks = [(kind, filename, name, outdir, fmt, cache_mode)
+             for filename, name in zip(files, output_names(files))]
+    return _pool_map(render, tasks, jobs)
+
+
+def batch_summary(kind, files, cache_mode=cache.USE, jobs=None):
+    """ Summarize all 'files' in parallel in 'jobs' processes
+    :returns: list of summary dicts """
+    tasks = [(kind, filename, cache_mode) for filename in files]
+    return _pool_map(summarize, tasks, jobs)
+
+
+def _pool_map(func, tasks, jobs):
+    """ Map 'func' on 'tasks' with a pool of 'jobs' processes """
+    if jobs == 1 or len(tasks) <= 1:
+        return [func(task) for task in tasks]
+    pool = multiprocessing.Pool(jobs)
+    try:
+        return pool.map(func, tasks, chunksize=1)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def jobs_arg(value):
+    """ Number of processes, at least 1 """
+    jobs = int(value)
+    if jobs < 1:
+        raise argparse.ArgumentTypeError('invalid jobs number: %r' % value)
+    return jobs
+
+
+PARSER = argparse.ArgumentParser(
+    prog='plot_oml_batch',
+    description="Render or summarize many iot-lab OML files in parallel")
+PARSER.add_argument('inputs', metavar='DATA', nargs='+',
+                    help="OML files, directories or glob patterns")
+PARSER.add_argument('-k', '--kind', choices=sorted(KINDS), default='consum',
+                    help="OML files measures kind")
+PARSER.add_argument('-j', '--jobs', type=jobs_arg, default=None,
+                    help="Number of processes, default to number of CPUs")
+PARSER.add_argument('-d', '--output-dir', dest='outdir', metavar='DIR',
+                    default='.',
+                    help="Rendered files directory")
+PARSER.add_argument('-f', '--format', dest='fmt', metavar='FORMAT',
+                    default='png',
+                    help="Rendered files format")
+PARSER.add_argument('-s', '--summary', action='store_true',
+                    help="Print a JSON summary instead of rendering files")
+PARSER.add_argument('--no-cache', dest='cache', action='store_const',
+                    const=cache.BYPASS, default=cache.USE,
+                    help="Do not use parsed files cache")
+PARSER.add_argument('--rebuild-cache', dest='cache', action='store_const',
+                    const=cache.REBUILD, help="Rebuild parsed files cache")
+
+
+def main():
+    """ Main command """
+    opts = PARSER.parse_args()
+    files = oml_files(opts.inputs)
+
+    if opts.summary:
+        summaries = batch_summary(opts.kind, files, opts.cache, opts.jobs)
+        json.dump(summaries, sys.stdout, indent=2, sort_keys=True)
+        print
+        errors = [s['file'] for s in summaries if 'error' in s]
+    else:
+        results = batch_render(opts.kind, files, opts.outdir, opts.fmt,
+                               opts.cache, opts.jobs)
+        errors = []
+        for filename, saved in results:
+            if isinstance(saved, list):
+                print '%s: %s' % (filename, ' '.join(saved))
+            else:
+                print >> sys.stderr, '%s: %s' % (filename, saved)
+                errors.append(filename)
+
+    if errors:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is a part of IoT-LAB oml-plot-tools
+# Copyright (C) 2015 INRIA (Contact: admin@iot-lab.info)
+# Contributor(s) : see AUTHORS file
+#
+# This software is governed by the CeCILL license under French law
+# and abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# http://www.cecill.info.
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+""" On-disk cache of parsed oml files
+
+Parsed arrays are stored as '.npy' files in CACHE_DIR, keyed by the oml file
+path, size, modification time and requested measures, and loaded back with
+memory mapping. Least recently used entries are removed when the cache is
+bigger than CACHE_MAX_SIZE bytes.
+"""
+
+import os
+import time
+import json
+import errno
+import struct
+import hashlib
+
+import numpy
+from numpy.lib import format as npy_format
+
+from . import __version__
+
+CACHE_DIR = os.environ.get('OML_PLOT_TOOLS_CACHE_DIR', os.path.join(
+    os.path.expanduser('~'), '.cache', 'oml-plot-tools'))
+CACHE_MAX_SIZE = int(os.environ.get('OML_PLOT_TOOLS_CACHE_SIZE', 1 << 30))
+# Sites maps are checked again after this delay, in seconds
+MAP_TTL = int(os.environ.get('OML_PLOT_TOOLS_MAP_TTL', 7 * 24 * 3600))
+
+# Cache modes
+USE = 'use'
+BYPASS = 'bypass'
+REBUILD = 'rebuild'
+
+_EXT = '.npy'
+
+
+def key(filename, *args):
+    """ Cache key for 'filename' current content and 'args' """
+    stat = os.stat(filename)
+    content = (os.path.abspath(filename), stat.st_size, stat.st_mtime,
+               args, __version__)
+    return hashlib.sha1(repr(content)).hexdigest()
+
+
+def load(cache_key):
+    """ Return cached array memory mapped read-only, or None """
+    path = _path(cache_key)
+    try:
+        data = numpy.load(path, mmap_mode='r')
+        os.utime(path, None)
+    except (IOError, OSError, ValueError):
+        return None
+    return data
+
+
+def store(cache_key, chunks):
+    """ Store arrays 'chunks' in cache as one array, and evict old entries
+    The stored entry is kept, even if bigger than CACHE_MAX_SIZE.
+
+    :returns: stored array memory mapped read-only, or None on error or if
+        'chunks' are empty
+    :raises: 'chunks' iteration errors, without leaving a temporary file """
+    path = _path(cache_key)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        _makedirs(CACHE_DIR)
+        if not save(tmp_path, chunks):
+            return None
+        os.rename(tmp_path, path)
+        data = numpy.load(path, mmap_mode='r')
+    except (IOError, OSError):
+        return None
+    finally:
+        # Also on chunks parsing errors, which are raised
+        _remove(tmp_path)
+
+    evict(CACHE_MAX_SIZE, keep=path)
+    return data
+
+
+def save(path, chunks):
+    """ Save arrays 'chunks' as one array in '.npy' file 'path'
+
+    Chunks are written one after the other, so the whole array is never in
+    memory. They must all have the same dtype.
+    :returns: number of rows saved """
+    rows = 0
+    dtype = None
+    with open(path, 'wb') as npy_fd:
+        for chunk in chunks:
+            if dtype is None:
+                dtype = chunk.dtype
+                npy_fd.write(_npy_header(dtype, rows))
+            rows += len(chunk)
+            npy_fd.write(numpy.ascontiguousarray(chunk, dtype).data)
+
+        # Write final rows number, header length does not change
+        if dtype is not None:
+            npy_fd.seek(0)
+            npy_fd.write(_npy_header(dtype, rows))
+    return rows
+
+
+def _npy_header(dtype, rows):
+    """ '.npy' format 1.0 header with same length for any 'rows' """
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%20d,), }" % (
+        npy_format.dtype_to_descr(dtype), rows)
+    # Total length is aligned on 64 bytes, ending with a '\n'
+    header += ' ' * (-(len(header) + 11) % 64) + '\n'
+    return npy_format.magic(1, 0) + struct.pack('<H', len(header)) + header
+
+
+def evict(max_size, keep=None):
+    """ Remove least recently used entries until cache size <= 'max_size'
+    Entry 'keep' path is never removed, even if bigger than 'max_size' """
+    try:
+        names = [name for name in os.listdir(CACHE_DIR)
+                 if name.endswith(_EXT)]
+    except OSError:
+        return
+
+    entries = []
+    for name in names:
+        path = os.path.join(CACHE_DIR, name)
+        try:
+            stat = os.stat(path)
+        except OSError:  # pragma: no cover
+            continue  # removed concurrently
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    size = sum(entry[1] for entry in entries)
+    for _, entry_size, path in sorted(entries):
+        if size <= max_size:
+            break
+        if path == keep:
+            continue
+        _remove(path)
+        size -= entry_size
+
+
+def map_load(site):
+    """ Cached 'site' map
+
+    :returns: (meta, image, age) with 'meta' the stored dict, 'image' the
+        decoded image array and 'age' seconds since stored or refreshed,
+        or None """
+    meta_path, image_path = _map_paths(site)
+    try:
+        with open(meta_path) as meta_fd:
+            meta = json.load(meta_fd)
+        image = numpy.load(image_path)
+        age = time.time() - os.stat(meta_path).st_mtime
+    except (IOError, OSError, ValueError):
+        return None
+    return meta, image, age
+
+
+def map_store(site, meta, image):
+    """ Store 'site' map 'meta' dict and decoded 'image' array
+    :returns: True on success """
+    meta_path, image_path = _map_paths(site)
+    tmp = '.%d.tmp' % os.getpid()
+    try:
+        _makedirs(os.path.dirname(meta_path))
+        with open(image_path + tmp, 'wb') as image_fd:
+            numpy.save(image_fd, image)
+        with open(meta_path + tmp, 'w') as meta_fd:
+            json.dump(meta, meta_fd)
+        # Image first, meta is the valid entry marker
+        os.rename(image_path + tmp, image_path)
+        os.rename(meta_path + tmp, meta_path)
+    except (IOError, OSError):
+        _remove(image_path + tmp)
+        _remove(meta_path + tmp)
+        return False
+    return True
+
+
+def map_touch(site):
+    """ Mark 'site' cached map as up to date """
+    try:
+        os.utime(_map_paths(site)[0], None)
+    except OSError:
+        pass
+
+
+def _map_paths(site):
+    """ 'site' map cache entry meta and image paths, not evicted """
+    path = os.path.join(CACHE_DIR, 'maps', os.path.basename(site))
+    return path + '.json', path + _EXT
+
+
+def _path(cache_key):
+    """ Cache entry path for 'cache_key' """
+    return os.path.join(CACHE_DIR, cache_key + _EXT)
+
+
+def _makedirs(path):
+    """ Create 'path' directories if needed """
+    try:
+        os.makedirs(path)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+
+
+def _remove(path):
+    """ Remove 'path' if it exists """
+    try:
+        os.remove(path)
+    except OSError:
+        pass
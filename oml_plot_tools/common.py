@@ -25,6 +25,9 @@
 # Issues with numpy
 # pylint:disable=no-member
 
+import os
+import itertools
+import contextlib
 from collections import namedtuple
 try:
     # E0611: no name in module
@@ -33,9 +36,12 @@ except ImportError:  # pragma: no cover
     from ordereddict import OrderedDict  # pylint:disable=import-error
 
 import numpy
-import matplotlib.pyplot as plt
+
+from . import cache
 
 OML_HEADER_LEN = 9
+OML_CHUNK_ROWS = 1 << 16
+OML_INDEX_STEP = 1 << 20
 
 OML_TYPES = {
     'consumption': 1,
@@ -49,12 +55,36 @@ TIMESTAMP_LABEL = 'Sample Time (sec)'
 OML_FIELDS = [
     ('timestamp', float),
     ('type', numpy.str_, 16),
-    ('num', int),
-    ('t_s', int),
-    ('t_us', int),
+    ('num', numpy.uint32),
+    ('t_s', numpy.uint32),
+    ('t_us', numpy.uint32),
 ]
 
+# Schema declared types and names
+OML_SCHEMA_TYPES = {
+    'int32': numpy.int32,
+    'uint32': numpy.uint32,
+    'int64': numpy.int64,
+    'uint64': numpy.uint64,
+    'double': numpy.float64,
+}
+OML_SCHEMA_NAMES = {
+    'timestamp_s': 't_s',
+    'timestamp_us': 't_us',
+}
+
 MeasureTuple = namedtuple('MeasureTuple', ['name', 'type', 'label'])
+OmlHeader = namedtuple('OmlHeader', ['metadata', 'schemas'])
+OML_INDEX_DTYPE = [('timestamp', float), ('offset', numpy.int64)]
+
+PYRAMID_FACTOR = 4
+CLOCK_PERCENTILES = (50, 90, 99, 99.9)
+ROLLING_STATS = ('mean', 'min', 'max', 'std')
+OML_GAP_DTYPE = [('num_start', numpy.int64), ('num_end', numpy.int64),
+                 ('start', float), ('end', float)]
+GAP_PLT = {'facecolor': 'red', 'alpha': 0.2, 'linewidth': 0}
+PyramidLevel = namedtuple('PyramidLevel', ['x', 'min', 'max', 'mean',
+                                           'count'])
 
 
 def measures_dict(*measures_tuples):
@@ -63,48 +93,335 @@ def measures_dict(*measures_tuples):
     return OrderedDict(measures_list)
 
 
-def oml_load(filename, meas_type, measures):
+def oml_load(filename, meas_type,  # pylint:disable=too-many-arguments
+             measures=None, cache_mode=cache.USE, start=None, stop=None):
     """ Load oml file
     :returns: numpy array
-    :measures: list of MeasureTuple """
+    :measures: list of MeasureTuple, all schema fields if None
+    :cache_mode: cache.USE, cache.BYPASS or cache.REBUILD.
+        Cached arrays are read-only memory mapped, file objects are not cached
+    :start: :stop: only load measures in this time range, in epoch seconds.
+        Only this part of the file is read, measures must be time ordered.
+    """
+    if start is not None or stop is not None:
+        return _oml_load_range(filename, meas_type, measures, cache_mode,
+                               start, stop)
+
+    cache_key = _oml_cache_key(filename, cache_mode, meas_type,
+                               _measures_key(measures))
+    if cache_key is not None:
+        data = cache.load(cache_key) if cache_mode == cache.USE else None
+        if data is None:
+            # Parsed by chunks directly to the cache file
+            chunks = iter_oml_chunks(filename, meas_type, measures)
+            data = cache.store(cache_key, chunks)
+        if data is not None:
+            return data
+
+    with _oml_errors():
+        data = _oml_read(filename, meas_type, measures)
 
-    meas_dtypes = [(m.name, m.type) for m in measures]
+    # No empty measures
+    if array_empty(data):
+        raise ValueError("No values, not an oml file")
 
-    try:
-        data = _oml_read(filename, meas_type, meas_dtypes)
-    except IOError as err:
-        raise ValueError("Error opening oml file:\n{0}\n".format(err))
-    except (ValueError, StopIteration, IndexError) as err:
-        raise ValueError("Error reading oml file:\n{0}\n".format(err))
-    except TypeError as err:
-        raise ValueError("{0}".format(err))
+    return data
 
-    # No error when only one value
-    data = numpy.atleast_1d(data)
 
-    # No empty measures
-    # I think not reproducible anymore with genfromtxt however.
-    if array_empty(data):  # pragma: no cover
-        raise ValueError("No values, not an oml file")
+def _oml_load_range(filename, meas_type,  # pylint:disable=too-many-arguments
+                    measures, cache_mode, start, stop):
+    """ Load oml file measures between 'start' and 'stop' timestamps
+
+    Use cached array if available, else read the file from the index entry
+    before 'start' until 'stop' """
+    start = -numpy.inf if start is None else start
+    stop = numpy.inf if stop is None else stop
+
+    data = None
+    cache_key = _oml_cache_key(filename, cache_mode, meas_type,
+                               _measures_key(measures))
+    if cache_key is not None and cache_mode == cache.USE:
+        data = cache.load(cache_key)
+
+    if data is not None:
+        first = numpy.searchsorted(data['timestamp'], start, 'left')
+        last = numpy.searchsorted(data['timestamp'], stop, 'right')
+        data = data[first:last]
+    else:
+        # File objects can only be read once, they are read from the start
+        index = numpy.array([], dtype=OML_INDEX_DTYPE)
+        if not hasattr(filename, 'read'):
+            index = oml_index(filename, cache_mode=cache_mode)
+        with _oml_errors():
+            data = _oml_read_range(filename, meas_type, measures, index,
+                                   start, stop)
+
+    if array_empty(data):
+        raise ValueError("No values between %f and %f" % (start, stop))
 
     return data
 
 
-def oml_plot_clock(data, title='Clock time verification'):
-    """ Print clock diff between measures
+def oml_index(filename, step=OML_INDEX_STEP, cache_mode=cache.USE):
+    """ Sparse index of the oml file measures, one line every 'step' bytes
+
+    Read lines only, not the whole file.
+    :returns: numpy array with lines 'timestamp' and 'offset' in file """
+    cache_key = _oml_cache_key(filename, cache_mode, 'index', step)
+    if cache_key is not None and cache_mode == cache.USE:
+        index = cache.load(cache_key)
+        if index is not None:
+            return index
+
+    with _oml_errors():
+        with _oml_open(filename) as oml_fd:
+            index = _oml_index(oml_fd, step)
+
+    if cache_key is not None:
+        cached = cache.store(cache_key, [index])
+        index = index if cached is None else cached
+    return index
+
+
+def time_arg(value):
+    """ Time argument in seconds since experiment start, or since epoch when
+    starting with '@'
+    :returns: (seconds, absolute) """
+    return float(value.lstrip('@')), value.startswith('@')
+
+
+def rolling_arg(value):
+    """ Rolling window argument, samples number or seconds with 's' suffix
+    :returns: (size, seconds) """
+    if value.endswith('s'):
+        size, seconds = float(value[:-1]), True
+    else:
+        size, seconds = int(value), False
+    if size <= 0:
+        raise ValueError(value)
+    return size, seconds
+
+
+def duration_arg(value):
+    """ Duration argument in seconds, strictly positive """
+    seconds = float(value)
+    if not 0 < seconds < float('inf'):
+        raise ValueError(value)
+    return seconds
+
+
+def oml_time_range(filename, start=None, stop=None):
+    """ Convert 'start' and 'stop' time_arg values to epoch seconds
+    Relative times are from the oml header 'start-time' """
+    times = []
+    for time in (start, stop):
+        if time is not None and not time[1]:
+            header = oml_header(filename)
+            try:
+                time = (time[0] + float(header.metadata['start-time']), True)
+            except (KeyError, ValueError):
+                raise ValueError("No 'start-time' in oml header, "
+                                 "use '@' absolute time")
+        times.append(None if time is None else time[0])
+    return tuple(times)
+
+
+def oml_convert(filename, npy_file, meas_type, measures=None,
+                chunk_rows=OML_CHUNK_ROWS):
+    """ Convert oml file to a '.npy' file, that can be memory mapped with
+    numpy.load(npy_file, mmap_mode='r')
+
+    The file is converted by chunks, never loading the whole array.
+    :returns: number of measures """
+    chunks = iter_oml_chunks(filename, meas_type, measures, chunk_rows)
+    return cache.save(npy_file, chunks)
+
+
+def oml_header(filename):
+    """ Read oml file header
+    :returns: OmlHeader with 'metadata' dict and 'schemas' dict
+        {schema_num: [(name, type), ...]} """
+    with _oml_errors():
+        with _oml_open(filename) as oml_fd:
+            return _oml_header(oml_fd)
+
+
+def iter_oml_chunks(filename, meas_type, measures=None,
+                    chunk_rows=OML_CHUNK_ROWS):
+    """ Iterate over oml file measures without loading the whole file
+    :yields: numpy arrays of at most 'chunk_rows' measures, like oml_load
+    :measures: list of MeasureTuple, all schema fields if None """
+    with _oml_errors():
+        with _oml_open(filename) as oml_fd:
+            header = _oml_header(oml_fd)
+            layout = _oml_layout(header, meas_type, measures)
+            for chunk in _oml_parse(oml_fd, meas_type, *layout,
+                                    chunk_rows=chunk_rows):
+                if not array_empty(chunk):
+                    yield chunk
+
+
+def oml_clock_stats(filename, meas_type, measures=None,
+                    chunk_rows=OML_CHUNK_ROWS):
+    """ Clock statistics of oml file, computed by chunks
+    :returns: ClockStats """
+    stats = ClockStats()
+    for chunk in iter_oml_chunks(filename, meas_type, measures, chunk_rows):
+        stats.update(chunk['timestamp'])
+    return stats
+
+
+class ClockStats(object):
+    """ Clock diff statistics between measures, in milliseconds
+
+    Updated incrementally with consecutive timestamps chunks, each chunk
+    mean and variance are merged with the previous ones. """
+
+    def __init__(self):
+        self.count = 0
+        self.start = None
+        self.end = None
+        self.mean = numpy.nan
+        self.min = numpy.nan
+        self.max = numpy.nan
+        self._ndiff = 0
+        self._m2 = 0.0
+
+    def update(self, timestamps):
+        """ Update statistics with next 'timestamps' """
+        if array_empty(timestamps):
+            return
+        self.count += len(timestamps)
+
+        if self.end is None:
+            self.start = timestamps[0]
+        else:
+            timestamps = numpy.concatenate(([self.end], timestamps))
+        self.end = timestamps[-1]
+
+        clock_diff = numpy.diff(timestamps) * 1000
+        if array_empty(clock_diff):
+            return
+        self._merge(clock_diff)
+
+    def _merge(self, clock_diff):
+        """ Merge 'clock_diff' statistics """
+        ndiff = len(clock_diff)
+        mean = numpy.mean(clock_diff)
+        m_2 = numpy.sum((clock_diff - mean) ** 2)
+
+        if self._ndiff:
+            total = self._ndiff + ndiff
+            delta = mean - self.mean
+            self.mean += delta * ndiff / total
+            self._m2 += m_2 + delta ** 2 * self._ndiff * ndiff / total
+            self.min = min(self.min, numpy.min(clock_diff))
+            self.max = max(self.max, numpy.max(clock_diff))
+        else:
+            self.mean, self._m2 = mean, m_2
+            self.min, self.max = numpy.min(clock_diff), numpy.max(clock_diff)
+        self._ndiff += ndiff
+
+    @property
+    def std(self):
+        """ Clock diff standard deviation """
+        if not self._ndiff:
+            return numpy.nan
+        return numpy.sqrt(self._m2 / self._ndiff)
+
+    @property
+    def duration(self):
+        """ Duration in seconds """
+        return self.end - self.start
+
+    @property
+    def steptime(self):
+        """ Mean time between measures in milliseconds """
+        return 1000 * self.duration / self.count
+
+
+def oml_gaps(data):
+    """ Index of missing 'num' sequence numbers
+
+    :params data: oml_load returned array
+    :returns: OML_GAP_DTYPE array, one entry per hole, with first and last
+        missing sequence numbers and timestamps of the measures around it
+    """
+    num = data['num'].astype(numpy.int64)
+    holes = numpy.flatnonzero(numpy.diff(num) > 1)
+
+    gaps = numpy.empty(len(holes), dtype=OML_GAP_DTYPE)
+    gaps['num_start'] = num[holes] + 1
+    gaps['num_end'] = num[holes + 1] - 1
+    gaps['start'] = data['timestamp'][holes]
+    gaps['end'] = data['timestamp'][holes + 1]
+    return gaps
+
+
+def clock_report(data, percentiles=CLOCK_PERCENTILES):
+    """ Clock verification report, json serializable dict
+
+    Clock deltas between measures are in milliseconds.
+    'gaps' are missing 'num' sequence numbers, 'duplicates' and
+    'non_monotonic' count timestamps equal or before the previous one.
     :params data: oml_load returned array
     """
     time = data['timestamp']
     clock_diff = numpy.diff(time) * 1000
+    gaps = oml_gaps(data)
+
+    report = {
+        'count': len(time),
+        'start': float(time[0]) if len(time) else None,
+        'end': float(time[-1]) if len(time) else None,
+        'gaps': len(gaps),
+        'missing': int(numpy.sum(gaps['num_end'] - gaps['num_start'] + 1)),
+        'duplicates': int(numpy.count_nonzero(clock_diff == 0)),
+        'non_monotonic': int(numpy.count_nonzero(clock_diff < 0)),
+        'delta': None,
+    }
+    if len(clock_diff):
+        values = numpy.percentile(clock_diff, percentiles)
+        report['delta'] = {
+            'mean': float(clock_diff.mean()),
+            'std': float(clock_diff.std()),
+            'min': float(clock_diff.min()),
+            'max': float(clock_diff.max()),
+            'percentiles': dict(('p%g' % perc, float(value))
+                                for perc, value in zip(percentiles, values)),
+        }
+    return report
+
+
+def oml_print_clock(data):
+    """ Print clock diff statistics between measures
+    :params data: oml_load returned array
+    :returns: ClockStats
+    """
+    stats = ClockStats()
+    stats.update(data['timestamp'])
+    if not stats.count:
+        print 'No values'
+        return stats
+
+    print 'Time from %f to %f' % (stats.start, stats.end)
+    print 'NB Points      =', stats.count
+    print 'Duration    (s)=', stats.duration
+    print 'Steptime   (ms)=', stats.steptime
+    print 'Clock mean (ms)=', stats.mean
+    print 'Clock std  (ms)=', stats.std
+    print 'Clock max  (ms)=', stats.max
+    print 'Clock min  (ms)=', stats.min
+    return stats
 
-    print 'Time from %f to %f' % (time[0], time[-1])
-    print 'NB Points      =', len(time)
-    print 'Duration    (s)=', time[-1] - time[0]
-    print 'Steptime   (ms)=', 1000 * (time[-1] - time[0]) / len(time)
-    print 'Clock mean (ms)=', numpy.mean(clock_diff)
-    print 'Clock std  (ms)=', numpy.std(clock_diff)
-    print 'Clock max  (ms)=', numpy.max(clock_diff)
-    print 'Clock min  (ms)=', numpy.min(clock_diff)
+
+def oml_plot_clock(data, title='Clock time verification'):
+    """ Print clock diff between measures
+    :params data: oml_load returned array
+    """
+    import matplotlib.pyplot as plt
+    oml_print_clock(data)
+    clock_diff = numpy.diff(data['timestamp']) * 1000
 
     plt.figure()
     plt.title(title)
@@ -114,55 +431,522 @@ def oml_plot_clock(data, title='Clock time verification'):
     return True
 
 
-def plot(data, title, field, ylabel, xlabel=TIMESTAMP_LABEL):
-    """ Plot data """
+def timestamp_ns(data):
+    """ Return 't_s' and 't_us' as int64 nanoseconds timestamps
+
+    Exact integer alternative to the float 'timestamp' field
+    :params data: oml_load returned array
+    """
+    t_s = data['t_s'].astype(numpy.int64)
+    t_us = data['t_us'].astype(numpy.int64)
+    return t_s * 1000000000 + t_us * 1000
+
+
+def plot(data, title,  # pylint:disable=too-many-arguments
+         field, ylabel, xlabel=TIMESTAMP_LABEL, zoom=False, gaps=None):
+    """ Plot data
+
+    NaN runs are reduced to one NaN, still breaking the line.
+    Decimated to the figure width when there are more points than pixels.
+    With 'zoom', the plot is updated on zoom from a resolution pyramid.
+    'gaps' from 'oml_gaps' are shaded """
+    import matplotlib.pyplot as plt
     plt.title(title)
     plt.grid()
     plt.xlabel(xlabel)
     plt.ylabel(ylabel)
-    plt.plot(data['timestamp'], data[field])
+    x_values, y_values = compress_nan(data['timestamp'], data[field])
+    if zoom:
+        plot_zoom(plt.gca(), x_values, y_values)
+    else:
+        plt.plot(*decimate(x_values, y_values, figure_width()))
+    if gaps is not None and len(gaps):
+        plot_gaps(plt.gca(), gaps)
+
+
+def compress_nan(x_values, y_values):
+    """ Remove NaN 'y_values' but the first of each NaN run
+    :returns: (x_values, y_values) """
+    nan = numpy.isnan(y_values)
+    if not nan.any():
+        return x_values, y_values
+    # Leading NaN are removed, others NaN runs start after a value
+    keep = ~nan
+    keep[1:] |= nan[1:] & ~nan[:-1]
+    return x_values[keep], y_values[keep]
+
+
+def plot_gaps(axes, gaps):
+    """ Shade 'gaps' time ranges on 'axes' full height """
+    ranges = zip(gaps['start'], gaps['end'] - gaps['start'])
+    axes.broken_barh(ranges, (0, 1), transform=axes.get_xaxis_transform(),
+                     **GAP_PLT)
+
+
+def plot_zoom(axes, x_values, y_values):
+    """ Plot values on 'axes' from a resolution pyramid
+    The resolution level is updated when axes x limits change """
+    levels = pyramid(x_values, y_values)
+    width = figure_width(axes.figure)
+    line, = axes.plot(*pyramid_select(levels, -numpy.inf, numpy.inf, width))
+
+    def _update(axes):
+        """ Select resolution for new axes limits """
+        xmin, xmax = axes.get_xlim()
+        width = figure_width(axes.figure)
+        line.set_data(*pyramid_select(levels, xmin, xmax, width))
+
+    axes.callbacks.connect('xlim_changed', _update)
+    return line
+
+
+def pyramid(x_values, y_values, factor=PYRAMID_FACTOR):
+    """ Multi-resolution pyramid of 'y_values'
+
+    Level 0 has the values, each next level has the min, max and mean of
+    'factor' values of the previous level, until one value. NaN are ignored.
+    :returns: list of PyramidLevel, with 'x' the buckets first 'x_values' """
+    y_values = numpy.asarray(y_values, dtype=float)
+    count = (~numpy.isnan(y_values)).astype(int)
+    levels = [PyramidLevel(numpy.asarray(x_values), y_values, y_values,
+                           y_values, count)]
+
+    while len(levels[-1].x) > 1:
+        levels.append(_pyramid_reduce(levels[-1], factor))
+    return levels
+
+
+def _pyramid_reduce(level, factor):
+    """ Next pyramid level, reducing 'factor' values of 'level' """
+    pad = -len(level.x) % factor
+
+    def _groups(values, fill):
+        """ Values grouped by 'factor', padded with 'fill' """
+        values = numpy.concatenate((values, numpy.full(pad, fill)))
+        return values.reshape(-1, factor)
+
+    count = _groups(level.count, 0).sum(axis=1)
+    total = numpy.where(level.count, level.mean * level.count, 0)
+    total = _groups(total, 0).sum(axis=1)
+    with numpy.errstate(invalid='ignore'):
+        mean = total / count
+
+    return PyramidLevel(level.x[::factor],
+                        numpy.fmin.reduce(_groups(level.min, numpy.nan), 1),
+                        numpy.fmax.reduce(_groups(level.max, numpy.nan), 1),
+                        mean, count)
+
+
+def pyramid_select(levels, xmin, xmax, buckets):
+    """ Values to plot between 'xmin' and 'xmax' with about 'buckets' pixels
+
+    Use the most detailed level with less than 2 values per bucket, and
+    plot min and max for each of its values.
+    :returns: (x_values, y_values) """
+    for num, level in enumerate(levels):
+        first = max(numpy.searchsorted(level.x, xmin) - 1, 0)
+        last = min(numpy.searchsorted(level.x, xmax, 'right') + 1,
+                   len(level.x))
+        if num == 0 and last - first <= 2 * buckets:
+            return level.x[first:last], level.min[first:last]
+        if last - first <= buckets:
+            break
+
+    x_values = numpy.repeat(level.x[first:last], 2)
+    y_values = numpy.column_stack((level.min[first:last],
+                                   level.max[first:last])).ravel()
+    return x_values, y_values
+
+
+def figure_width(fig=None):
+    """ Current figure width in pixels """
+    import matplotlib.pyplot as plt
+    fig = fig or plt.gcf()
+    return int(fig.get_figwidth() * fig.dpi)
+
+
+def decimate(x_values, y_values, buckets):
+    """ Reduce 'y_values' to their min and max values in 'buckets' buckets
+
+    Keeps spikes visible while plotting at most '2 * buckets' points.
+    NaN values are ignored, unless a bucket has only NaN values.
+    :returns: (x_values, y_values) decimated """
+    size = len(y_values)
+    if size <= 2 * buckets:
+        return x_values, y_values
+
+    # Buckets indexes, last one padded with the last value
+    step = int(numpy.ceil(float(size) / buckets))
+    buckets = int(numpy.ceil(float(size) / step))
+    indexes = numpy.arange(buckets * step).reshape(buckets, step)
+    indexes = numpy.minimum(indexes, size - 1)
+
+    values = numpy.asarray(y_values)[indexes]
+    nan = numpy.isnan(values)
+    argmin = numpy.where(nan, numpy.inf, values).argmin(axis=1)
+    argmax = numpy.where(nan, -numpy.inf, values).argmax(axis=1)
+
+    # min and max in their time order
+    rows = numpy.arange(buckets)
+    selected = numpy.sort(numpy.column_stack((argmin, argmax)), axis=1)
+    selected = indexes[rows[:, numpy.newaxis], selected].ravel()
+
+    return numpy.asarray(x_values)[selected], numpy.asarray(y_values)[selected]
+
+
+def rolling_apply(data, fields, window, stat='mean'):
+    """ Replace 'fields' values by their 'stat' on trailing 'window'
+    :param window: rolling_arg (size, seconds) value
+    :returns: new array, rolled fields are float """
+    dtype = [(name, float if name in fields else data.dtype[name])
+             for name in data.dtype.names]
+    rolled = numpy.empty(len(data), dtype=dtype)
+    starts = rolling_starts(data['timestamp'], window)
+    for name in data.dtype.names:
+        if name in fields:
+            rolled[name] = rolling(data[name], starts, stat)
+        else:
+            rolled[name] = data[name]
+    return rolled
+
+
+def rolling_starts(time, window):
+    """ Index of the first measure of each measure trailing 'window'
+
+    Windows of 'size' measures, or of 'size' seconds until the measure.
+    :param window: rolling_arg (size, seconds) value """
+    size, seconds = window
+    if seconds:
+        # searchsorted needs non decreasing timestamps
+        time = numpy.maximum.accumulate(time)
+        return numpy.searchsorted(time, time - size, 'left')
+    return numpy.maximum(numpy.arange(len(time)) - size + 1, 0)
+
+
+def rolling(values, starts, stat='mean'):
+    """ 'stat' of values[starts[i]:i + 1] for each 'i', NaN are ignored
+
+    Mean and std use cumulative sums, min and max a sparse table,
+    with one level in memory at a time. """
+    values = numpy.asarray(values, dtype=float)
+    ends = numpy.arange(1, len(values) + 1)
+    if stat in ('min', 'max'):
+        return _rolling_extremum(values, starts, ends, stat)
+
+    # Centered values for std numerical precision
+    nan = numpy.isnan(values)
+    offset = values[~nan].mean() if not nan.all() else 0.0
+    centered = numpy.where(nan, 0, values - offset)
+
+    def _window_sum(array):
+        """ Sum of 'array' on windows """
+        cumsum = numpy.r_[0, numpy.cumsum(array)]
+        return cumsum[ends] - cumsum[starts]
+
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        count = _window_sum(~nan)
+        mean = _window_sum(centered) / count
+        if stat == 'mean':
+            return mean + offset
+        var = _window_sum(centered ** 2) / count - mean ** 2
+    return numpy.sqrt(numpy.maximum(var, 0))
+
+
+def _rolling_extremum(values, starts, ends, stat):
+    """ Min or max of values[starts:ends] windows using a sparse table
+
+    Level 'k' table has the extremum of '2 ** k' values from each index,
+    a window is covered by two, possibly overlapping, level entries. """
+    func = numpy.fmin if stat == 'min' else numpy.fmax
+    result = numpy.full(len(values), numpy.nan)
+    if not len(values):
+        return result
+    lengths = ends - starts
+    levels = numpy.floor(numpy.log2(lengths)).astype(int)
+
+    table = values
+    for level in range(levels.max() + 1):
+        width = 1 << level
+        if level:
+            table = func(table[:-width // 2], table[width // 2:])
+        select = numpy.flatnonzero(levels == level)
+        result[select] = func(table[starts[select]],
+                              table[ends[select] - width])
+    return result
 
 
 def plot_show():
     """Show image."""
+    import matplotlib.pyplot as plt
     plt.tight_layout()
     plt.show()
 
 
+def plot_output(figures, output=None):
+    """ Show figures, or save them to 'output' if given """
+    if output is None:
+        plot_show()
+    else:
+        plot_save(figures, output)
+
+
+def plot_save(figures, output):
+    """ Save 'figures' to 'output' file and close them.
+    Layout is computed like when shown, as plot_show is not called.
+    With multiple figures, files are numbered: 'name-1.png', 'name-2.png'
+    :returns: saved files names """
+    import matplotlib.pyplot as plt
+    root, ext = os.path.splitext(output)
+    outputs = []
+    for num, fig in enumerate(figures, start=1):
+        path = output if len(figures) == 1 else '%s-%d%s' % (root, num, ext)
+        fig.tight_layout()
+        fig.savefig(path)
+        plt.close(fig)
+        outputs.append(path)
+    return outputs
+
+
+def plot_headless():
+    """ Use non-interactive backend, to save files without display """
+    import matplotlib.pyplot as plt
+    plt.switch_backend('agg')
+
+
+def new_figures(fignums):
+    """ Figures opened since 'fignums' figures """
+    import matplotlib.pyplot as plt
+    return [plt.figure(num) for num in plt.get_fignums()
+            if num not in fignums]
+
+
 # Help functions
 
 
-def _oml_read(filename, meas_type, fields_dtypes=()):
+def _oml_read(filename, meas_type, measures=None):
     """ Read oml file
     :measures: list of MeasureTuple """
 
-    # Select values
-    dtypes = OML_FIELDS + list(fields_dtypes)
-    names = [entry[0] for entry in dtypes]
+    with _oml_open(filename) as oml_fd:
+        header = _oml_header(oml_fd)
+        layout = _oml_layout(header, meas_type, measures)
+        chunks = list(_oml_parse(oml_fd, meas_type, *layout))
+
+    return numpy.concatenate(chunks)
+
+
+def _oml_header(oml_fd):
+    """ Read header from 'oml_fd'
+
+    Header ends with an empty line, or after OML_HEADER_LEN lines when
+    there is no 'content' line """
+    metadata = {}
+    schemas = {}
+
+    for num in itertools.count(1):
+        # 'readline' keeps file position valid for 'tell'
+        line = oml_fd.readline()
+        if not line:
+            raise ValueError("Incomplete oml header")
+        line = line.strip()
+        if not line:
+            break
+
+        key, _, value = line.partition(':')
+        if key == 'schema':
+            fields = value.split()
+            schemas[int(fields[0])] = [tuple(field.split(':', 1))
+                                       for field in fields[2:]]
+        else:
+            metadata[key] = value.strip()
+
+        if num == OML_HEADER_LEN and 'content' not in metadata:
+            break
+
+    return OmlHeader(metadata, schemas)
+
+
+def _oml_read_range(filename, meas_type,  # pylint:disable=too-many-arguments
+                    measures, index, start, stop):
+    """ Read oml file measures between 'start' and 'stop' using 'index' """
+    chunks = []
+    with _oml_open(filename) as oml_fd:
+        header = _oml_header(oml_fd)
+        layout = _oml_layout(header, meas_type, measures)
+
+        entry = numpy.searchsorted(index['timestamp'], start, 'right') - 1
+        if entry >= 0:
+            oml_fd.seek(index['offset'][entry])
+
+        for chunk in _oml_parse(oml_fd, meas_type, *layout):
+            time = chunk['timestamp']
+            chunks.append(chunk[(start <= time) & (time <= stop)])
+            if len(chunk) and time[-1] > stop:
+                break
+
+    return numpy.concatenate(chunks)
+
+
+def _oml_index(oml_fd, step):
+    """ Index measures lines timestamps and offsets every 'step' bytes """
+    _oml_header(oml_fd)
+
+    index = []
+    offset = oml_fd.tell()
+    line = oml_fd.readline()
+    while line:
+        timestamp = _oml_line_timestamp(line)
+        if timestamp is not None:
+            index.append((timestamp, offset))
+            # Go to next line after 'step' bytes
+            oml_fd.seek(offset + step)
+            oml_fd.readline()
+
+        offset = oml_fd.tell()
+        line = oml_fd.readline()
+
+    return numpy.array(index, dtype=OML_INDEX_DTYPE)
+
+
+def _oml_line_timestamp(line):
+    """ Measure line 't_s + t_us' timestamp, None if invalid """
+    fields = line.split()
+    try:
+        return float(fields[3]) + float(fields[4]) / 1e6
+    except (IndexError, ValueError):
+        return None
+
+
+def _oml_layout(header, meas_type, measures=None):
+    """ Measures dtypes and their columns in oml lines
+
+    Columns and types are taken from the header schema for 'meas_type' if
+    declared, else from 'measures'.
+    :returns: (dtypes, columns, ncols) """
+    schema = header.schemas.get(OML_TYPES[meas_type])
+    if schema is not None:
+        fields = [(OML_SCHEMA_NAMES.get(name, name),
+                   OML_SCHEMA_TYPES.get(_type)) for name, _type in schema]
+    elif measures is not None:
+        fields = OML_FIELDS[3:] + [(m.name, m.type) for m in measures]
+    else:
+        raise ValueError("No schema for %s" % meas_type)
+
+    # Columns after 'timestamp type num'
+    names = [name for name, _ in fields]
+    types = dict(fields)
+    if measures is None:
+        selected = [name for name in names if types[name] is not None]
+    else:
+        selected = ['t_s', 't_us'] + [m.name for m in measures]
+
+    dtypes = [OML_FIELDS[0], ('type', numpy.str_, len(meas_type)),
+              OML_FIELDS[2]]
+    columns = [0, 1, 2]
+    for name in selected:
+        if types.get(name) is None:
+            raise ValueError("Field %s not in %s schema" % (name, meas_type))
+        dtypes.append((name, types[name]))
+        columns.append(3 + names.index(name))
+
+    return dtypes, columns, 3 + len(fields)
+
+
+def _oml_cache_key(filename, cache_mode, *args):
+    """ Cache key for oml file and 'args', None if not cached """
+    if cache_mode == cache.BYPASS or hasattr(filename, 'read'):
+        return None
+    try:
+        return cache.key(filename, *args)
+    except OSError:
+        return None
+
 
-    # Read values from file
-    c_meas_type = {names.index('type'): _valid_oml_f(meas_type)}
-    data = numpy.genfromtxt(filename, skip_header=OML_HEADER_LEN, names=names,
-                            dtype=dtypes, converters=c_meas_type,
-                            invalid_raise=False)
+def _measures_key(measures):
+    """ Measures names and types, for cache key """
+    if measures is None:
+        return None
+    return [(m.name, m.type) for m in measures]
+
+
+@contextlib.contextmanager
+def _oml_errors():
+    """ Convert oml file reading errors to ValueError """
+    try:
+        yield
+    except IOError as err:
+        raise ValueError("Error opening oml file:\n{0}\n".format(err))
+    except (ValueError, StopIteration, IndexError) as err:
+        raise ValueError("Error reading oml file:\n{0}\n".format(err))
+    except TypeError as err:
+        raise ValueError("{0}".format(err))
+
+
+@contextlib.contextmanager
+def _oml_open(filename):
+    """ Open 'filename', file objects are used as is """
+    if hasattr(filename, 'read'):
+        yield filename
+    else:
+        with open(filename) as oml_fd:
+            yield oml_fd
+
+
+def _oml_parse(oml_fd, meas_type,  # pylint:disable=too-many-arguments
+               dtypes, columns, ncols, chunk_rows=OML_CHUNK_ROWS):
+    """ Parse oml measures lines from 'oml_fd' by chunks of 'chunk_rows'
+
+    Always yield at least one, maybe empty, chunk """
+    lines = list(itertools.islice(oml_fd, chunk_rows))
+    yield _oml_parse_lines(lines, meas_type, dtypes, columns, ncols)
+
+    while len(lines) == chunk_rows:
+        lines = list(itertools.islice(oml_fd, chunk_rows))
+        yield _oml_parse_lines(lines, meas_type, dtypes, columns, ncols)
+
+
+def _oml_parse_lines(lines, meas_type, dtypes, columns, ncols):
+    """ Parse oml measures 'lines' in a new structured array
+    Field 'dtypes[i]' is read from column 'columns[i]' """
+
+    # Parse all values at once, one line is 'timestamp type num t_s t_us ...'
+    text = ''.join(lines)
+    values = numpy.fromstring(text, sep=' ')
+    if values.size != len(lines) * ncols or \
+            numpy.any(_oml_tokens_count(text) != ncols):
+        values = _oml_valid_values(lines, ncols)
+    values = values.reshape(-1, ncols)
+
+    if not numpy.all(values[:, 1] == OML_TYPES[meas_type]):
+        raise TypeError("OML file is not: %s" % meas_type)
+
+    data = numpy.empty(len(values), dtype=dtypes)
+    for col, name in zip(columns, data.dtype.names):
+        data[name] = values[:, col]
+    data['type'] = meas_type
 
     # Update 'timestamp' field with the cn calculated timestamp
-    for row in numpy.nditer(data, op_flags=['readwrite']):
-        timestamp = row['t_s'] + row['t_us'] / 1e6
-        row['timestamp'] = timestamp
+    data['timestamp'] = data['t_s'] + data['t_us'] / 1e6
 
     return data
 
 
-def _valid_oml_f(meas_type):
-    """ Return a function that validates oml type """
-    def _validate(value):
-        """ Check that 'meas_type' column matchs requested """
-        value = int(value)
-        if int(value) == OML_TYPES[meas_type]:
-            return meas_type
-        raise TypeError("OML file is not: %s" % meas_type)
-    return _validate
+def _oml_tokens_count(text):
+    """ Number of whitespace separated tokens on each line of 'text' """
+    chars = numpy.frombuffer(text, dtype=numpy.uint8)
+    space = chars <= ord(' ')
+    tokens = numpy.cumsum(~space & numpy.r_[True, space[:-1]])
+    ends = numpy.flatnonzero(chars == ord('\n'))
+    if len(chars) and chars[-1] != ord('\n'):
+        ends = numpy.r_[ends, len(chars) - 1]
+    return numpy.diff(numpy.r_[0, tokens[ends]])
+
+
+def _oml_valid_values(lines, ncols):
+    """ Values from lines with 'ncols' columns, others are ignored """
+    rows = [line.split() for line in lines]
+    rows = [row for row in rows if len(row) == ncols]
+    return numpy.array(rows, dtype=float)
 
 
 def array_empty(array):
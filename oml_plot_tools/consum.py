@@ -22,8 +22,12 @@
 
 
 """
-usage: plot_oml_consum [-h] -i DATA [-l TITLE] [-b BEGIN] [-e END] [-a] [-p]
-                       [-v] [-c] [-t]
+usage: plot_oml_consum [-h] -i DATA [-l TITLE] [-b BEGIN] [-e END]
+                       [--start TIME] [--stop TIME] [--no-cache]
+                       [--rebuild-cache] [--derive-power] [-z]
+                       [--rolling WINDOW] [--rolling-stat {mean,min,max,std}]
+                       [--gaps] [-o FILE] [-s] [--time-report] [--energy]
+                       [--window SECONDS] [-a] [-p] [-v] [-c] [-t]
 
 Plot iot-lab consumption OML files
 
@@ -36,6 +40,28 @@ optional arguments:
   -b BEGIN, --begin BEGIN
                         Sample start
   -e END, --end END     Sample end
+  --start TIME          Time start, in seconds since experiment start or since
+                        epoch when starting with '@'
+  --stop TIME           Time stop, same format as start
+  --no-cache            Do not use parsed files cache
+  --rebuild-cache       Rebuild parsed files cache
+  --derive-power        Compute missing power values from voltage and current
+  -z, --zoom            Update plots resolution on zoom
+  --rolling WINDOW      Plot values rolling statistic on trailing windows of
+                        WINDOW measures, or seconds with 's' suffix
+  --rolling-stat {mean,min,max,std}
+                        Rolling statistic, default mean
+  --gaps                Shade sequence number gaps on plots
+  -o FILE, --output FILE
+                        Save plots to file instead of showing them, format
+                        from extension
+  -s, --stats           Only print time verification statistics, without
+                        plotting
+  --time-report         Only print time verification report as JSON, without
+                        plotting
+  --energy              Only print energy and power report as JSON, without
+                        plotting
+  --window SECONDS      Energy report time windows duration
 
 plot:
   Plot selection
@@ -48,9 +74,12 @@ plot:
 """
 
 
+import json
 import argparse
-import matplotlib.pyplot as plt
+
+import numpy
 from . import common
+from . import cache
 
 
 # Selection variables
@@ -69,20 +98,73 @@ MEASURES_D = common.measures_dict(
 )
 
 
-def oml_load(filename):
-    """ Load consumption oml file """
-    data = common.oml_load(filename, 'consumption', MEASURES_D.values())
+def oml_load(filename,  # pylint:disable=too-many-arguments
+             cache_mode=cache.USE, start=None, stop=None, derive=False):
+    """ Load consumption oml file
+    :param derive: replace 'nan' power values with voltage * current """
+    data = common.oml_load(filename, 'consumption', MEASURES_D.values(),
+                           cache_mode=cache_mode, start=start, stop=stop)
+    if derive:
+        data = derive_power(data)
+    return data
+
+
+def derive_power(data):
+    """ Replace 'nan' power values with voltage * current
+    Returns a copy if there were 'nan' power values, as cached data are
+    read-only """
+    missing = numpy.isnan(data[_POWER])
+    if not missing.any():
+        return data
+    data = numpy.array(data)
+    data[_POWER][missing] = data[_VOLTAGE][missing] * data[_CURRENT][missing]
     return data
 
 
 PARSER = argparse.ArgumentParser(
     prog='plot_oml_consum', description="Plot iot-lab consumption OML files")
-PARSER.add_argument('-i', '--input', dest='data', type=oml_load, required=True,
+PARSER.add_argument('-i', '--input', metavar='DATA', required=True,
                     help="Node consumption values")
 PARSER.add_argument('-l', '--label', dest='title', default=_TITLE,
                     help="Graph title")
 PARSER.add_argument('-b', '--begin', default=0, type=int, help="Sample start")
 PARSER.add_argument('-e', '--end', default=-1, type=int, help="Sample end")
+PARSER.add_argument('--start', metavar='TIME', type=common.time_arg,
+                    help="Time start, in seconds since experiment start "
+                         "or since epoch when starting with '@'")
+PARSER.add_argument('--stop', metavar='TIME', type=common.time_arg,
+                    help="Time stop, same format as start")
+PARSER.add_argument('--no-cache', dest='cache', action='store_const',
+                    const=cache.BYPASS, default=cache.USE,
+                    help="Do not use parsed files cache")
+PARSER.add_argument('--rebuild-cache', dest='cache', action='store_const',
+                    const=cache.REBUILD, help="Rebuild parsed files cache")
+PARSER.add_argument('--derive-power', dest='derive', action='store_true',
+                    help="Compute missing power values from voltage and "
+                         "current")
+PARSER.add_argument('-z', '--zoom', action='store_true',
+                    help="Update plots resolution on zoom")
+PARSER.add_argument('--rolling', metavar='WINDOW', type=common.rolling_arg,
+                    help="Plot values rolling statistic on trailing windows "
+                         "of WINDOW measures, or seconds with 's' suffix")
+PARSER.add_argument('--rolling-stat', choices=common.ROLLING_STATS,
+                    default='mean', help="Rolling statistic, default mean")
+PARSER.add_argument('--gaps', action='store_true',
+                    help="Shade sequence number gaps on plots")
+PARSER.add_argument('-o', '--output', metavar='FILE',
+                    help="Save plots to file instead of showing them, "
+                         "format from extension")
+PARSER.add_argument('-s', '--stats', action='store_true',
+                    help="Only print time verification statistics, "
+                         "without plotting")
+PARSER.add_argument('--time-report', action='store_true',
+                    help="Only print time verification report as JSON, "
+                         "without plotting")
+PARSER.add_argument('--energy', action='store_true',
+                    help="Only print energy and power report as JSON, "
+                         "without plotting")
+PARSER.add_argument('--window', metavar='SECONDS', type=common.duration_arg,
+                    help="Energy report time windows duration")
 
 _PLOT = PARSER.add_argument_group('plot', "Plot selection")
 _PLOT.add_argument('-a', '--all', dest='plot', const=_ALL,
@@ -98,7 +180,16 @@ _PLOT.add_argument('-t', '--time', dest='plot', const=_TIME,
                    action='append_const', help="Plot time verification")
 
 
-def consumption_plot(data, title, selection):
+def consumption_plot(data, title,  # pylint:disable=too-many-arguments
+                     selection, zoom=False, output=None, show_gaps=False):
+    """ Plot consumption figures, then show them or save them to 'output'
+    :returns: figures """
+    figures = consumption_figures(data, title, selection, zoom, show_gaps)
+    common.plot_output(figures, output)
+    return figures
+
+
+def consumption_figures(data, title, selection, zoom=False, show_gaps=False):
     """ Plot consumption values according to selection
 
     :param data: numpy array returned by oml_read
@@ -107,31 +198,40 @@ def consumption_plot(data, title, selection):
         'power', 'voltage', 'current': plot on different windows
         'all': plot all three on the same window
         'time': plot time verification
+    :param zoom: update plots resolution on zoom
+    :param show_gaps: shade sequence number gaps
+    :returns: figures
     """
+    import matplotlib.pyplot as plt
+    fignums = plt.get_fignums()
+    gaps = common.oml_gaps(data) if show_gaps else None
 
     # Single selection of 'p/v/c'
     for value in (_POWER, _VOLTAGE, _CURRENT):
         if value in selection:
-            oml_plot(data, title, [MEASURES_D[value]])
+            oml_plot(data, title, [MEASURES_D[value]], zoom=zoom, gaps=gaps)
 
     # Plot all on the same window
     if _ALL in selection:
-        oml_plot(data, title, MEASURES_D.values())
+        oml_plot(data, title, MEASURES_D.values(), zoom=zoom, gaps=gaps)
 
     # Clock verification
     if 'time' in selection:
         common.oml_plot_clock(data)
 
-    common.plot_show()
+    return common.new_figures(fignums)
 
 
-def oml_plot(data, title, meas_tuples):
+def oml_plot(data, title, meas_tuples, zoom=False, gaps=None):
     """ Plot consumption value for 'meas_tuples'
 
     :param data: numpy array returned by oml_read
     :param title: Subplots title base
     :param meas_tuples: numpy.dtypesplots separated on different windows
+    :param zoom: update plots resolution on zoom
+    :param gaps: sequence number gaps to shade
     """
+    import matplotlib.pyplot as plt
 
     nbplots = len(meas_tuples)
     plt.figure()
@@ -140,17 +240,166 @@ def oml_plot(data, title, meas_tuples):
         plt.subplot(nbplots, 1, num)
 
         _title = '%s %s' % (title, meas.name)
-        common.plot(data, _title, meas.name, meas.label)
+        common.plot(data, _title, meas.name, meas.label, zoom=zoom,
+                    gaps=gaps)
+
+
+def oml_energy_stats(filename, window=None, derive=False,
+                     chunk_rows=common.OML_CHUNK_ROWS):
+    """ Energy statistics of consumption oml file, computed by chunks
+    :param derive: replace 'nan' power values with voltage * current
+    :returns: EnergyStats """
+    stats = EnergyStats(window)
+    for chunk in common.iter_oml_chunks(filename, 'consumption',
+                                        MEASURES_D.values(), chunk_rows):
+        stats.update(derive_power(chunk) if derive else chunk)
+    return stats
+
+
+class EnergyStats(object):
+    """ Energy and power statistics, by time windows
+
+    Energy is the trapezoidal integration of power over timestamps,
+    intervals with a 'nan' power at either end are skipped.
+    Windows of 'window' seconds start from the first measure, or the whole
+    trace is one window if None. An interval is accounted in the window of
+    its first measure.
+    Updated incrementally with consecutive measures chunks. """
+
+    def __init__(self, window=None):
+        self.window = window
+        self.start = None
+        self.windows = {}
+        self._last = None
+
+    def update(self, data):
+        """ Update statistics with 'data' measures """
+        if not len(data):
+            return
+        time = data['timestamp']
+        power = data[_POWER].astype(float)
+        if self.start is None:
+            self.start = time[0]
+        index = self._window_index(time)
+        peaks = numpy.where(numpy.isnan(power), -numpy.inf, power)
+
+        # Continue integration from previous chunk last measure
+        if self._last is not None:
+            time = numpy.r_[self._last[0], time]
+            power = numpy.r_[self._last[1], power]
+            ints_index = numpy.r_[self._last[2], index]
+        else:
+            ints_index = index
+        self._last = (time[-1], power[-1], index[-1])
+
+        delta = numpy.diff(time)
+        energy = delta * (power[1:] + power[:-1]) / 2
+        valid = ~numpy.isnan(energy)
+        ints_index = ints_index[:-1]
+
+        windows, inverse = numpy.unique(numpy.r_[ints_index[valid], index],
+                                        return_inverse=True)
+        nints = numpy.count_nonzero(valid)
+        size = len(windows)
+        values = numpy.array([
+            numpy.bincount(inverse[:nints], weights=energy[valid],
+                           minlength=size),
+            numpy.bincount(inverse[:nints], weights=delta[valid],
+                           minlength=size),
+            numpy.bincount(inverse[nints:], minlength=size),
+            _reduce_max(inverse[nints:], peaks, size),
+        ])
+        # Merge with windows [energy, duration, count, peak]
+        for window, wvalues in zip(windows.tolist(), values.T):
+            stats = self.windows.setdefault(
+                window, numpy.array([0.0, 0.0, 0.0, -numpy.inf]))
+            stats[:3] += wvalues[:3]
+            stats[3] = max(stats[3], wvalues[3])
+
+    def _window_index(self, time):
+        """ Window number of each timestamp """
+        if self.window is None:
+            return numpy.zeros(len(time), dtype=numpy.int64)
+        return ((time - self.start) // self.window).astype(numpy.int64)
+
+    def report(self):
+        """ Energy report, json serializable dict
+
+        Energy in Joules, power in Watts, 'duration' is the integrated
+        time in seconds, without 'nan' power intervals. """
+        windows = [self._window_report(window) for window in
+                   sorted(self.windows)]
+        total = _energy_report(
+            sum(w['energy'] for w in windows),
+            sum(w['duration'] for w in windows),
+            sum(w['count'] for w in windows),
+            max([self.windows[w][3] for w in self.windows] or [-numpy.inf]))
+        total['windows'] = windows
+        return total
+
+    def _window_report(self, window):
+        """ Report for 'window' """
+        report = _energy_report(*self.windows[window])
+        if self.window is None:
+            report['start'] = self.start
+        else:
+            report['start'] = self.start + window * self.window
+        return report
+
+
+def _energy_report(energy, duration, count, peak):
+    """ Energy report values dict """
+    return {
+        'energy': float(energy),
+        'duration': float(duration),
+        'count': int(count),
+        'mean_power': float(energy / duration) if duration else None,
+        'peak_power': float(peak) if numpy.isfinite(peak) else None,
+    }
+
+
+def _reduce_max(groups, values, size):
+    """ Max of 'values' in each of 'size' groups numbers """
+    order = numpy.argsort(groups, kind='mergesort')
+    starts = numpy.searchsorted(groups[order], numpy.arange(size))
+    result = numpy.full(size, -numpy.inf)
+    used = numpy.bincount(groups, minlength=size) > 0
+    result[used] = numpy.maximum.reduceat(values[order], starts[used])
+    return result
 
 
 def main():
     """ Main command """
     opts = PARSER.parse_args()
+    if opts.window is not None and not opts.energy:
+        PARSER.error('--window requires --energy')
+    try:
+        start, stop = common.oml_time_range(opts.input, opts.start, opts.stop)
+        data = oml_load(opts.input, opts.cache, start, stop, opts.derive)
+    except ValueError as err:
+        PARSER.error(str(err))
     # default to plot all
     selection = opts.plot or (_ALL)
     # select samples
-    data = opts.data[opts.begin:opts.end]
-    consumption_plot(data, opts.title, selection)
+    data = data[opts.begin:opts.end]
+    if opts.stats:
+        common.oml_print_clock(data)
+        return
+    if opts.time_report:
+        print json.dumps(common.clock_report(data), indent=2, sort_keys=True)
+        return
+    if opts.energy:
+        stats = EnergyStats(opts.window)
+        stats.update(data)
+        print json.dumps(stats.report(), indent=2, sort_keys=True)
+        return
+    if opts.rolling:
+        data = common.rolling_apply(data, MEASURES_D.keys(), opts.rolling,
+                                    opts.rolling_stat)
+    if opts.output:
+        common.plot_headless()
+    consumption_plot(data, opts.title, selection, opts.zoom, opts.output,
+                     opts.gaps)
 
 
 if __name__ == "__main__":
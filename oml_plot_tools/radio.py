@@ -22,8 +22,13 @@
 
 
 """
-usage: plot_oml_radio [-h] -i DATA [-l TITLE] [-b BEGIN] [-e END] [-a] [-p]
-                      [-t]
+usage: plot_oml_radio [-h] -i DATA [-l TITLE] [-b BEGIN] [-e END]
+                      [--start TIME] [--stop TIME] [--no-cache]
+                      [--rebuild-cache] [--rolling WINDOW]
+                      [--rolling-stat {mean,min,max,std}] [--gaps] [-o FILE]
+                      [-s] [--time-report] [--channel-stats [FORMAT]]
+                      [--busy-threshold DBM] [-a] [-p] [--heatmap]
+                      [--heatmap-mean] [-t]
 
 Plot iot-lab radio OML files
 
@@ -36,19 +41,48 @@ optional arguments:
   -b BEGIN, --begin BEGIN
                         Sample start
   -e END, --end END     Sample end
+  --start TIME          Time start, in seconds since experiment start or since
+                        epoch when starting with '@'
+  --stop TIME           Time stop, same format as start
+  --no-cache            Do not use parsed files cache
+  --rebuild-cache       Rebuild parsed files cache
+  --rolling WINDOW      Plot values rolling statistic on trailing windows of
+                        WINDOW measures, or seconds with 's' suffix
+  --rolling-stat {mean,min,max,std}
+                        Rolling statistic, default mean
+  --gaps                Shade sequence number gaps on plots
+  -o FILE, --output FILE
+                        Save plots to file instead of showing them, format
+                        from extension
+  -s, --stats           Only print time verification statistics, without
+                        plotting
+  --time-report         Only print time verification report as JSON, without
+                        plotting
+  --channel-stats [FORMAT]
+                        Only print channels RSSI statistics, as 'json'
+                        (default) or 'csv'
+  --busy-threshold DBM  RSSI above which a channel is busy, default -80
 
 plot:
   Plot selection
 
   -a, --all             Plot all channels in one window (default)
   -p, --plot            Plot channels in different windows
+  --heatmap             Plot channels x time max RSSI heatmap
+  --heatmap-mean        Plot channels x time mean RSSI heatmap
   -t, --time            Plot time verification
 """
 
 
+import csv
+import sys
+import json
 import argparse
-import matplotlib.pyplot as plt
+from collections import OrderedDict
+
+import numpy
 from . import common
+from . import cache
 
 MEASURES_D = common.measures_dict(
     ('channel', int, 'Channel'),
@@ -56,26 +90,73 @@ MEASURES_D = common.measures_dict(
 )
 
 
-def oml_load(filename):
+def oml_load(filename, cache_mode=cache.USE, start=None, stop=None):
     """ Load radio oml file """
-    data = common.oml_load(filename, 'radio', MEASURES_D.values())
+    data = common.oml_load(filename, 'radio', MEASURES_D.values(),
+                           cache_mode=cache_mode, start=start, stop=stop)
     return data
 
 
+# RSSI histograms bins, one per dBm value
+RSSI_MIN = -128
+RSSI_BINS = 256
+BUSY_THRESHOLD = -80
+STATS_PERCENTILES = (5, 25, 50, 75, 95)
+STATS_CSV_FIELDS = ['channel', 'count', 'min', 'max', 'mean',
+                    'busy_fraction', 'busy_periods', 'busy_time',
+                    'busy_longest']
+
+
 # Selection variables
 _JOINED = 'joined'
 _SEPARATED = 'separated'
 _TIME = 'time'
+_HEATMAP = 'heatmap'
+_HEATMAP_MEAN = 'heatmap_mean'
 
 
 PARSER = argparse.ArgumentParser(
     prog='plot_oml_radio', description="Plot iot-lab radio OML files")
-PARSER.add_argument('-i', '--input', dest='data', type=oml_load, required=True,
+PARSER.add_argument('-i', '--input', metavar='DATA', required=True,
                     help="Node radio values")
 PARSER.add_argument('-l', '--label', dest='title', default="Node",
                     help="Graph title")
 PARSER.add_argument('-b', '--begin', default=0, type=int, help="Sample start")
 PARSER.add_argument('-e', '--end', default=-1, type=int, help="Sample end")
+PARSER.add_argument('--start', metavar='TIME', type=common.time_arg,
+                    help="Time start, in seconds since experiment start "
+                         "or since epoch when starting with '@'")
+PARSER.add_argument('--stop', metavar='TIME', type=common.time_arg,
+                    help="Time stop, same format as start")
+PARSER.add_argument('--no-cache', dest='cache', action='store_const',
+                    const=cache.BYPASS, default=cache.USE,
+                    help="Do not use parsed files cache")
+PARSER.add_argument('--rebuild-cache', dest='cache', action='store_const',
+                    const=cache.REBUILD, help="Rebuild parsed files cache")
+PARSER.add_argument('--rolling', metavar='WINDOW', type=common.rolling_arg,
+                    help="Plot values rolling statistic on trailing windows "
+                         "of WINDOW measures, or seconds with 's' suffix")
+PARSER.add_argument('--rolling-stat', choices=common.ROLLING_STATS,
+                    default='mean', help="Rolling statistic, default mean")
+PARSER.add_argument('--gaps', action='store_true',
+                    help="Shade sequence number gaps on plots")
+PARSER.add_argument('-o', '--output', metavar='FILE',
+                    help="Save plots to file instead of showing them, "
+                         "format from extension")
+PARSER.add_argument('-s', '--stats', action='store_true',
+                    help="Only print time verification statistics, "
+                         "without plotting")
+PARSER.add_argument('--time-report', action='store_true',
+                    help="Only print time verification report as JSON, "
+                         "without plotting")
+PARSER.add_argument('--channel-stats', nargs='?', choices=('json', 'csv'),
+                    const='json', metavar='FORMAT',
+                    help="Only print channels RSSI statistics, "
+                         "as 'json' (default) or 'csv'")
+PARSER.add_argument('--busy-threshold', metavar='DBM', type=int,
+                    default=BUSY_THRESHOLD,
+                    help="RSSI above which a channel is busy, "
+                         "default %(default)s")
 
 _PLOT = PARSER.add_argument_group('plot', "Plot selection")
 _PLOT.add_argument('-a', '--all', dest='plot', const=_JOINED,
@@ -84,11 +165,25 @@ _PLOT.add_argument('-a', '--all', dest='plot', const=_JOINED,
 _PLOT.add_argument('-p', '--plot', dest='plot', const=_SEPARATED,
                    action='append_const',
                    help="Plot channels in different windows")
+_PLOT.add_argument('--heatmap', dest='plot', const=_HEATMAP,
+                   action='append_const',
+                   help="Plot channels x time max RSSI heatmap")
+_PLOT.add_argument('--heatmap-mean', dest='plot', const=_HEATMAP_MEAN,
+                   action='append_const',
+                   help="Plot channels x time mean RSSI heatmap")
 _PLOT.add_argument('-t', '--time', dest='plot', const=_TIME,
                    action='append_const', help="Plot time verification")
 
 
-def radio_plot(data, title, selection):
+def radio_plot(data, title, selection, output=None, show_gaps=False):
+    """ Plot radio figures, then show them or save them to 'output'
+    :returns: figures """
+    figures = radio_figures(data, title, selection, show_gaps)
+    common.plot_output(figures, output)
+    return figures
+
+
+def radio_figures(data, title, selection, show_gaps=False):
     """ Plot radio values according to selection
 
     :param data: numpy array returnel by oml_read
@@ -96,42 +191,93 @@ def radio_plot(data, title, selection):
     :param selection: with values in
         'joined': plot on the same window
         'separated': plot on different windows
+        'heatmap', 'heatmap_mean': plot max/mean RSSI heatmap
         'time': plot time verification
+    :param show_gaps: shade sequence number gaps
+    :returns: figures
     """
+    import matplotlib.pyplot as plt
+    fignums = plt.get_fignums()
+    gaps = common.oml_gaps(data) if show_gaps else None
 
+    channels = None
+    if _JOINED in selection or _SEPARATED in selection:
+        channels = group_channels(data)
     if _JOINED in selection:
-        oml_plot_rssi(data, title)
+        oml_plot_rssi(data, title, gaps=gaps, channels=channels)
     if _SEPARATED in selection:
-        oml_plot_rssi(data, title, separated=True)
+        oml_plot_rssi(data, title, separated=True, gaps=gaps,
+                      channels=channels)
+    if _HEATMAP in selection:
+        oml_plot_heatmap(data, title, 'max')
+    if _HEATMAP_MEAN in selection:
+        oml_plot_heatmap(data, title, 'mean')
 
     # Clock verification
     if _TIME in selection:
         common.oml_plot_clock(data)
 
-    common.plot_show()
+    return common.new_figures(fignums)
 
 
 def list_channels(data):
     """ List radio channels used in data """
-    channels = list(set(data['channel']))
-    return sorted(channels)
+    return numpy.unique(data['channel']).tolist()
+
+
+def group_channels(data):
+    """ Split data by channel in one pass
+
+    Measures are stably sorted by channel, so keep their time order.
+    Returns views on 'data' when already sorted by channel.
+    :returns: OrderedDict {channel: data}, sorted by channel """
+    channel = data['channel']
+    if numpy.any(channel[1:] < channel[:-1]):
+        order = numpy.argsort(channel, kind='mergesort')
+        data, channel = data[order], channel[order]
+    starts = numpy.flatnonzero(channel[1:] != channel[:-1]) + 1
+    groups = numpy.split(data, starts) if len(data) else []
+    return OrderedDict((int(group['channel'][0]), group) for group in groups)
 
 
 def with_channel(data, channel):
-    """ Extract data where measured channel == `channel` """
-    select = data['channel'] == channel
+    """ Extract data where measured channel == `channel`
+
+    Returns a view, not a copy, when the channel measures are contiguous """
+    select = numpy.flatnonzero(data['channel'] == channel)
+    if len(select) and select[-1] - select[0] + 1 == len(select):
+        return data[select[0]:select[-1] + 1]
     return data[select]
 
 
-def oml_plot_rssi(data, title, separated=False):
+def rolling_channels(data, window, stat='mean'):
+    """ RSSI rolling 'stat' on each channel measures windows
+    :param window: common.rolling_arg (size, seconds) value
+    :returns: new array, in 'data' order """
+    order = numpy.argsort(data['channel'], kind='mergesort')
+    groups = group_channels(data[order]).values() or [data]
+    rolled = numpy.concatenate([
+        common.rolling_apply(group, ['rssi'], window, stat)
+        for group in groups])
+    # Put back measures in their original rows
+    rolled[order] = rolled.copy()
+    return rolled
+
+
+def oml_plot_rssi(data, title,  # pylint:disable=too-many-arguments
+                  separated=False, gaps=None, channels=None):
     """ Plot rssi for all channels.
 
     :param data: numpy array returned by oml_read
     :param title: Subplots title base
     :param separated: plots separated on different windows
+    :param gaps: sequence number gaps to shade, from all channels measures
+    :param channels: 'group_channels' of data, computed if None
     """
+    import matplotlib.pyplot as plt
 
-    channels = list_channels(data)
+    if channels is None:
+        channels = group_channels(data)
     nbplots = len(channels)
     meas = MEASURES_D['rssi']
 
@@ -139,9 +285,7 @@ def oml_plot_rssi(data, title, separated=False):
     if not separated:
         plt.figure()
 
-    for num, channel in enumerate(channels, start=1):
-        # Select data for channel
-        cdata = with_channel(data, channel)
+    for num, (channel, cdata) in enumerate(channels.items(), start=1):
         _title = '%s Channel %s' % (title, channel)
 
         # One window per plot
@@ -149,17 +293,243 @@ def oml_plot_rssi(data, title, separated=False):
             plt.figure()
 
         plt.subplot(nbplots, 1, num)
-        common.plot(cdata, _title, meas.name, meas.label)
+        common.plot(cdata, _title, meas.name, meas.label, gaps=gaps)
+
+
+def rssi_heatmap(data, buckets, aggregate='max'):
+    """ Aggregate RSSI in a channels x time buckets array
+
+    :param buckets: number of time buckets
+    :param aggregate: 'max' or 'mean' of measures in each bin
+    :returns: (channels, time buckets edges, values),
+        values are NaN for bins without measures
+    """
+    channels = numpy.unique(data['channel'])
+    values = numpy.full(len(channels) * buckets, numpy.nan)
+    if not len(data):
+        return channels, numpy.zeros(buckets + 1), values.reshape(0, buckets)
+
+    time = data['timestamp']
+    edges = numpy.linspace(time.min(), time.max(), buckets + 1)
+
+    # Flat bin index for each measure
+    span = (edges[-1] - edges[0]) or 1.0
+    tbin = ((time - edges[0]) * (buckets / span)).astype(numpy.int64)
+    tbin = numpy.minimum(tbin, buckets - 1)
+    flat = numpy.searchsorted(channels, data['channel']) * buckets + tbin
+    rssi = data['rssi'].astype(float)
+
+    if aggregate == 'mean':
+        counts = numpy.bincount(flat, minlength=values.size)
+        sums = numpy.bincount(flat, weights=rssi, minlength=values.size)
+        used = counts > 0
+        values[used] = sums[used] / counts[used]
+    else:
+        order = numpy.argsort(flat, kind='mergesort')
+        flat = flat[order]
+        starts = numpy.flatnonzero(numpy.r_[True, flat[1:] != flat[:-1]])
+        values[flat[starts]] = numpy.maximum.reduceat(rssi[order], starts)
+
+    return channels, edges, values.reshape(len(channels), buckets)
+
+
+def oml_plot_heatmap(data, title, aggregate='max'):
+    """ Plot RSSI as a channels x time image
+
+    Time is binned to the figure width, so rendering does not depend on
+    the number of measures.
+    :param aggregate: 'max' or 'mean' of measures in each bin
+    """
+    import matplotlib.pyplot as plt
+
+    plt.figure()
+    channels, edges, values = rssi_heatmap(data, common.figure_width(),
+                                           aggregate)
+    extent = [edges[0], edges[-1], len(channels) - 0.5, -0.5]
+    plt.imshow(numpy.ma.masked_invalid(values), aspect='auto',
+               interpolation='nearest', extent=extent)
+    plt.colorbar().set_label('%s %s' % (aggregate, MEASURES_D['rssi'].label))
+    plt.yticks(range(len(channels)), channels)
+    plt.title('%s RSSI heatmap' % title)
+    plt.xlabel(common.TIMESTAMP_LABEL)
+    plt.ylabel(MEASURES_D['channel'].label)
+
+
+def oml_channel_stats(filename, threshold=BUSY_THRESHOLD,
+                      chunk_rows=common.OML_CHUNK_ROWS):
+    """ Channels RSSI statistics of radio oml file, computed by chunks
+    :returns: ChannelStats """
+    stats = ChannelStats(threshold)
+    for chunk in common.iter_oml_chunks(filename, 'radio', MEASURES_D.values(),
+                                        chunk_rows):
+        stats.update(chunk)
+    return stats
+
+
+class ChannelStats(object):
+    """ Per channel RSSI statistics
+
+    Updated incrementally with consecutive measures chunks. RSSI are
+    accumulated in one bin per dBm histograms, from which percentiles are
+    exact. Busy periods are runs of consecutive measures above 'threshold',
+    from the first to the last busy measure timestamps.
+    Busy fraction is the time fraction of intervals between consecutive
+    measures starting with a measure above 'threshold'. """
+
+    def __init__(self, threshold=BUSY_THRESHOLD):
+        self.threshold = threshold
+        self.histograms = {}
+        self.busy = {}
+        # channel: [duration, busy duration]
+        self.durations = {}
+        self._running = {}
+        self._last = {}
+
+    def update(self, data):
+        """ Update statistics with 'data' measures """
+        for channel, cdata in group_channels(data).items():
+            rssi = cdata['rssi'].astype(numpy.int64) - RSSI_MIN
+            rssi = numpy.clip(rssi, 0, RSSI_BINS - 1)
+            hist = self.histograms.setdefault(
+                channel, numpy.zeros(RSSI_BINS, dtype=numpy.int64))
+            hist += numpy.bincount(rssi, minlength=RSSI_BINS)
+            above = cdata['rssi'] > self.threshold
+            self._update_busy(channel, cdata['timestamp'], above)
+            self._update_durations(channel, cdata['timestamp'], above)
+
+    def _update_durations(self, channel, time, above):
+        """ Add intervals durations, continuing from previous chunk """
+        last = self._last.get(channel)
+        if last is not None:
+            time, above = numpy.r_[last[0], time], numpy.r_[last[1], above]
+        self._last[channel] = (time[-1], above[-1])
+        delta = numpy.diff(time)
+        durations = self.durations.setdefault(channel, [0.0, 0.0])
+        durations[0] += float(delta.sum())
+        durations[1] += float(delta[above[:-1]].sum())
+
+    def _update_busy(self, channel, time, above):
+        """ Add busy periods, a period may continue from previous chunk """
+        edges = numpy.diff(numpy.r_[0, above.astype(numpy.int8), 0])
+        starts = numpy.flatnonzero(edges == 1)
+        ends = numpy.flatnonzero(edges == -1) - 1
+        periods = zip(time[starts], time[ends])
+
+        running = self._running.pop(channel, None)
+        if running is not None:
+            if len(starts) and starts[0] == 0:
+                periods[0] = (running[0], periods[0][1])
+            else:
+                periods.insert(0, running)
+        # Last period may continue in next chunk
+        if len(ends) and ends[-1] == len(time) - 1:
+            self._running[channel] = periods.pop()
+        self.busy.setdefault(channel, []).extend(periods)
+
+    def periods(self, channel):
+        """ Busy periods (start, end) timestamps of 'channel' """
+        running = self._running.get(channel)
+        return self.busy.get(channel, []) + ([running] if running else [])
+
+    def report(self, percentiles=STATS_PERCENTILES):
+        """ Statistics report, json serializable dict of channels stats """
+        return dict((str(channel), self._channel_report(channel, percentiles))
+                    for channel in sorted(self.histograms))
+
+    def _channel_report(self, channel, percentiles):
+        """ Report for 'channel' """
+        hist = self.histograms[channel]
+        values = numpy.arange(RSSI_MIN, RSSI_MIN + RSSI_BINS)
+        count = int(hist.sum())
+        used = numpy.flatnonzero(hist)
+        cumsum = numpy.cumsum(hist)
+        ranks = numpy.maximum(1, numpy.ceil(
+            numpy.array(percentiles, dtype=float) * count / 100))
+        periods = numpy.array(self.periods(channel), dtype=float)
+        durations = numpy.diff(periods.reshape(-1, 2)).ravel()
+        duration, busy = self.durations[channel]
+        if duration > 0:
+            busy_fraction = busy / duration
+        else:
+            # Measures at the same time
+            busy_fraction = float(hist[values > self.threshold].sum()) / count
+
+        return {
+            'count': count,
+            'min': int(values[used[0]]),
+            'max': int(values[used[-1]]),
+            'mean': float(numpy.dot(hist, values)) / count,
+            'percentiles': dict(
+                ('p%g' % perc, int(values[numpy.searchsorted(cumsum, rank)]))
+                for perc, rank in zip(percentiles, ranks)),
+            'histogram': dict((str(values[i]), int(hist[i])) for i in used),
+            'busy_fraction': busy_fraction,
+            'busy_periods': len(durations),
+            'busy_time': float(durations.sum()),
+            'busy_longest': float(durations.max()) if len(durations) else 0.0,
+        }
+
+
+def stats_print(report, fmt='json', out=None):
+    """ Print ChannelStats 'report' as 'json' or 'csv' to 'out' or stdout """
+    out = out or sys.stdout
+    if fmt == 'json':
+        json.dump(report, out, indent=2, sort_keys=True)
+        out.write('\n')
+        return
+
+    percentiles = report.values()[0]['percentiles'] if report else {}
+    fields = STATS_CSV_FIELDS + sorted(percentiles, key=lambda p: float(p[1:]))
+    writer = csv.DictWriter(out, fields, extrasaction='ignore')
+    writer.writeheader()
+    for channel in sorted(report, key=int):
+        row = dict(report[channel], channel=channel)
+        row.update(report[channel]['percentiles'])
+        writer.writerow(row)
+
+
+def _whole_file(opts):
+    """ No samples or time selection in 'opts' """
+    return (opts.begin == 0 and opts.end == -1 and
+            opts.start is None and opts.stop is None)
 
 
 def main():
     """ Main command """
     opts = PARSER.parse_args()
+    if opts.channel_stats and _whole_file(opts):
+        # Streamed, the file is not loaded
+        try:
+            stats = oml_channel_stats(opts.input, opts.busy_threshold)
+        except ValueError as err:
+            PARSER.error(str(err))
+        stats_print(stats.report(), opts.channel_stats)
+        return
+    try:
+        start, stop = common.oml_time_range(opts.input, opts.start, opts.stop)
+        data = oml_load(opts.input, opts.cache, start, stop)
+    except ValueError as err:
+        PARSER.error(str(err))
     # default to plot all
     selection = opts.plot or (_JOINED)
     # select samples
-    data = opts.data[opts.begin:opts.end]
-    radio_plot(data, opts.title, selection)
+    data = data[opts.begin:opts.end]
+    if opts.stats:
+        common.oml_print_clock(data)
+        return
+    if opts.time_report:
+        print json.dumps(common.clock_report(data), indent=2, sort_keys=True)
+        return
+    if opts.channel_stats:
+        stats = ChannelStats(opts.busy_threshold)
+        stats.update(data)
+        stats_print(stats.report(), opts.channel_stats)
+        return
+    if opts.rolling:
+        data = rolling_channels(data, opts.rolling, opts.rolling_stat)
+    if opts.output:
+        common.plot_headless()
+    radio_plot(data, opts.title, selection, opts.output, opts.gaps)
 
 
 if __name__ == "__main__":
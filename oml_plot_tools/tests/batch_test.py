@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+# This file is a part of IoT-LAB oml-plot-tools
+# Copyright (C) 2015 INRIA (Contact: admin@iot-lab.info)
+# Contributor(s) : see AUTHORS file
+#
+# This software is governed by the CeCILL license under French law
+# and abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# http://www.cecill.info.
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+
+# pylint:disable=missing-docstring
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+import mock
+
+from .common import test_file_path, utest_help_as_doc, utest_cache_dir
+from .. import batch
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        utest_cache_dir(self)
+        self.tmpdir = tempfile.mkdtemp()
+        self.examples = test_file_path('examples')
+        self.conso_file = test_file_path('examples', 'consumption.oml')
+        self.radio_file = test_file_path('examples', 'radio.oml')
+        mock.patch('oml_plot_tools.common.plot_headless').start()
+
+    def tearDown(self):
+        mock.patch.stopall()
+        shutil.rmtree(self.tmpdir)
+
+    def test_oml_files(self):
+        files = batch.oml_files([self.examples])
+        self.assertIn(self.conso_file, files)
+        self.assertIn(self.radio_file, files)
+        self.assertEqual(sorted(files), files)
+
+        pattern = os.path.join(self.examples, 'consumption*.oml')
+        self.assertEqual(
+            [self.conso_file,
+             test_file_path('examples', 'consumption_only_one.oml')],
+            batch.oml_files([pattern, self.conso_file]))
+
+        # Non existing files are kept, for error reporting
+        self.assertEqual(['/invalid/file'], batch.oml_files(['/invalid/file']))
+
+    def test_batch_summary(self):
+        files = [self.conso_file, '/invalid/file']
+        summaries = batch.batch_summary('consum', files, jobs=2)
+
+        self.assertEqual(self.conso_file, summaries[0]['file'])
+        self.assertEqual(batch.consum.oml_load(self.conso_file).size,
+                         summaries[0]['rows'])
+        self.assertEqual(['max', 'mean', 'min'],
+                         sorted(summaries[0]['current']))
+        self.assertIsNone(summaries[0]['power'])  # not measured
+        self.assertLessEqual(summaries[0]['start'], summaries[0]['end'])
+
+        self.assertEqual('/invalid/file', summaries[1]['file'])
+        self.assertIn('error', summaries[1])
+
+    def test_batch_render(self):
+        files = [self.conso_file, self.radio_file]
+        results = batch.batch_render('consum', files[:1], self.tmpdir, jobs=1)
+        output = os.path.join(self.tmpdir, 'consumption.png')
+        self.assertEqual([(self.conso_file, [output])], results)
+        self.assertTrue(os.path.exists(results[0][1][0]))
+
+        results = batch.batch_render('radio', files[1:], self.tmpdir, 'svg')
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir,
+                                                    'radio.svg')))
+
+        robot_file = test_file_path('examples', 'robot.oml')
+        results = batch.batch_render('traj', [robot_file], self.tmpdir)
+        self.assertEqual(2, len(results[0][1]))
+
+        results = batch.batch_render('consum', ['/invalid/file'], self.tmpdir)
+        self.assertIn('Error', results[0][1])
+
+    def test_batch_render_errors(self):
+        files = [self.conso_file,
+                 test_file_path('examples', 'consumption_only_one.oml')]
+
+        # Plotting errors are reported per file
+        with mock.patch('oml_plot_tools.common.plot_save') as plot_save:
+            plot_save.side_effect = [IOError('Permission denied'), ['out']]
+            results = batch.batch_render('consum', files, self.tmpdir,
+                                         jobs=1)
+        self.assertEqual([(self.conso_file, 'Permission denied'),
+                          (files[1], ['out'])], results)
+
+        results = batch.batch_render('consum', files[:1], '/invalid/dir')
+        self.assertEqual(self.conso_file, results[0][0])
+        self.assertIsInstance(results[0][1], str)
+
+    def test_output_names(self):
+        self.assertEqual(['x', 'y'], batch.output_names(['a/x.oml',
+                                                         'b/y.oml']))
+        self.assertEqual(['a_x', 'b_c_x', 'y'], batch.output_names(
+            ['/d/a/x.oml', '/d/b/c/x.oml', '/d/y.oml']))
+
+        # Same file names are rendered to different files
+        conso_dir = os.path.join(self.tmpdir, 'conso')
+        os.mkdir(conso_dir)
+        conso_file = os.path.join(conso_dir, 'consumption.oml')
+        shutil.copy(self.conso_file, conso_file)
+        results = batch.batch_render('consum', [self.conso_file, conso_file],
+                                     self.tmpdir, jobs=1)
+        self.assertNotEqual(results[0][1], results[1][1])
+
+    def batch_main(self, *args):
+        with mock.patch('sys.argv', ['plot_oml_batch'] + list(args)):
+            batch.main()
+
+    def test_main_summary(self):
+        with mock.patch('sys.stdout', StringIO()) as stdout:
+            self.batch_main('-s', '-j', '1', self.conso_file)
+        self.assertEqual(self.conso_file,
+                         json.loads(stdout.getvalue())[0]['file'])
+
+        with mock.patch('sys.stdout', StringIO()):
+            self.assertRaises(SystemExit, self.batch_main, '-s',
+                              '/invalid/file')
+
+    def test_main_render(self):
+        with mock.patch('sys.stdout', StringIO()) as stdout:
+            self.batch_main('-d', self.tmpdir, '-k', 'radio', self.radio_file)
+        self.assertIn('radio.png', stdout.getvalue())
+
+        with mock.patch('sys.stderr', StringIO()) as stderr:
+            self.assertRaises(SystemExit, self.batch_main, '/invalid/file')
+        self.assertIn('/invalid/file', stderr.getvalue())
+
+    def test_jobs_arg(self):
+        self.assertEqual(4, batch.jobs_arg('4'))
+        self.assertRaises(batch.argparse.ArgumentTypeError,
+                          batch.jobs_arg, '0')
+
+
+class TestDoc(unittest.TestCase):
+    def test_doc(self):
+        utest_help_as_doc(self, batch)
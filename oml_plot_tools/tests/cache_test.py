@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+# This file is a part of IoT-LAB oml-plot-tools
+# Copyright (C) 2015 INRIA (Contact: admin@iot-lab.info)
+# Contributor(s) : see AUTHORS file
+#
+# This software is governed by the CeCILL license under French law
+# and abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# http://www.cecill.info.
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+import numpy
+
+from .common import test_file_path
+from .. import cache, consum
+
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        mock.patch('oml_plot_tools.cache.CACHE_DIR', self.cache_dir).start()
+        self.conso_file = test_file_path('examples', 'consumption.oml')
+
+    def tearDown(self):
+        mock.patch.stopall()
+        shutil.rmtree(self.cache_dir)
+
+    def test_key(self):
+        key = cache.key(self.conso_file, 'consumption')
+        self.assertEqual(key, cache.key(self.conso_file, 'consumption'))
+        self.assertNotEqual(key, cache.key(self.conso_file, 'radio'))
+
+        # File modification invalidates key
+        stat = os.stat(self.conso_file)
+        with mock.patch('os.stat') as stat_mock:
+            stat_mock.return_value = os.stat_result(
+                stat[:8] + (stat.st_mtime + 1, stat.st_ctime))
+            self.assertNotEqual(key, cache.key(self.conso_file,
+                                               'consumption'))
+
+    def test_store_load(self):
+        data = numpy.arange(10)
+        self.assertIsNone(cache.load('key'))
+
+        ret = cache.store('key', [data[:4], data[4:]])
+        self.assertTrue(isinstance(ret, numpy.memmap))
+        self.assertEqual(data.tolist(), ret.tolist())
+        ret = cache.load('key')
+        self.assertTrue(isinstance(ret, numpy.memmap))
+        self.assertEqual(data.tolist(), ret.tolist())
+
+        # Nothing to store
+        self.assertIsNone(cache.store('empty', []))
+
+        # Invalid cache dir
+        with mock.patch('oml_plot_tools.cache.CACHE_DIR', '/dev/null/cache'):
+            self.assertIsNone(cache.store('key', [data]))
+            self.assertIsNone(cache.load('key'))
+        self.assertEqual(['key.npy'], os.listdir(self.cache_dir))
+
+    def test_store_chunks_error(self):
+        def chunks():
+            yield numpy.arange(10)
+            raise ValueError('Invalid chunk')
+
+        self.assertRaises(ValueError, cache.store, 'key', chunks())
+        self.assertEqual([], os.listdir(self.cache_dir))
+
+        # Wrong measures type file
+        radio_file = test_file_path('examples', 'radio.oml')
+        self.assertRaises((TypeError, ValueError), consum.oml_load,
+                          radio_file)
+        self.assertEqual([], os.listdir(self.cache_dir))
+
+    def test_save(self):
+        path = os.path.join(self.cache_dir, 'data.npy')
+        data = consum.oml_load(self.conso_file, cache.BYPASS)
+
+        rows = cache.save(path, [data[:1000], data[1000:3000], data[3000:]])
+        self.assertEqual(len(data), rows)
+        ret = numpy.load(path, mmap_mode='r')
+        self.assertEqual(data.dtype, ret.dtype)
+        self.assertEqual(repr(data.tolist()), repr(ret.tolist()))
+
+        # Same result as numpy.save
+        numpy.save(path, data[:10])
+        cache.save(path, [data[:10]])
+        self.assertEqual(repr(numpy.load(path).tolist()),
+                         repr(data[:10].tolist()))
+
+    def test_evict(self):
+        data = numpy.zeros(1000)
+        for num in range(4):
+            cache.store('key%d' % num, [data])
+            os.utime(os.path.join(self.cache_dir, 'key%d.npy' % num),
+                     (num, num))
+        # Mark key0 as recently used
+        cache.load('key0')
+
+        size = os.path.getsize(os.path.join(self.cache_dir, 'key0.npy'))
+        cache.evict(2 * size)
+        self.assertEqual(['key0.npy', 'key3.npy'],
+                         sorted(os.listdir(self.cache_dir)))
+
+        # Invalid cache dir
+        with mock.patch('oml_plot_tools.cache.CACHE_DIR', '/dev/null/cache'):
+            cache.evict(0)
+
+    def test_evict_big_entry(self):
+        data = numpy.zeros(1000)
+        cache.store('key0', [data])
+        # New entry bigger than cache size is kept, others are evicted
+        with mock.patch('oml_plot_tools.cache.CACHE_MAX_SIZE', 1000):
+            ret = cache.store('key1', [data])
+        self.assertEqual(data.tolist(), ret.tolist())
+        self.assertEqual(['key1.npy'], os.listdir(self.cache_dir))
+        self.assertIsNotNone(cache.load('key1'))
+
+    def test_oml_load(self):
+        data = consum.oml_load(self.conso_file, cache.BYPASS)
+        self.assertFalse(isinstance(data, numpy.memmap))
+        self.assertEqual([], os.listdir(self.cache_dir))
+
+        # Stored and loaded from cache
+        with mock.patch('oml_plot_tools.common.iter_oml_chunks') as chunks:
+            chunks.return_value = [data[:10], data[10:]]
+            ret = consum.oml_load(self.conso_file)
+            ret_cached = consum.oml_load(self.conso_file)
+            self.assertEqual(1, chunks.call_count)
+
+            # rebuild
+            consum.oml_load(self.conso_file, cache.REBUILD)
+            self.assertEqual(2, chunks.call_count)
+
+        self.assertTrue(isinstance(ret, numpy.memmap))
+        self.assertEqual(repr(data.tolist()), repr(ret.tolist()))
+        self.assertEqual(repr(data.tolist()), repr(ret_cached.tolist()))
+        self.assertEqual(1, len(os.listdir(self.cache_dir)))
+
+        # Cache not writable
+        with mock.patch('oml_plot_tools.cache.CACHE_DIR', '/dev/null/cache'):
+            ret = consum.oml_load(self.conso_file)
+        self.assertFalse(isinstance(ret, numpy.memmap))
+        self.assertEqual(repr(data.tolist()), repr(ret.tolist()))
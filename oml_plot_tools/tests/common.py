@@ -25,12 +25,16 @@
 import os
 import math
 import runpy
+import shutil
+import tempfile
 from cStringIO import StringIO
 
 import mock
 import matplotlib.pyplot as plt
 from PIL import Image
 
+from .. import cache
+
 TEST_DIR = os.path.dirname(__file__)
 
 
@@ -39,6 +43,16 @@ def test_file_path(*args):
     return os.path.join(TEST_DIR, *args)
 
 
+def utest_cache_dir(testcase):
+    """ Use a temporary cache directory during 'testcase' test
+    :returns: cache directory """
+    cache_dir = tempfile.mkdtemp()
+    testcase.addCleanup(shutil.rmtree, cache_dir)
+    testcase.addCleanup(setattr, cache, 'CACHE_DIR', cache.CACHE_DIR)
+    cache.CACHE_DIR = cache_dir
+    return cache_dir
+
+
 def help_main_and_doc(module, help_opt='--help'):
     """ Check that help message is module docstring """
 
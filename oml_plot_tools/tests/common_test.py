@@ -22,20 +22,42 @@
 
 # pylint:disable=missing-docstring
 
+import os
+import json
 import unittest
+import tempfile
 from cStringIO import StringIO
 
 # Issues with pylint and numpy
 # pylint:disable=no-member
+import mock
 import numpy
+import matplotlib.pyplot as plt
 
+from oml_plot_tools import cache
 from oml_plot_tools import common
 from oml_plot_tools import consum
+from oml_plot_tools import radio
+from oml_plot_tools.tests.common import test_file_path, utest_cache_dir
 
 
 MEASURE_FMT = ('{t} {type} {num} {t_s} {t_us} {measures}\n')
 HEADER = 'HEADER\n' * common.OML_HEADER_LEN
 CONSO_T = common.OML_TYPES['consumption']
+SCHEMA_HEADER = (
+    'protocol: 4\n'
+    'domain: 10328\n'
+    'start-time: 1440424717\n'
+    'sender-id: m3-1\n'
+    'app-name: control_node_measures\n'
+    'schema: 0 _experiment_metadata subject:string key:string value:string\n'
+    'schema: 1 control_node_measures_consumption timestamp_s:uint32 '
+    'timestamp_us:uint32 power:double voltage:double current:double\n'
+    'schema: 2 control_node_measures_radio timestamp_s:uint32 '
+    'timestamp_us:uint32 channel:uint32 rssi:int32\n'
+    'content: text\n'
+    '\n'
+)
 
 
 class TestCommon(unittest.TestCase):
@@ -96,3 +118,618 @@ class TestCommon(unittest.TestCase):
         self.assertRaises(ValueError, common.oml_load,
                           StringIO(content), 'consumption',
                           consum.MEASURES_D.values())
+
+    def test_timestamp_ns(self):
+        meas = '1. 2. 3.'
+        content = HEADER
+        content += MEASURE_FMT.format(t=0.1234, type=CONSO_T, num=1,
+                                      t_s=1440424734, t_us=484120,
+                                      measures=meas)
+        content += MEASURE_FMT.format(t=1.1234, type=CONSO_T, num=2,
+                                      t_s=1440424751, t_us=1,
+                                      measures=meas)
+        data = common.oml_load(StringIO(content), 'consumption',
+                               consum.MEASURES_D.values())
+
+        ret = common.timestamp_ns(data)
+        self.assertEqual([1440424734484120000, 1440424751000001000],
+                         ret.tolist())
+        self.assertEqual(numpy.int64, ret.dtype)
+
+    def test_oml_parse_chunks(self):
+        meas = '1. 2. 3.'
+        content = ''
+        for num in range(1, 6):
+            content += MEASURE_FMT.format(t=0.1234, type=CONSO_T, num=num,
+                                          t_s=12345, t_us=678900,
+                                          measures=meas)
+        # pylint:disable=protected-access
+        layout = common._oml_layout(common.OmlHeader({}, {}), 'consumption',
+                                    consum.MEASURES_D.values())
+        chunks = list(common._oml_parse(StringIO(content), 'consumption',
+                                        *layout, chunk_rows=2))
+        self.assertEqual([2, 2, 1], [len(chunk) for chunk in chunks])
+        self.assertEqual(list(range(1, 6)),
+                         numpy.concatenate(chunks)['num'].tolist())
+
+    def test_oml_load_invalid_lines(self):
+        meas = '1. 2. 3.'
+        content = HEADER
+        content += MEASURE_FMT.format(t=0.1234, type=CONSO_T, num=1,
+                                      t_s=12345, t_us=678900, measures=meas)
+        content += '\n'
+        content += MEASURE_FMT.format(t=0.1234, type=CONSO_T, num=2,
+                                      t_s=12345, t_us=678900, measures='1.')
+        content += MEASURE_FMT.format(t=1.1234, type=CONSO_T, num=3,
+                                      t_s=12346, t_us=678900, measures=meas)
+
+        ret = common.oml_load(StringIO(content), 'consumption',
+                              consum.MEASURES_D.values())
+        self.assertEqual([1, 3], ret['num'].tolist())
+
+        # Truncated and too long lines with the expected total values
+        content = HEADER
+        for num, measures in enumerate(['1. 2. 3.', '1. 2.', '1. 2. 3. 4.',
+                                        '1. 2. 3.'], 1):
+            content += MEASURE_FMT.format(t=0.1234, type=CONSO_T, num=num,
+                                          t_s=12345, t_us=678900,
+                                          measures=measures)
+        ret = common.oml_load(StringIO(content.rstrip('\n')), 'consumption',
+                              consum.MEASURES_D.values())
+        self.assertEqual([1, 4], ret['num'].tolist())
+        self.assertEqual([3.0, 3.0], ret['current'].tolist())
+
+        # invalid value
+        content += MEASURE_FMT.format(t=1.1234, type=CONSO_T, num=4,
+                                      t_s=12346, t_us=678900,
+                                      measures='1. 2. abc')
+        self.assertRaises(ValueError, common.oml_load,
+                          StringIO(content), 'consumption',
+                          consum.MEASURES_D.values())
+
+
+class TestOmlSchema(unittest.TestCase):
+
+    def setUp(self):
+        utest_cache_dir(self)
+
+    def test_oml_header(self):
+        header = common.oml_header(test_file_path('examples', 'radio.oml'))
+
+        self.assertEqual('1418998468', header.metadata['start-time'])
+        self.assertEqual('m3-8', header.metadata['sender-id'])
+        self.assertEqual([('timestamp_s', 'uint32'),
+                          ('timestamp_us', 'uint32'),
+                          ('channel', 'uint32'), ('rssi', 'int32')],
+                         header.schemas[2])
+
+        self.assertRaises(ValueError, common.oml_header, StringIO('1 2 3'))
+        self.assertRaises(ValueError, common.oml_header, '/invalid/path')
+
+    def test_oml_load_schema_dtypes(self):
+        radio_file = test_file_path('examples', 'radio.oml')
+        data = common.oml_load(radio_file, 'radio',
+                               radio.MEASURES_D.values())
+
+        self.assertEqual(numpy.uint32, data.dtype['t_s'])
+        self.assertEqual(numpy.uint32, data.dtype['channel'])
+        self.assertEqual(numpy.int32, data.dtype['rssi'])
+        self.assertEqual(33, data.dtype.itemsize)
+        self.assertEqual((22, -91), (data['channel'][0], data['rssi'][0]))
+
+    def test_oml_load_schema_fields(self):
+        content = SCHEMA_HEADER
+        content += MEASURE_FMT.format(t=0.1234, type=CONSO_T, num=1,
+                                      t_s=12345, t_us=678900,
+                                      measures='1. 2. 3.')
+
+        # All fields
+        ret = common.oml_load(StringIO(content), 'consumption')
+        self.assertEqual(('timestamp', 'type', 'num', 't_s', 't_us',
+                          'power', 'voltage', 'current'), ret.dtype.names)
+
+        # Only some, in any order
+        measures = [consum.MEASURES_D['current'], consum.MEASURES_D['power']]
+        ret = common.oml_load(StringIO(content), 'consumption', measures)
+        self.assertEqual([(12345.6789, 'consumption', 1, 12345, 678900,
+                           3., 1.)], ret.tolist())
+
+        # Not in schema
+        self.assertRaises(ValueError, common.oml_load, StringIO(content),
+                          'consumption', radio.MEASURES_D.values())
+
+        # No schema and no measures
+        self.assertRaises(ValueError, common.oml_load, StringIO(HEADER),
+                          'consumption')
+
+
+class TestOmlChunks(unittest.TestCase):
+
+    def setUp(self):
+        utest_cache_dir(self)
+        self.conso_file = test_file_path('examples', 'consumption.oml')
+        self.data = consum.oml_load(self.conso_file)
+
+    def test_iter_oml_chunks(self):
+        chunks = list(common.iter_oml_chunks(self.conso_file, 'consumption',
+                                             consum.MEASURES_D.values(),
+                                             chunk_rows=1000))
+        self.assertEqual([1000, 1000, 1000, 1000, 170],
+                         [len(chunk) for chunk in chunks])
+        # compare repr as 'nan' != 'nan'
+        self.assertEqual(repr(self.data.tolist()),
+                         repr(numpy.concatenate(chunks).tolist()))
+
+        # Errors are raised as ValueError
+        chunks = common.iter_oml_chunks('/invalid/path', 'consumption')
+        self.assertRaises(ValueError, list, chunks)
+
+    def test_oml_convert(self):
+        npy_file = tempfile.mktemp(suffix='.npy')
+        try:
+            rows = common.oml_convert(self.conso_file, npy_file,
+                                      'consumption',
+                                      consum.MEASURES_D.values(),
+                                      chunk_rows=1000)
+            data = numpy.load(npy_file, mmap_mode='r')
+        finally:
+            os.remove(npy_file)
+
+        self.assertEqual(len(self.data), rows)
+        self.assertEqual(repr(self.data.tolist()), repr(data.tolist()))
+
+    def test_oml_clock_stats(self):
+        stats = common.oml_clock_stats(self.conso_file, 'consumption',
+                                       chunk_rows=1000)
+        time = self.data['timestamp']
+        clock_diff = numpy.diff(time) * 1000
+
+        self.assertEqual(len(time), stats.count)
+        self.assertEqual((time[0], time[-1]), (stats.start, stats.end))
+        self.assertAlmostEqual(time[-1] - time[0], stats.duration)
+        self.assertAlmostEqual(numpy.mean(clock_diff), stats.mean)
+        self.assertAlmostEqual(numpy.std(clock_diff), stats.std)
+        self.assertEqual(numpy.min(clock_diff), stats.min)
+        self.assertEqual(numpy.max(clock_diff), stats.max)
+
+    def test_oml_print_clock(self):
+        data = numpy.zeros(3, dtype=[('timestamp', float)])
+        data['timestamp'] = [1.0, 1.5, 2.0]
+        with mock.patch('sys.stdout', StringIO()) as stdout:
+            self.assertEqual(3, common.oml_print_clock(data).count)
+        self.assertIn('Time from 1.000000 to 2.000000', stdout.getvalue())
+
+        # No values
+        with mock.patch('sys.stdout', StringIO()) as stdout:
+            self.assertEqual(0, common.oml_print_clock(data[:0]).count)
+        self.assertEqual('No values\n', stdout.getvalue())
+
+    def test_clock_stats_small_chunks(self):
+        stats = common.ClockStats()
+        self.assertTrue(numpy.isnan(stats.std))
+
+        # Only one timestamp
+        stats.update(numpy.array([1.0]))
+        stats.update(numpy.array([]))
+        self.assertTrue(numpy.isnan(stats.mean))
+
+        stats.update(numpy.array([1.002]))
+        stats.update(numpy.array([1.003, 1.007]))
+        self.assertEqual(4, stats.count)
+        self.assertAlmostEqual(7.0 / 3, stats.mean)
+        self.assertAlmostEqual(1.0, stats.min)
+        self.assertAlmostEqual(4.0, stats.max)
+        self.assertAlmostEqual(numpy.std([2.0, 1.0, 4.0]), stats.std)
+
+
+class TestOmlTimeRange(unittest.TestCase):
+
+    def setUp(self):
+        utest_cache_dir(self)
+        self.conso_file = test_file_path('examples', 'consumption.oml')
+        self.data = consum.oml_load(self.conso_file, cache.BYPASS)
+        self.time = self.data['timestamp']
+
+    def test_oml_index(self):
+        index = common.oml_index(self.conso_file, step=1000,
+                                 cache_mode=cache.BYPASS)
+        # Stored then loaded from cache
+        self.assertEqual(index.tolist(), common.oml_index(
+            self.conso_file, step=1000, cache_mode=cache.REBUILD).tolist())
+        self.assertEqual(index.tolist(), common.oml_index(
+            self.conso_file, step=1000).tolist())
+        self.assertTrue(200 < len(index) < 300)
+
+        with open(self.conso_file) as oml_fd:
+            for timestamp, offset in index:
+                oml_fd.seek(offset)
+                num = int(oml_fd.readline().split()[2])
+                self.assertEqual(self.time[num - 1], timestamp)
+
+        # Invalid lines are not indexed
+        content = HEADER + 'invalid\n'
+        content += MEASURE_FMT.format(t=0.1234, type=CONSO_T, num=1,
+                                      t_s=12345, t_us=678900,
+                                      measures='1. 2. 3.')
+        index = common.oml_index(StringIO(content))
+        self.assertEqual([(12345.6789, len(HEADER) + len('invalid\n'))],
+                         index.tolist())
+
+    def test_oml_load_range(self):
+        start, stop = self.time[1000], self.time[3000]
+        expected = self.data[1000:3001]
+        ret = consum.oml_load(self.conso_file, cache.BYPASS, start, stop)
+        self.assertEqual(repr(expected.tolist()), repr(ret.tolist()))
+
+        # Only the part after the index entry before 'start' is parsed
+        index = common.oml_index(self.conso_file, step=4096,
+                                 cache_mode=cache.BYPASS)
+        with mock.patch('oml_plot_tools.common.oml_index') as oml_index:
+            oml_index.return_value = index
+            with mock.patch('oml_plot_tools.common._oml_parse_lines',
+                            wraps=common._oml_parse_lines) as parse:
+                ret = common.oml_load(self.conso_file, 'consumption',
+                                      cache_mode=cache.BYPASS, start=start,
+                                      stop=stop)
+                rows = sum(len(call[0][0]) for call in parse.call_args_list)
+        self.assertEqual(repr(expected.tolist()), repr(ret.tolist()))
+        self.assertTrue(len(self.data) - 1000 <= rows < len(self.data) - 900)
+
+        # Open ranges
+        ret = consum.oml_load(self.conso_file, cache.BYPASS, start=start)
+        self.assertEqual(len(self.data) - 1000, len(ret))
+        ret = consum.oml_load(self.conso_file, cache.BYPASS, stop=stop)
+        self.assertEqual(3001, len(ret))
+
+        self.assertRaises(ValueError, consum.oml_load, self.conso_file,
+                          cache.BYPASS, 0, 1)
+
+    def test_oml_load_range_file_object(self):
+        start, stop = self.time[1000], self.time[3000]
+        with open(self.conso_file) as oml_fd:
+            ret = common.oml_load(StringIO(oml_fd.read()), 'consumption',
+                                  consum.MEASURES_D.values(), start=start,
+                                  stop=stop)
+        self.assertEqual(repr(self.data[1000:3001].tolist()),
+                         repr(ret.tolist()))
+
+    def test_oml_load_range_cached(self):
+        start, stop = self.time[1000], self.time[3000]
+        consum.oml_load(self.conso_file)
+        with mock.patch('oml_plot_tools.common._oml_read_range') as read:
+            ret = consum.oml_load(self.conso_file, start=start, stop=stop)
+            self.assertFalse(read.called)
+        self.assertTrue(isinstance(ret, numpy.memmap))
+        self.assertEqual(repr(self.data[1000:3001].tolist()),
+                         repr(ret.tolist()))
+
+    def test_oml_time_range(self):
+        self.assertEqual((12.5, False), common.time_arg('12.5'))
+        self.assertEqual((1440424734.5, True),
+                         common.time_arg('@1440424734.5'))
+
+        ret = common.oml_time_range(self.conso_file,
+                                    common.time_arg('17.5'),
+                                    common.time_arg('@1440424800'))
+        self.assertEqual((1440424734.5, 1440424800.), ret)
+        self.assertEqual((None, None),
+                         common.oml_time_range(self.conso_file))
+
+        # No start-time in header
+        self.assertRaises(ValueError, common.oml_time_range,
+                          StringIO(HEADER), (1., False))
+
+
+class TestClockReport(unittest.TestCase):
+
+    def test_clock_report(self):
+        data = numpy.array([(0.0, 0), (0.1, 1), (0.2, 2), (0.2, 3),
+                            (0.1, 4), (0.5, 8), (0.6, 10)],
+                           dtype=[('timestamp', float), ('num', 'uint32')])
+        report = common.clock_report(data, percentiles=(0, 50, 100))
+
+        self.assertEqual(7, report['count'])
+        self.assertEqual(0.0, report['start'])
+        self.assertEqual(0.6, report['end'])
+        self.assertEqual(2, report['gaps'])
+        self.assertEqual(4, report['missing'])
+        self.assertEqual(1, report['duplicates'])
+        self.assertEqual(1, report['non_monotonic'])
+
+        delta = report['delta']
+        self.assertAlmostEqual(100, delta['mean'])
+        self.assertAlmostEqual(-100, delta['min'])
+        self.assertAlmostEqual(400, delta['max'])
+        self.assertAlmostEqual(delta['min'], delta['percentiles']['p0'])
+        self.assertAlmostEqual(100, delta['percentiles']['p50'])
+        self.assertAlmostEqual(delta['max'], delta['percentiles']['p100'])
+        json.dumps(report)
+
+    def test_clock_report_single_value(self):
+        data = numpy.array([(1.0, 0)],
+                           dtype=[('timestamp', float), ('num', 'uint32')])
+        report = common.clock_report(data)
+        self.assertEqual(1, report['count'])
+        self.assertEqual(0, report['gaps'])
+        self.assertIsNone(report['delta'])
+
+        report = common.clock_report(data[:0])
+        self.assertIsNone(report['start'])
+
+
+class TestOmlGaps(unittest.TestCase):
+
+    def setUp(self):
+        utest_cache_dir(self)
+        self.data = numpy.zeros(6, dtype=[('timestamp', float),
+                                          ('num', 'uint32'), ('value', int)])
+        self.data['timestamp'] = [0.0, 0.1, 0.2, 0.6, 0.7, 1.0]
+        self.data['num'] = [0, 1, 2, 6, 7, 9]
+
+    def test_oml_gaps(self):
+        gaps = common.oml_gaps(self.data)
+        self.assertEqual([3, 8], gaps['num_start'].tolist())
+        self.assertEqual([5, 8], gaps['num_end'].tolist())
+        self.assertEqual([0.2, 0.7], gaps['start'].tolist())
+        self.assertEqual([0.6, 1.0], gaps['end'].tolist())
+
+        self.assertEqual(0, len(common.oml_gaps(self.data[:3])))
+        self.assertEqual(0, len(common.oml_gaps(self.data[:0])))
+
+    def test_plot_gaps(self):
+        plt.figure()
+        gaps = common.oml_gaps(self.data)
+        common.plot(self.data, 'title', 'value', 'label', gaps=gaps)
+        bars, = plt.gca().collections
+        self.assertEqual(2, len(bars.get_paths()))
+        plt.close()
+
+        # No gaps
+        plt.figure()
+        common.plot(self.data, 'title', 'value', 'label', gaps=gaps[:0])
+        self.assertEqual([], plt.gca().collections)
+        plt.close()
+
+
+class TestCompressNan(unittest.TestCase):
+
+    def test_compress_nan(self):
+        nan = numpy.nan
+        x_values = numpy.arange(9)
+        y_values = numpy.array([nan, nan, 1, nan, nan, nan, 2, 3, nan])
+        x_ret, y_ret = common.compress_nan(x_values, y_values)
+        self.assertEqual([2, 3, 6, 7, 8], x_ret.tolist())
+        self.assertEqual('[1.0, nan, 2.0, 3.0, nan]', repr(y_ret.tolist()))
+
+        # Unchanged without nan
+        y_values = numpy.arange(9.0)
+        x_ret, y_ret = common.compress_nan(x_values, y_values)
+        self.assertIs(y_values, y_ret)
+
+        # All nan
+        x_ret, y_ret = common.compress_nan(x_values, numpy.full(9, nan))
+        self.assertEqual(0, len(x_ret))
+        self.assertEqual(0, len(y_ret))
+
+
+class TestRolling(unittest.TestCase):
+
+    def setUp(self):
+        utest_cache_dir(self)
+        nan = numpy.nan
+        self.values = numpy.array([1, 5, nan, 2, 8, 3, nan, nan, 4, 6])
+        self.time = numpy.array([0, 1, 2, 3, 4, 5, 6, 7, 8, 8.5])
+
+    def assert_rolling(self, window, func):
+        starts = common.rolling_starts(self.time, window)
+        for stat in common.ROLLING_STATS:
+            expected = []
+            for end, start in enumerate(starts, start=1):
+                values = self.values[start:end]
+                values = values[~numpy.isnan(values)]
+                expected.append(getattr(numpy, stat)(values)
+                                if len(values) else numpy.nan)
+            ret = common.rolling(self.values, starts, stat)
+            self.assertTrue(numpy.allclose(expected, ret, atol=1e-6,
+                                           equal_nan=True),
+                            (stat, expected, ret))
+        func(starts)
+
+    def test_rolling_samples(self):
+        def _starts(starts):
+            self.assertEqual([0, 0, 0, 1, 2, 3, 4, 5, 6, 7], starts.tolist())
+        self.assert_rolling((3, False), _starts)
+
+    def test_rolling_seconds(self):
+        def _starts(starts):
+            self.assertEqual([0, 0, 0, 1, 2, 3, 4, 5, 6, 7], starts.tolist())
+        self.assert_rolling((2.0, True), _starts)
+
+        def _starts_large(starts):
+            self.assertEqual([0] * 10, starts.tolist())
+        self.assert_rolling((100.0, True), _starts_large)
+
+    def test_rolling_empty(self):
+        starts = numpy.array([], dtype=int)
+        for stat in common.ROLLING_STATS:
+            self.assertEqual(0, len(common.rolling([], starts, stat)))
+
+    def test_rolling_apply(self):
+        data = numpy.zeros(10, dtype=[('timestamp', float), ('value', int),
+                                      ('num', int)])
+        data['timestamp'] = self.time
+        data['value'] = range(10)
+        data['num'] = range(10)
+        rolled = common.rolling_apply(data, ['value'], (2, False), 'mean')
+        self.assertEqual(float, rolled.dtype['value'])
+        self.assertEqual(data['num'].tolist(), rolled['num'].tolist())
+        self.assertEqual([0] + [i + 0.5 for i in range(9)],
+                         rolled['value'].tolist())
+
+    def test_duration_arg(self):
+        self.assertEqual(1.5, common.duration_arg('1.5'))
+        for value in ('0', '-1', 'inf', 'nan', 'abc'):
+            self.assertRaises(ValueError, common.duration_arg, value)
+
+    def test_rolling_arg(self):
+        self.assertEqual((10, False), common.rolling_arg('10'))
+        self.assertEqual((1.5, True), common.rolling_arg('1.5s'))
+        self.assertRaises(ValueError, common.rolling_arg, '0')
+        self.assertRaises(ValueError, common.rolling_arg, 'abc')
+
+
+class TestDecimate(unittest.TestCase):
+
+    def test_decimate(self):
+        x_values = numpy.arange(10000) / 10.
+        y_values = numpy.sin(x_values)
+        y_values[1234] = 100
+        y_values[5678] = -100
+
+        x_ret, y_ret = common.decimate(x_values, y_values, 100)
+        self.assertEqual(200, len(y_ret))
+        self.assertTrue(numpy.all(numpy.diff(x_ret) >= 0))
+        self.assertEqual((100, -100), (max(y_ret), min(y_ret)))
+        self.assertIn(123.4, x_ret)
+        self.assertIn(567.8, x_ret)
+
+        # Nothing to decimate
+        x_ret, y_ret = common.decimate(x_values[:200], y_values[:200], 100)
+        self.assertEqual(y_values[:200].tolist(), y_ret.tolist())
+
+    def test_decimate_nan(self):
+        y_values = numpy.arange(1000.)
+        y_values[:500] = numpy.nan
+        y_values[600] = numpy.nan
+
+        _, y_ret = common.decimate(numpy.arange(1000), y_values, 100)
+        self.assertTrue(numpy.all(numpy.isnan(y_ret[:100])))
+        self.assertFalse(numpy.any(numpy.isnan(y_ret[100:])))
+        self.assertEqual((500, 999), (y_ret[100], y_ret[-1]))
+
+    def test_plot_decimated(self):
+        data = numpy.zeros(100000, dtype=[('timestamp', float),
+                                          ('power', float)])
+        data['timestamp'] = numpy.arange(100000)
+        with mock.patch('matplotlib.pyplot.plot') as plot:
+            common.plot(data, 'title', 'power', 'Power')
+            x_values, _ = plot.call_args[0]
+        width = common.figure_width()
+        self.assertTrue(width < len(x_values) <= 2 * width)
+
+
+class TestPyramid(unittest.TestCase):
+
+    def setUp(self):
+        utest_cache_dir(self)
+        self.x_values = numpy.arange(1000) / 10.
+        self.y_values = numpy.sin(self.x_values)
+
+    def test_pyramid(self):
+        self.y_values[:10] = numpy.nan
+        levels = common.pyramid(self.x_values, self.y_values, factor=4)
+        self.assertEqual([1000, 250, 63, 16, 4, 1],
+                         [len(level.x) for level in levels])
+
+        level = levels[2]
+        self.assertEqual(self.x_values[16], level.x[1])
+        self.assertEqual(numpy.nanmin(self.y_values[16:32]), level.min[1])
+        self.assertEqual(numpy.nanmax(self.y_values[16:32]), level.max[1])
+        self.assertAlmostEqual(numpy.nanmean(self.y_values[16:32]),
+                               level.mean[1])
+        # NaN values ignored
+        self.assertEqual(6, level.count[0])
+        self.assertAlmostEqual(numpy.nanmean(self.y_values[:16]),
+                               level.mean[0])
+        self.assertEqual(numpy.nanmax(self.y_values), levels[-1].max[0])
+        self.assertAlmostEqual(numpy.nanmean(self.y_values),
+                               levels[-1].mean[0])
+
+    def test_pyramid_select(self):
+        levels = common.pyramid(self.x_values, self.y_values, factor=4)
+
+        # Raw values when zoomed
+        x_ret, y_ret = common.pyramid_select(levels, 10, 20, 100)
+        self.assertEqual(self.x_values[99:202].tolist(), x_ret.tolist())
+        self.assertEqual(self.y_values[99:202].tolist(), y_ret.tolist())
+
+        # Min/max of a level
+        x_ret, y_ret = common.pyramid_select(levels, 0, 100, 100)
+        self.assertEqual(numpy.repeat(levels[2].x, 2).tolist(),
+                         x_ret.tolist())
+        self.assertEqual(levels[2].max[0], y_ret[1])
+
+    def test_plot_zoom(self):
+        data = numpy.zeros(1000, dtype=[('timestamp', float),
+                                        ('power', float)])
+        data['timestamp'] = self.x_values
+        data['power'] = self.y_values
+
+        plt.figure()
+        common.plot(data, 'title', 'power', 'Power', zoom=True)
+        line = plt.gca().get_lines()[0]
+        self.assertEqual(1000, len(line.get_xdata()))
+
+        with mock.patch('oml_plot_tools.common.figure_width') as width:
+            width.return_value = 10
+            plt.xlim(0, 50)
+            self.assertEqual(2 * 9, len(line.get_xdata()))
+            plt.xlim(0, 1)
+            self.assertEqual(12, len(line.get_xdata()))
+        plt.close()
+
+
+class TestPlotSave(unittest.TestCase):
+
+    def setUp(self):
+        utest_cache_dir(self)
+        self.tmpdir = tempfile.mkdtemp()
+        plt.close('all')
+
+    def tearDown(self):
+        for name in os.listdir(self.tmpdir):
+            os.remove(os.path.join(self.tmpdir, name))
+        os.rmdir(self.tmpdir)
+
+    def test_plot_save(self):
+        output = os.path.join(self.tmpdir, 'plot.png')
+        fignums = plt.get_fignums()
+        plt.figure()
+        plt.plot([0, 1], [1, 0])
+        figures = common.new_figures(fignums)
+        self.assertEqual(1, len(figures))
+
+        self.assertEqual([output], common.plot_save(figures, output))
+        self.assertTrue(os.path.getsize(output))
+        self.assertEqual([], plt.get_fignums())
+
+    def test_plot_save_multiple(self):
+        output = os.path.join(self.tmpdir, 'plot.svg')
+        figures = [plt.figure(), plt.figure()]
+        files = common.plot_save(figures, output)
+        self.assertEqual([os.path.join(self.tmpdir, 'plot-1.svg'),
+                          os.path.join(self.tmpdir, 'plot-2.svg')], files)
+        self.assertEqual(sorted(['plot-1.svg', 'plot-2.svg']),
+                         sorted(os.listdir(self.tmpdir)))
+
+    def test_plot_save_layout(self):
+        output = os.path.join(self.tmpdir, 'plot.png')
+        fig = plt.figure()
+        with mock.patch.object(fig, 'tight_layout') as tight_layout:
+            common.plot_save([fig], output)
+        self.assertTrue(tight_layout.called)
+
+    @mock.patch('oml_plot_tools.common.plot_show')
+    def test_plot_output(self, plot_show):
+        output = os.path.join(self.tmpdir, 'plot.png')
+        common.plot_output([plt.figure()])
+        self.assertTrue(plot_show.called)
+        self.assertFalse(os.path.exists(output))
+
+        common.plot_output([plt.figure()], output)
+        self.assertTrue(os.path.exists(output))
+
+    @mock.patch('matplotlib.pyplot.switch_backend')
+    def test_plot_headless(self, switch_backend):
+        common.plot_headless()
+        switch_backend.assert_called_with('agg')
@@ -23,18 +23,25 @@
 # pylint:disable=missing-docstring
 # python2.6
 # pylint:disable=too-many-public-methods
+import os
+import sys
+import json
 import unittest
+import subprocess
+from cStringIO import StringIO
 
 import mock
+import numpy
 
-from .common import (test_file_path, utest_help_as_doc,
+from .common import (test_file_path, utest_help_as_doc, utest_cache_dir,
                      utest_plot_and_compare, assert_called_with_nparray)
-from .. import consum, common
+from .. import consum, common, cache
 
 
 class TestConsumptionOmlPlot(unittest.TestCase):
 
     def setUp(self):
+        utest_cache_dir(self)
         conso_file = test_file_path('examples', 'consumption.oml')
         self.data = consum.oml_load(conso_file)
         self.title = 'Node'
@@ -56,9 +63,96 @@ class TestConsumptionOmlPlot(unittest.TestCase):
         utest_plot_and_compare(self, ref_img, 50)
 
 
+class TestDerivePower(unittest.TestCase):
+
+    def setUp(self):
+        utest_cache_dir(self)
+        self.conso_file = test_file_path('examples', 'consumption.oml')
+
+    def test_derive_power(self):
+        data = consum.oml_load(self.conso_file)
+        self.assertTrue(numpy.isnan(data['power']).all())
+
+        derived = consum.oml_load(self.conso_file, derive=True)
+        self.assertEqual((data['voltage'] * data['current']).tolist(),
+                         derived['power'].tolist())
+        self.assertEqual(data['current'].tolist(),
+                         derived['current'].tolist())
+
+        # No copy without nan
+        self.assertIs(derived, consum.derive_power(derived))
+
+    def test_derive_power_energy(self):
+        stats = consum.oml_energy_stats(self.conso_file, derive=True)
+        full = consum.EnergyStats()
+        full.update(consum.oml_load(self.conso_file, derive=True))
+        self.assertEqual(full.report(), stats.report())
+        self.assertLess(0, stats.report()['energy'])
+
+
+class TestEnergyStats(unittest.TestCase):
+
+    def setUp(self):
+        utest_cache_dir(self)
+        self.data = numpy.zeros(6, dtype=[('timestamp', float),
+                                          ('power', float)])
+        self.data['timestamp'] = [10, 11, 12, 13, 14, 15]
+        self.data['power'] = [1, 1, numpy.nan, 2, 2, 4]
+
+    def test_energy(self):
+        stats = consum.EnergyStats()
+        stats.update(self.data)
+        report = stats.report()
+        self.assertEqual(6.0, report['energy'])
+        self.assertEqual(3.0, report['duration'])
+        self.assertEqual(6, report['count'])
+        self.assertEqual(2.0, report['mean_power'])
+        self.assertEqual(4.0, report['peak_power'])
+        self.assertEqual(1, len(report['windows']))
+        self.assertEqual(10, report['windows'][0]['start'])
+
+    def test_energy_windows(self):
+        stats = consum.EnergyStats(window=2)
+        stats.update(self.data)
+        windows = stats.report()['windows']
+        self.assertEqual([10, 12, 14], [w['start'] for w in windows])
+        self.assertEqual([1.0, 2.0, 3.0], [w['energy'] for w in windows])
+        self.assertEqual([1.0, 1.0, 1.0], [w['duration'] for w in windows])
+        self.assertEqual([2, 2, 2], [w['count'] for w in windows])
+        self.assertEqual([1.0, 2.0, 4.0], [w['peak_power'] for w in windows])
+
+    def test_energy_chunks(self):
+        full = consum.EnergyStats(window=2)
+        full.update(self.data)
+        stats = consum.EnergyStats(window=2)
+        for chunk in (self.data[:1], self.data[1:1], self.data[1:4],
+                      self.data[4:]):
+            stats.update(chunk)
+        self.assertEqual(full.report(), stats.report())
+
+    def test_energy_nan(self):
+        self.data['power'] = numpy.nan
+        stats = consum.EnergyStats()
+        stats.update(self.data)
+        report = stats.report()
+        self.assertEqual(0.0, report['energy'])
+        self.assertIsNone(report['mean_power'])
+        self.assertIsNone(report['peak_power'])
+
+        self.assertIsNone(consum.EnergyStats().report()['peak_power'])
+
+    def test_oml_energy_stats(self):
+        conso_file = test_file_path('examples', 'consumption.oml')
+        full = consum.EnergyStats(window=60)
+        full.update(consum.oml_load(conso_file))
+        stats = consum.oml_energy_stats(conso_file, 60, chunk_rows=100)
+        self.assertEqual(full.report(), stats.report())
+
+
 class TestConsumptionPlot(unittest.TestCase):
 
     def setUp(self):
+        utest_cache_dir(self)
         meas_file = test_file_path('examples', 'consumption.oml')
         self.data = consum.oml_load(meas_file)[0:1]
 
@@ -85,19 +179,22 @@ class TestConsumptionPlot(unittest.TestCase):
         assert_called_with_nparray(
             self.oml_plot,
             self.data, self.title,
-            [common.MeasureTuple('power', float, 'Power (W)')])
+            [common.MeasureTuple('power', float, 'Power (W)')],
+            zoom=False, gaps=None)
 
         self.consum_main('-v')
         assert_called_with_nparray(
             self.oml_plot,
             self.data, self.title,
-            [common.MeasureTuple('voltage', float, 'Voltage (V)')])
+            [common.MeasureTuple('voltage', float, 'Voltage (V)')],
+            zoom=False, gaps=None)
 
         self.consum_main('-c')
         assert_called_with_nparray(
             self.oml_plot,
             self.data, self.title,
-            [common.MeasureTuple('current', float, 'Current (A)')])
+            [common.MeasureTuple('current', float, 'Current (A)')],
+            zoom=False, gaps=None)
 
         # Plot only once per entry
         self.oml_plot.reset_mock()
@@ -111,7 +208,8 @@ class TestConsumptionPlot(unittest.TestCase):
             self.data, self.title,
             [common.MeasureTuple('power', float, 'Power (W)'),
              common.MeasureTuple('voltage', float, 'Voltage (V)'),
-             common.MeasureTuple('current', float, 'Current (A)')])
+             common.MeasureTuple('current', float, 'Current (A)')],
+            zoom=False, gaps=None)
 
     def test_plot_default_all(self):
         self.consum_main()
@@ -120,12 +218,107 @@ class TestConsumptionPlot(unittest.TestCase):
             self.data, self.title,
             [common.MeasureTuple('power', float, 'Power (W)'),
              common.MeasureTuple('voltage', float, 'Voltage (V)'),
-             common.MeasureTuple('current', float, 'Current (A)')])
+             common.MeasureTuple('current', float, 'Current (A)')],
+            zoom=False, gaps=None)
+
+    def test_plot_zoom(self):
+        self.consum_main('-p', '--zoom')
+        assert_called_with_nparray(
+            self.oml_plot,
+            self.data, self.title,
+            [common.MeasureTuple('power', float, 'Power (W)')],
+            zoom=True, gaps=None)
+
+    def test_plot_gaps(self):
+        self.consum_main('-p', '--gaps')
+        gaps = self.oml_plot.call_args[1]['gaps']
+        self.assertEqual(numpy.dtype(common.OML_GAP_DTYPE), gaps.dtype)
+
+    def test_plot_derive_power(self):
+        self.consum_main('-p', '--derive-power')
+        data = self.oml_plot.call_args[0][0]
+        self.assertFalse(numpy.isnan(data['power']).any())
+
+    def test_plot_rolling(self):
+        meas_file = test_file_path('examples', 'consumption.oml')
+        current = consum.oml_load(meas_file)['current'][:20]
+        self.args = [self.args[0], '-i', meas_file, '--end', '20']
+
+        self.consum_main('-c', '--rolling', '3', '--rolling-stat', 'max')
+        data = self.oml_plot.call_args[0][0]
+        self.assertEqual([current[max(i - 2, 0):i + 1].max()
+                          for i in range(len(current))],
+                         data['current'].tolist())
+
+        self.consum_main('-c', '--rolling', '3')
+        data = self.oml_plot.call_args[0][0]
+        numpy.testing.assert_allclose(
+            [current[max(i - 2, 0):i + 1].mean()
+             for i in range(len(current))], data['current'])
 
     def test_plot_time(self):
         self.consum_main('-t')
         assert_called_with_nparray(self.oml_plot_clock, self.data)
 
+    def test_plot_time_range(self):
+        data = consum.oml_load(test_file_path('examples', 'consumption.oml'))
+        self.consum_main('-t', '--start', '@%f' % data['timestamp'][10],
+                         '--stop', '3600')
+        assert_called_with_nparray(self.oml_plot_clock, data[10:11])
+
+        # Relative to header 'start-time'
+        self.consum_main('-t', '--start', '%f' % (data['timestamp'][10] -
+                                                  1440424717))
+        assert_called_with_nparray(self.oml_plot_clock, data[10:11])
+
+    @mock.patch('oml_plot_tools.common.plot_headless')
+    @mock.patch('oml_plot_tools.common.plot_save')
+    def test_plot_output(self, plot_save, plot_headless):
+        self.consum_main('-p', '-o', 'conso.png')
+        self.assertTrue(plot_headless.called)
+        self.assertEqual('conso.png', plot_save.call_args[0][1])
+
+    def test_time_report(self):
+        with mock.patch('sys.stdout', StringIO()) as stdout:
+            self.consum_main('--time-report')
+        report = json.loads(stdout.getvalue())
+        self.assertEqual(1, report['count'])
+
+    def test_energy(self):
+        with mock.patch('sys.stdout', StringIO()) as stdout:
+            self.consum_main('--energy', '--window', '10')
+        report = json.loads(stdout.getvalue())
+        self.assertEqual(1, report['count'])
+        self.assertEqual(1, len(report['windows']))
+        self.assertFalse(self.oml_plot.called)
+
+        with mock.patch('sys.stderr'):
+            for window in ('0', '-1', 'nan'):
+                self.assertRaises(SystemExit, self.consum_main,
+                                  '--energy', '--window', window)
+            # Only for energy report
+            self.assertRaises(SystemExit, self.consum_main, '--window', '10')
+
+    @mock.patch('oml_plot_tools.common.oml_print_clock')
+    def test_stats(self, oml_print_clock):
+        self.consum_main('--stats')
+        assert_called_with_nparray(oml_print_clock, self.data)
+        self.assertFalse(self.oml_plot.called)
+
+    def test_stats_no_matplotlib(self):
+        code = ("import sys; from oml_plot_tools import consum; consum.main();"
+                "assert 'matplotlib' not in sys.modules")
+        with open(os.devnull, 'w') as devnull:
+            env = dict(os.environ, OML_PLOT_TOOLS_CACHE_DIR=cache.CACHE_DIR)
+            subprocess.check_call([sys.executable, '-c', code] +
+                                  self.args[1:] + ['--stats'], stdout=devnull,
+                                  env=env)
+
+    def test_invalid_file(self):
+        self.args = [self.args[0], '-i', '/invalid/file/path']
+        with mock.patch('sys.stderr'):
+            self.assertRaises(SystemExit, self.consum_main, '--no-cache')
+
 
 class TestDoc(unittest.TestCase):
     def test_doc(self):
@@ -23,18 +23,23 @@
 # pylint:disable=missing-docstring
 # python2.6
 # pylint:disable=too-many-public-methods
+import json
 import unittest
+from cStringIO import StringIO
 
 import mock
+import numpy
+import matplotlib.pyplot as plt
 
-from .common import (test_file_path, utest_help_as_doc,
+from .common import (test_file_path, utest_help_as_doc, utest_cache_dir,
                      utest_plot_and_compare, assert_called_with_nparray)
-from .. import radio
+from .. import radio, common
 
 
 class TestRadioOmlPlot(unittest.TestCase):
 
     def setUp(self):
+        utest_cache_dir(self)
         radio_file = test_file_path('examples', 'radio.oml')
         self.data = radio.oml_load(radio_file)
         self.title = ''
@@ -56,9 +61,219 @@ class TestRadioOmlPlot(unittest.TestCase):
         utest_plot_and_compare(self, ref_img, 50)
 
 
+class TestRadioChannels(unittest.TestCase):
+
+    def setUp(self):
+        utest_cache_dir(self)
+        radio_file = test_file_path('examples', 'radio.oml')
+        self.data = radio.oml_load(radio_file)
+
+    def test_rolling_channels(self):
+        data = radio.rolling_channels(self.data, (2, False))
+        self.assertEqual(len(self.data), len(data))
+        for channel, cdata in radio.group_channels(data).items():
+            rssi = self.data[self.data['channel'] == channel]['rssi']
+            self.assertEqual(numpy.r_[rssi[0], (rssi[1:] + rssi[:-1]) / 2.0]
+                             .tolist(), cdata['rssi'].tolist())
+        # Measures stay in time order
+        self.assertEqual(self.data['timestamp'].tolist(),
+                         data['timestamp'].tolist())
+        self.assertEqual(self.data['channel'].tolist(),
+                         data['channel'].tolist())
+        self.assertEqual(0, len(radio.rolling_channels(self.data[:0],
+                                                       (2, False))))
+
+    def test_group_channels(self):
+        channels = radio.group_channels(self.data)
+        self.assertEqual([22, 26], channels.keys())
+        for channel, cdata in channels.items():
+            self.assertEqual(
+                self.data[self.data['channel'] == channel].tolist(),
+                cdata.tolist())
+
+        # Already sorted returns views
+        data = numpy.sort(self.data, order='channel', kind='mergesort')
+        channels = radio.group_channels(data)
+        self.assertTrue(all(numpy.may_share_memory(data, cdata)
+                            for cdata in channels.values()))
+
+        self.assertEqual({}, radio.group_channels(self.data[:0]))
+
+    def test_rssi_heatmap(self):
+        data = numpy.zeros(6, dtype=[('timestamp', float), ('channel', int),
+                                     ('rssi', int)])
+        data['timestamp'] = [0, 1, 2, 3, 4, 4]
+        data['channel'] = [11, 26, 11, 11, 26, 26]
+        data['rssi'] = [-90, -80, -70, -60, -50, -40]
+
+        channels, edges, values = radio.rssi_heatmap(data, 2)
+        self.assertEqual([11, 26], channels.tolist())
+        self.assertEqual([0, 2, 4], edges.tolist())
+        self.assertEqual('[[-90.0, -60.0], [-80.0, -40.0]]',
+                         repr(values.tolist()))
+
+        channels, edges, values = radio.rssi_heatmap(data, 4, 'mean')
+        self.assertEqual('[[-90.0, nan, -70.0, -60.0], '
+                         '[nan, -80.0, nan, -45.0]]', repr(values.tolist()))
+
+        # Single timestamp and no data
+        _, _, values = radio.rssi_heatmap(data[4:], 2)
+        self.assertEqual('[[-40.0, nan]]', repr(values.tolist()))
+        channels, _, values = radio.rssi_heatmap(data[:0], 2)
+        self.assertEqual((0, 2), values.shape)
+
+    def test_plot_heatmap(self):
+        plt.figure()
+        radio.oml_plot_heatmap(self.data, 'Node', 'mean')
+        image, = plt.gcf().axes[0].get_images()
+        self.assertEqual((2, common.figure_width()),
+                         image.get_array().shape)
+        plt.close()
+
+    def test_with_channel(self):
+        self.assertEqual([22, 26], radio.list_channels(self.data))
+
+        # Interleaved channels
+        ret = radio.with_channel(self.data, 26)
+        self.assertEqual(
+            self.data[self.data['channel'] == 26].tolist(), ret.tolist())
+
+        # Contiguous channel returns a view
+        data = numpy.sort(self.data, order='channel')
+        ret = radio.with_channel(data, 22)
+        self.assertEqual(data[data['channel'] == 22].tolist(), ret.tolist())
+        self.assertTrue(numpy.may_share_memory(data, ret))
+
+        self.assertEqual(0, len(radio.with_channel(data, 11)))
+
+
+class TestChannelStats(unittest.TestCase):
+
+    def setUp(self):
+        utest_cache_dir(self)
+        self.radio_file = test_file_path('examples', 'radio.oml')
+        self.data = numpy.zeros(8, dtype=[('timestamp', float),
+                                          ('channel', int), ('rssi', int)])
+        self.data['timestamp'] = range(8)
+        self.data['channel'] = [11, 11, 11, 11, 11, 11, 26, 26]
+        self.data['rssi'] = [-91, -70, -60, -91, -50, -50, -91, -91]
+
+    def test_channel_stats(self):
+        stats = radio.ChannelStats(threshold=-80)
+        stats.update(self.data)
+        self.assertEqual([(1, 2), (4, 5)], stats.periods(11))
+        self.assertEqual([], stats.periods(26))
+
+        report = stats.report(percentiles=(0, 50, 100))
+        self.assertEqual(['11', '26'], sorted(report))
+        chan = report['11']
+        self.assertEqual(6, chan['count'])
+        self.assertEqual(-91, chan['min'])
+        self.assertEqual(-50, chan['max'])
+        self.assertAlmostEqual(-412 / 6.0, chan['mean'])
+        self.assertEqual({'p0': -91, 'p50': -70, 'p100': -50},
+                         chan['percentiles'])
+        self.assertEqual({'-91': 2, '-70': 1, '-60': 1, '-50': 2},
+                         chan['histogram'])
+        # Busy from 1 to 3 and 4 to 5, on 0 to 5
+        self.assertAlmostEqual(3 / 5.0, chan['busy_fraction'])
+        self.assertEqual(0.0, report['26']['busy_fraction'])
+
+        # Measures at the same time
+        data = self.data[[1, 3]]
+        data['timestamp'] = 1
+        stats = radio.ChannelStats(threshold=-80)
+        stats.update(data)
+        self.assertEqual(0.5, stats.report()['11']['busy_fraction'])
+        self.assertEqual(2, chan['busy_periods'])
+        self.assertEqual(2.0, chan['busy_time'])
+        self.assertEqual(1.0, chan['busy_longest'])
+        self.assertEqual(0, report['26']['busy_periods'])
+        self.assertEqual(0.0, report['26']['busy_longest'])
+
+    def test_channel_stats_chunks(self):
+        stats = radio.ChannelStats(threshold=-80)
+        for start in range(0, len(self.data), 2):
+            stats.update(self.data[start:start + 2])
+        self.assertEqual([(1, 2), (4, 5)], stats.periods(11))
+
+        full = radio.ChannelStats(threshold=-80)
+        full.update(self.data)
+        self.assertEqual(full.report(), stats.report())
+
+        # File by chunks
+        data = radio.oml_load(self.radio_file)
+        full = radio.ChannelStats()
+        full.update(data)
+        stats = radio.oml_channel_stats(self.radio_file, chunk_rows=100)
+        self.assertEqual(full.report(), stats.report())
+        self.assertEqual(full.periods(22), stats.periods(22))
+        self.assertEqual(full.durations, stats.durations)
+
+    def test_stats_print(self):
+        stats = radio.ChannelStats(threshold=-80)
+        stats.update(self.data)
+        report = stats.report(percentiles=(5, 50))
+
+        out = StringIO()
+        radio.stats_print(report, 'json', out)
+        self.assertEqual(report, json.loads(out.getvalue()))
+
+        out = StringIO()
+        radio.stats_print(report, 'csv', out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(','.join(radio.STATS_CSV_FIELDS + ['p5', 'p50']),
+                         lines[0])
+        self.assertEqual(3, len(lines))
+        self.assertTrue(lines[1].startswith('11,6,-91,-50,'))
+
+        out = StringIO()
+        radio.stats_print({}, 'csv', out)
+        self.assertEqual(','.join(radio.STATS_CSV_FIELDS),
+                         out.getvalue().strip())
+
+    def test_main(self):
+        args = ['plot_oml_radio', '-i', self.radio_file, '--channel-stats']
+        with mock.patch('sys.argv', args + ['--busy-threshold', '-100']):
+            with mock.patch('sys.stdout', StringIO()) as stdout:
+                radio.main()
+        report = json.loads(stdout.getvalue())
+        self.assertEqual(['22', '26'], sorted(report))
+        self.assertEqual(1.0, report['22']['busy_fraction'])
+
+        with mock.patch('sys.argv', args + ['csv']):
+            with mock.patch('sys.stdout', StringIO()) as stdout:
+                radio.main()
+        self.assertEqual(3, len(stdout.getvalue().splitlines()))
+
+    def test_main_streamed(self):
+        args = ['plot_oml_radio', '-i', self.radio_file, '--channel-stats']
+        with mock.patch('oml_plot_tools.radio.oml_load') as oml_load:
+            with mock.patch('sys.argv', args):
+                with mock.patch('sys.stdout', StringIO()) as stdout:
+                    radio.main()
+            self.assertFalse(oml_load.called)
+        self.assertEqual(
+            radio.oml_channel_stats(self.radio_file).report(),
+            json.loads(stdout.getvalue()))
+
+        # Samples selection uses loaded data
+        with mock.patch('sys.argv', args + ['--end', '10']):
+            with mock.patch('sys.stdout', StringIO()) as stdout:
+                radio.main()
+        self.assertEqual(10, sum(chan['count'] for chan in
+                                 json.loads(stdout.getvalue()).values()))
+
+        with mock.patch('sys.argv', ['plot_oml_radio', '-i', '/invalid/file',
+                                     '--channel-stats']):
+            with mock.patch('sys.stderr'):
+                self.assertRaises(SystemExit, radio.main)
+
+
 class TestRadioPlot(unittest.TestCase):
 
     def setUp(self):
+        utest_cache_dir(self)
         meas_file = test_file_path('examples', 'radio.oml')
         self.data = radio.oml_load(meas_file)[0:1]
 
@@ -71,6 +286,8 @@ class TestRadioPlot(unittest.TestCase):
                                         '.oml_plot_rssi').start()
         self.oml_plot_clock = mock.patch('oml_plot_tools.radio'
                                          '.common.oml_plot_clock').start()
+        self.channels = mock.patch('oml_plot_tools.radio.group_channels',
+                                   return_value=mock.sentinel.channels).start()
 
     def tearDown(self):
         mock.patch.stopall()
@@ -82,16 +299,63 @@ class TestRadioPlot(unittest.TestCase):
 
     def test_plot_joined(self):
         self.radio_main('--all')
-        assert_called_with_nparray(self.oml_plot_rssi, self.data, self.title)
+        assert_called_with_nparray(self.oml_plot_rssi, self.data, self.title,
+                                   gaps=None, channels=mock.sentinel.channels)
+        self.assertEqual(1, self.channels.call_count)
 
     def test_plot_separated(self):
         self.radio_main('--plot')
         assert_called_with_nparray(self.oml_plot_rssi,
-                                   self.data, self.title, separated=True)
+                                   self.data, self.title, separated=True,
+                                   gaps=None, channels=mock.sentinel.channels)
+
+    def test_plot_gaps(self):
+        self.radio_main('--all', '--gaps')
+        gaps = self.oml_plot_rssi.call_args[1]['gaps']
+        self.assertEqual(0, len(gaps))
+
+    @mock.patch('oml_plot_tools.radio.oml_plot_heatmap')
+    def test_plot_heatmap(self, oml_plot_heatmap):
+        self.radio_main('--heatmap', '--heatmap-mean')
+        self.assertEqual(['max', 'mean'],
+                         [c[0][2] for c in oml_plot_heatmap.call_args_list])
+        self.assertFalse(self.oml_plot_rssi.called)
+        self.assertFalse(self.channels.called)
+
+    @mock.patch('oml_plot_tools.radio.rolling_channels')
+    def test_plot_rolling(self, rolling_channels):
+        self.radio_main('--all', '--rolling', '1s')
+        assert_called_with_nparray(rolling_channels, self.data, (1.0, True),
+                                   'mean')
 
     def test_plot_time(self):
         self.radio_main('--time')
         assert_called_with_nparray(self.oml_plot_clock, self.data)
+        self.assertFalse(self.channels.called)
+
+    @mock.patch('oml_plot_tools.common.plot_headless')
+    @mock.patch('oml_plot_tools.common.plot_save')
+    def test_plot_output(self, plot_save, plot_headless):
+        self.radio_main('--all', '--output', 'radio.pdf')
+        self.assertTrue(plot_headless.called)
+        self.assertEqual('radio.pdf', plot_save.call_args[0][1])
+
+    def test_time_report(self):
+        with mock.patch('sys.stdout', StringIO()) as stdout:
+            self.radio_main('--time-report')
+        report = json.loads(stdout.getvalue())
+        self.assertEqual(1, report['count'])
+
+    @mock.patch('oml_plot_tools.common.oml_print_clock')
+    def test_stats(self, oml_print_clock):
+        self.radio_main('--stats')
+        assert_called_with_nparray(oml_print_clock, self.data)
+        self.assertFalse(self.oml_plot_rssi.called)
+
+    def test_invalid_file(self):
+        self.args = [self.args[0], '-i', '/invalid/file/path']
+        with mock.patch('sys.stderr'):
+            self.assertRaises(SystemExit, self.radio_main, '--no-cache')
 
 
 class TestDoc(unittest.TestCase):
@@ -20,18 +20,24 @@
 # knowledge of the CeCILL license and that you accept its terms.
 
 
-# pylint:disable=missing-docstring
+# pylint:disable=missing-docstring,protected-access
 # python2.6
 # pylint:disable=too-many-public-methods
-import unittest
+import os
 import json
+import shutil
+import tempfile
+import unittest
+from cStringIO import StringIO
 
 import mock
+import numpy
 
 from .common import (utest_help_as_doc, utest_plot_and_compare,
-                     test_file_path, assert_called_with_nparray)
+                     test_file_path, assert_called_with_nparray,
+                     utest_cache_dir)
 
-from .. import traj, common
+from .. import traj, common, cache
 
 
 def robot_get_map(site):
@@ -53,11 +59,13 @@ def robot_get_map(site):
 def maps_load(site):
     """Load given site map and retern mapinfo."""
     map_cfg = robot_get_map(site)
-    return traj._mapinfo_from_cfg(map_cfg)  # pylint:disable=protected-access
+    # pylint:disable=protected-access
+    return traj._mapinfo_from_meta(map_cfg, traj._image_from_cfg(map_cfg))
 
 
 class TestTrajectoryOmlPlot(unittest.TestCase):
     def setUp(self):
+        utest_cache_dir(self)
         robot_file = test_file_path('examples', 'robot.oml')
         circuit_file = test_file_path('examples', 'Jhall_w.json')
 
@@ -99,6 +107,7 @@ class TestTrajectoryOmlPlot(unittest.TestCase):
 class TestTrajectory(unittest.TestCase):
 
     def setUp(self):
+        utest_cache_dir(self)
         meas_file = test_file_path('examples', 'robot.oml')
         self.data = traj.oml_load(meas_file)[0:1]
 
@@ -164,12 +173,454 @@ class TestTrajectory(unittest.TestCase):
         self.assertFalse(self.oml_plot_angle.called)
         self.assertFalse(self.oml_plot_clock.called)
 
+    def test_time_report(self):
+        with mock.patch('sys.stdout', StringIO()) as stdout:
+            self.traj_main('--time-report')
+        report = json.loads(stdout.getvalue())
+        self.assertEqual(1, report['count'])
+
+    @mock.patch('oml_plot_tools.traj.trajectory_report')
+    def test_analytics(self, trajectory_report):
+        trajectory_report.return_value = {'distance': 0.0}
+        with mock.patch('sys.stdout', StringIO()) as stdout:
+            self.traj_main('--analytics')
+        self.assertEqual({'distance': 0.0}, json.loads(stdout.getvalue()))
+        assert_called_with_nparray(trajectory_report, self.data, None, None)
+        self.assertFalse(self.oml_plot_map.called)
+
+    @mock.patch('oml_plot_tools.traj.occupancy_plot')
+    def test_occupancy(self, occupancy_plot):
+        robot_file = test_file_path('examples', 'robot.oml')
+        self.args = ['plot_oml_traj']
+        self.traj_main('--occupancy', robot_file, robot_file)
+        occupancy = occupancy_plot.call_args[0][0]
+        self.assertAlmostEqual(2 * 143.7, occupancy.grid.sum(), places=3)
+        self.assertFalse(self.oml_plot_map.called)
+
+        with mock.patch('sys.stderr'):
+            self.assertRaises(SystemExit, self.traj_main,
+                              '--occupancy', '/invalid/file/path')
+
+        # Skipped poses are reported
+        with mock.patch('oml_plot_tools.traj.oml_occupancy') as oml_occupancy:
+            oml_occupancy.return_value.skipped = 2
+            with mock.patch('sys.stderr', StringIO()) as stderr:
+                self.traj_main('--occupancy', robot_file)
+        self.assertIn('Skipped 2 poses', stderr.getvalue())
+
+    @mock.patch('oml_plot_tools.common.oml_print_clock')
+    def test_stats(self, oml_print_clock):
+        self.traj_main('--stats')
+        assert_called_with_nparray(oml_print_clock, self.data)
+        self.assertFalse(self.oml_plot_map.called)
+        self.assertFalse(self.plot_show.called)
+
+        # Requires input file
+        self.args = [self.args[0]]
+        with mock.patch('sys.stderr'):
+            self.assertRaises(SystemExit, self.traj_main, '--stats')
+
+    @mock.patch('oml_plot_tools.common.plot_headless')
+    @mock.patch('oml_plot_tools.common.plot_save')
+    def test_plot_output(self, plot_save, plot_headless):
+        self.oml_plot_angle.return_value = True
+        self.traj_main('--angle', '-o', 'angle.svg')
+        self.assertTrue(plot_headless.called)
+        self.assertEqual('angle.svg', plot_save.call_args[0][1])
+        self.assertFalse(self.plot_show.called)
+
     @mock.patch('iotlabcli.robot.robot_get_map', robot_get_map)
     def test_plot_mapinfo(self):
-        self.args = ['plot_oml_consum']
-        self.traj_main('--site-map', 'grenoble')
+        self.args = ['plot_oml_traj']
+        self.traj_main('--site-map', 'grenoble', '--no-cache')
         self.assertTrue(self.oml_plot_map.called)
 
+        with mock.patch('sys.stderr'):
+            self.assertRaises(SystemExit, self.traj_main,
+                              '--site-map', 'grenoble', '--offline')
+
+    def test_invalid_file(self):
+        self.args = [self.args[0], '-i', '/invalid/file/path']
+        with mock.patch('sys.stderr'):
+            self.assertRaises(SystemExit, self.traj_main, '--no-cache')
+
+
+class TestSiteMap(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        mock.patch('oml_plot_tools.cache.CACHE_DIR', self.cache_dir).start()
+        self.get_map = mock.patch('iotlabcli.robot.robot_get_map',
+                                  side_effect=robot_get_map).start()
+        self.image = maps_load('grenoble').image
+
+    def tearDown(self):
+        mock.patch.stopall()
+        shutil.rmtree(self.cache_dir)
+
+    def test_cached_map(self):
+        mapinfo = traj.get_site_map('grenoble')
+        self.assertEqual(1, self.get_map.call_count)
+        self.assertEqual(self.image.tolist(), mapinfo.image.tolist())
+
+        # Second time from cache
+        cached = traj.get_site_map('grenoble')
+        self.assertEqual(1, self.get_map.call_count)
+        self.assertEqual(mapinfo[1:5], cached[1:5])
+        self.assertEqual(self.image.tolist(), cached.image.tolist())
+
+        # Offline, even if outdated
+        with mock.patch('oml_plot_tools.cache.MAP_TTL', 0):
+            traj.get_site_map('grenoble', offline=True)
+        self.assertEqual(1, self.get_map.call_count)
+
+    def test_outdated_map(self):
+        traj.get_site_map('grenoble')
+        with mock.patch('oml_plot_tools.cache.MAP_TTL', 0):
+            # Checked again, but same content is not decoded again
+            with mock.patch('oml_plot_tools.traj._image_from_cfg') as decode:
+                traj.get_site_map('grenoble')
+            self.assertFalse(decode.called)
+            self.assertEqual(2, self.get_map.call_count)
+
+            # Changed content
+            map_cfg = robot_get_map('grenoble')
+            map_cfg['config']['ratio'] = 1
+            self.get_map.side_effect = None
+            self.get_map.return_value = map_cfg
+            self.assertEqual(1, traj.get_site_map('grenoble').ratio)
+        self.assertEqual(1, traj.get_site_map('grenoble').ratio)
+
+    def test_no_cache(self):
+        traj.get_site_map('grenoble', cache.BYPASS)
+        traj.get_site_map('grenoble', cache.BYPASS)
+        self.assertEqual(2, self.get_map.call_count)
+        self.assertEqual([], os.listdir(self.cache_dir))
+
+        traj.get_site_map('grenoble')
+        traj.get_site_map('grenoble', cache.REBUILD)
+        self.assertEqual(4, self.get_map.call_count)
+
+    def test_rebuild_map(self):
+        traj.get_site_map('grenoble')
+        # Same content is decoded and stored again
+        with mock.patch('oml_plot_tools.cache.map_store') as map_store:
+            mapinfo = traj.get_site_map('grenoble', cache.REBUILD)
+        self.assertTrue(map_store.called)
+        self.assertEqual(2, self.get_map.call_count)
+        self.assertEqual(self.image.tolist(), mapinfo.image.tolist())
+
+    def test_offline_no_cache(self):
+        self.assertRaises(ValueError, traj.get_site_map, 'grenoble',
+                          offline=True)
+        self.assertFalse(self.get_map.called)
+
+    def test_store_error(self):
+        with mock.patch('numpy.save', side_effect=IOError):
+            mapinfo = traj.get_site_map('grenoble')
+        self.assertEqual(self.image.tolist(), mapinfo.image.tolist())
+        self.assertIsNone(cache.map_load('grenoble'))
+        self.assertEqual([], os.listdir(os.path.join(self.cache_dir, 'maps')))
+
+        cache.map_touch('grenoble')  # no error
+
+
+class TestSimplifyTrajectory(unittest.TestCase):
+
+    def setUp(self):
+        utest_cache_dir(self)
+
+    def test_collapse_stationary(self):
+        nan = float('nan')
+        x_values = [0, 0, 0, 1, 1, nan, nan, 2, 2, 0]
+        y_values = [0, 0, 0, 1, 1, 1, nan, 2, 2, 0]
+        self.assertEqual([0, 3, 5, 7, 9], traj.simplify_trajectory(
+            x_values, y_values, 0).tolist())
+        self.assertEqual([], traj.simplify_trajectory([], [], 1).tolist())
+
+    def test_rdp(self):
+        x_values = [0, 1, 2, 3, 4, 5, 6, 7]
+        y_values = [0, 0.01, 0, 1, 2, 2, 2.1, 2]
+        self.assertEqual([0, 2, 4, 6, 7], traj.simplify_trajectory(
+            x_values, y_values, 0.05).tolist())
+        self.assertEqual([0, 7], traj.simplify_trajectory(
+            x_values, y_values, 10).tolist())
+        self.assertEqual([0, 1, 2, 4, 5, 6, 7], traj.simplify_trajectory(
+            x_values, y_values, 0.001).tolist())
+
+        # Loop, same start and end
+        self.assertEqual([0, 1, 2, 3], traj.simplify_trajectory(
+            [0, 1, 1, 0], [0, 0, 1, 0], 0.5).tolist())
+
+    def test_rdp_nan(self):
+        nan = float('nan')
+        x_values = [0, 1, 2, 3, nan, 5, 6, 7, 8]
+        y_values = [0, 0, 0, 0, nan, 0, 0, 0, 0]
+        self.assertEqual([0, 3, 4, 5, 8], traj.simplify_trajectory(
+            x_values, y_values, 0.1).tolist())
+
+    def test_robot_trajectory(self):
+        data = traj.oml_load(test_file_path('examples', 'robot.oml'))
+        index = traj.simplify_trajectory(data['x'], data['y'], 0.01)
+        self.assertTrue(len(index) < len(data) / 10)
+
+        # All removed points are within tolerance of the kept path
+        x_values, y_values = data['x'], data['y']
+        segment = numpy.searchsorted(index, numpy.arange(len(data)),
+                                     side='right') - 1
+        segment = numpy.minimum(segment, len(index) - 2)
+        dist = traj._segment_distance(  # pylint:disable=protected-access
+            x_values, y_values, numpy.arange(len(data)),
+            index[segment], index[segment + 1])
+        self.assertTrue((dist <= 0.01).all())
+
+
+class TestTrajectoryReport(unittest.TestCase):
+
+    def setUp(self):
+        utest_cache_dir(self)
+        self.data = numpy.zeros(5, dtype=[('timestamp', float),
+                                          ('x', float), ('y', float),
+                                          ('theta', float)])
+        self.data['timestamp'] = [0, 1, 2, 3, 4]
+        self.data['x'] = [0, 0, 3, 3, 3]
+        self.data['y'] = [0, 0, 4, 4, 8]
+        self.data['theta'] = [3.0, -3.0, 3.0, float('nan'), -3.0]
+        self.circuit = {
+            'coordinates': {'a': {'x': 0, 'y': 0}, 'b': {'x': 3, 'y': 0},
+                            'c': {'x': 3, 'y': 8}},
+            'points': ['a', 'b', 'c'],
+        }
+
+    def test_report(self):
+        mapinfo = traj.MapInfo(None, 0.05, 0, 0,
+                               [traj.Dock(0, 0.1, 0), traj.Dock(10, 10, 0)],
+                               None)
+        report = traj.trajectory_report(self.data, mapinfo, self.circuit)
+        self.assertEqual(5, report['count'])
+        self.assertEqual(4.0, report['duration'])
+        self.assertEqual(9.0, report['distance'])
+        self.assertEqual(2.25, report['mean_speed'])
+        self.assertEqual({'mean': 2.25, 'min': 0.0, 'max': 5.0,
+                          'percentiles': {'p50': 2.0, 'p90': 4.7,
+                                          'p99': 4.97}},
+                         {k: (numpy.round(v, 6) if k != 'percentiles' else
+                              {p: numpy.round(x, 6) for p, x in v.items()})
+                          for k, v in report['speed'].items()})
+
+        # Unwrapped: 0.28 rad steps, NaN skipped
+        turn = 2 * numpy.pi - 6
+        self.assertAlmostEqual(3 * turn, report['rotation'])
+        self.assertAlmostEqual(turn, report['angular_speed']['min'] * 2)
+        self.assertAlmostEqual(turn, report['angular_speed']['max'])
+
+        self.assertEqual([{'x': 0, 'y': 0.1, 'dwell': 1.0},
+                          {'x': 10, 'y': 10, 'dwell': 0.0}], report['docks'])
+        self.assertEqual(0.0, report['circuit']['max'])
+
+    def test_report_empty(self):
+        report = traj.trajectory_report(self.data[:1])
+        self.assertEqual(0.0, report['distance'])
+        self.assertIsNone(report['mean_speed'])
+        self.assertIsNone(report['speed'])
+        self.assertIsNone(report['angular_speed'])
+        self.assertIsNone(report['docks'])
+        self.assertIsNone(report['circuit'])
+
+    def test_circuit_distance(self):
+        x_values = [0, 1.5, 1.5, 4, float('nan')]
+        y_values = [0, 1, 5, 9, 0]
+        numpy.testing.assert_allclose(
+            [0, 1, 1.5, 1.4142136, numpy.nan],
+            traj.circuit_distance(x_values, y_values, self.circuit,
+                                  chunk_size=3), rtol=1e-6)
+
+        # Closed circuit
+        self.circuit['loop'] = True
+        numpy.testing.assert_allclose(
+            [0, 1, 0.3511234, 1.4142136, numpy.nan],
+            traj.circuit_distance(x_values, y_values, self.circuit),
+            rtol=1e-6)
+
+        # No points
+        empty = {'coordinates': {}, 'points': []}
+        self.assertTrue(numpy.isnan(traj.circuit_distance(
+            x_values, y_values, empty)).all())
+        self.assertIsNone(traj.trajectory_report(self.data,
+                                                 circuit=empty)['circuit'])
+
+        # Single point
+        self.circuit['points'] = ['c']
+        numpy.testing.assert_allclose(
+            [5, 5], traj.circuit_distance([3, 0], [3, 4], self.circuit))
+
+    def test_dock_dwell(self):
+        docks = [traj.Dock(3, 4, 0)]
+        self.assertEqual([1.0], traj.dock_dwell(self.data, docks).tolist())
+        self.assertEqual([2.0], traj.dock_dwell(self.data, docks,
+                                                4).tolist())
+        self.assertEqual([0.0], traj.dock_dwell(self.data[:1],
+                                                docks).tolist())
+        self.assertEqual([], traj.dock_dwell(self.data, []).tolist())
+
+
+class TestOccupancy(unittest.TestCase):
+
+    def setUp(self):
+        utest_cache_dir(self)
+        self.data = numpy.zeros(6, dtype=[('timestamp', float),
+                                          ('x', float), ('y', float)])
+        self.data['timestamp'] = [0, 1, 3, 3, 10, 11]
+        self.data['x'] = [0.5, 1.5, float('nan'), -0.5, 2.5, 0]
+        self.data['y'] = [0.5, 0.5, 0, 1.5, 0.5, 0]
+
+    def test_update(self):
+        occupancy = traj.Occupancy(1.0, max_gap=2)
+        occupancy.update(self.data)
+        # NaN, same time and too long intervals are skipped
+        self.assertEqual([[1.0, 2.0, 1.0]], occupancy.grid.tolist())
+        self.assertEqual((0, 0), occupancy.start)
+        self.assertEqual((0, 3, 0, 1), occupancy.extent())
+
+        # Update by chunks gives the same grid
+        chunked = traj.Occupancy(1.0, max_gap=2)
+        for first in range(0, len(self.data), 2):
+            chunked.update(self.data[first:first + 2])
+        chunked.update(self.data[:0])
+        self.assertEqual(occupancy.grid.tolist(), chunked.grid.tolist())
+
+    def test_grow(self):
+        occupancy = traj.Occupancy(1.0, origin=(0.5, 0), max_gap=10)
+        occupancy.update(self.data)
+        self.assertEqual([[0.0, 1.0, 2.0, 1.0], [7.0, 0.0, 0.0, 0.0]],
+                         occupancy.grid.tolist())
+        self.assertEqual((-1, 0), occupancy.start)
+        self.assertEqual((-0.5, 3.5, 0, 2), occupancy.extent())
+
+        # Runs are not joined
+        occupancy.end_run()
+        occupancy.update(self.data[2:4])
+        self.assertEqual(11.0, occupancy.grid.sum())
+        occupancy.update(self.data[:1])
+        self.assertEqual(11.0, occupancy.grid.sum())
+
+    def test_bounds(self):
+        # Outlier pose does not grow the grid
+        self.data['x'][1] = 1e9
+        occupancy = traj.Occupancy(0.25, max_gap=10)
+        occupancy.update(self.data)
+        self.assertEqual(1, occupancy.skipped)
+        self.assertEqual(9.0, occupancy.grid.sum())
+        self.assertLessEqual(occupancy.grid.size, traj.OCCUPANCY_MAX_CELLS)
+
+        occupancy = traj.Occupancy(1.0, max_gap=10, bounds=(0, 1, 0, 0))
+        occupancy.update(self.data)
+        self.assertEqual([[1.0]], occupancy.grid.tolist())
+        self.assertEqual(3, occupancy.skipped)
+        occupancy.end_run()
+        occupancy.update(self.data[3:5])
+        self.assertEqual(4, occupancy.skipped)
+
+        # Poses out of the map
+        mapinfo = maps_load('grenoble')
+        data = self.data.copy()
+        data['timestamp'] = range(6)
+        data['x'] = [mapinfo.offsetx - 1, mapinfo.offsetx + 1, 1e9, 1e9,
+                     1e9, 1e9]
+        data['y'] = mapinfo.offsety + 1
+        with mock.patch('oml_plot_tools.common.iter_oml_chunks') as chunks:
+            chunks.return_value = [data]
+            occupancy = traj.oml_occupancy(['robot.oml'], mapinfo)
+        self.assertEqual(4, occupancy.skipped)
+        self.assertEqual([[1.0]], occupancy.grid.tolist())
+
+    def test_oml_occupancy(self):
+        robot_file = test_file_path('examples', 'robot.oml')
+        mapinfo = maps_load('grenoble')
+        occupancy = traj.oml_occupancy([robot_file], mapinfo, chunk_rows=100)
+        self.assertEqual(5 * mapinfo.ratio, occupancy.cell)
+        self.assertEqual((mapinfo.offsetx, mapinfo.offsety),
+                         occupancy.origin)
+        self.assertAlmostEqual(143.7, occupancy.grid.sum(), places=3)
+
+        whole = traj.oml_occupancy([robot_file], mapinfo)
+        self.assertEqual(occupancy.grid.tolist(), whole.grid.tolist())
+
+        occupancy = traj.oml_occupancy([])
+        self.assertEqual(traj.OCCUPANCY_CELL, occupancy.cell)
+        self.assertIsNone(occupancy.extent())
+
+    @mock.patch('oml_plot_tools.common.plot_show')
+    def test_plot_occupancy(self, plot_show):
+        robot_file = test_file_path('examples', 'robot.oml')
+        mapinfo = maps_load('grenoble')
+        occupancy = traj.oml_occupancy([robot_file], mapinfo)
+
+        figures = traj.occupancy_plot(occupancy, 'Robot', mapinfo)
+        self.assertEqual(1, len(figures))
+        self.assertTrue(plot_show.called)
+        # Map and occupancy
+        images = figures[0].axes[0].get_images()
+        self.assertEqual(2, len(images))
+        numpy.testing.assert_allclose(occupancy.extent(),
+                                      images[1].get_extent())
+
+        figures = traj.occupancy_plot(traj.Occupancy(1.0), 'Robot')
+        self.assertEqual([], figures[0].axes[0].get_images())
+
+
+class TestMapView(unittest.TestCase):
+
+    def setUp(self):
+        utest_cache_dir(self)
+        self.mapinfo = maps_load('grenoble')
+
+    def test_image_pyramid(self):
+        image = numpy.array([[1, 2, 3], [4, 5, 6], [7, 8, 0]], numpy.uint8)
+        levels = traj.image_pyramid(image, min_size=1)
+        self.assertEqual([[1, 3], [7, 0]], levels[1].tolist())
+        self.assertEqual([[0]], levels[2].tolist())
+        self.assertEqual(3, len(levels))
+
+        # Grenoble map levels
+        self.assertEqual([(808, 1274), (404, 637), (202, 319), (101, 160)],
+                         [level.shape for level in self.mapinfo.levels])
+
+    def test_map_view(self):
+        # Crop at full resolution
+        image, extent = traj.map_view(self.mapinfo, (20, 30, 0, 5), 640)
+        self.assertEqual(self.mapinfo.levels[0].dtype, image.dtype)
+        self.assertEqual((141, 241), image.shape)
+        numpy.testing.assert_allclose((18.96, 31.01, -1.05, 6.0), extent)
+        self.assertTrue(numpy.may_share_memory(self.mapinfo.image, image))
+
+        # Whole map at lower resolution
+        image, extent = traj.map_view(self.mapinfo, None, 300)
+        self.assertEqual(self.mapinfo.levels[2].shape, image.shape)
+        numpy.testing.assert_allclose(traj._image_extent(self.mapinfo),
+                                      extent, atol=0.1)
+        image, extent = traj.map_view(self.mapinfo, None, 10)
+        self.assertEqual(self.mapinfo.levels[-1].shape, image.shape)
+        # Not stretched, padded columns only extend the right edge
+        map_extent = traj._image_extent(self.mapinfo)
+        numpy.testing.assert_allclose(map_extent[0], extent[0])
+        numpy.testing.assert_allclose(map_extent[2:], extent[2:])
+        size = self.mapinfo.ratio * 8
+        numpy.testing.assert_allclose(
+            (image.shape[1] * size, image.shape[0] * size),
+            (extent[1] - extent[0], extent[3] - extent[2]))
+
+        # Out of the map
+        self.assertIsNone(traj.map_view(self.mapinfo, (100, 110, 0, 5), 640))
+
+    @mock.patch('matplotlib.pyplot.imshow')
+    def test_plot_mapinfo_out_of_map(self, imshow):
+        data = numpy.zeros(2, dtype=[('x', float), ('y', float)])
+        data['x'] = [100, 110]
+        traj.oml_plot_map(data, 'title', self.mapinfo)
+        self.assertFalse(imshow.called)
+        self.assertIsNone(traj._plot_bbox(data[:0], None))
+
 
 class TestDoc(unittest.TestCase):
     def test_doc(self):
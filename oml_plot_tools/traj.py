@@ -23,7 +23,10 @@
 
 """
 usage: plot_oml_traj [-h] [-i DATA] [--circuit-file CIRCUIT] [--site-map SITE]
-                     [-l TITLE] [-b BEGIN] [-e END] [-t] [-a] [-ti]
+                     [--offline] [-l TITLE] [-b BEGIN] [-e END] [--start TIME]
+                     [--stop TIME] [--no-cache] [--rebuild-cache] [-o FILE]
+                     [-s] [--time-report] [--analytics]
+                     [--occupancy DATA [DATA ...]] [-t] [-a] [-ti]
 
 Plot iot-lab trajectory oml files
 
@@ -34,11 +37,29 @@ optional arguments:
   --circuit-file CIRCUIT
                         Robot circuit file, '-' for stdin
   --site-map SITE       Site map
+  --offline             Only use cached site map, without contacting the API
   -l TITLE, --label TITLE
                         Graph title
   -b BEGIN, --begin BEGIN
                         Sample start
   -e END, --end END     Sample end
+  --start TIME          Time start, in seconds since experiment start or since
+                        epoch when starting with '@'
+  --stop TIME           Time stop, same format as start
+  --no-cache            Do not use parsed files cache
+  --rebuild-cache       Rebuild parsed files cache
+  -o FILE, --output FILE
+                        Save plots to file instead of showing them, format
+                        from extension
+  -s, --stats           Only print time verification statistics, without
+                        plotting
+  --time-report         Only print time verification report as JSON, without
+                        plotting
+  --analytics           Only print trajectory distance, speed, docks dwell and
+                        circuit deviation report as JSON, without plotting
+  --occupancy DATA [DATA ...]
+                        Plot time spent in each map cell by robots from all
+                        given trajectory files
 
 plot:
   Plot selection
@@ -49,7 +70,9 @@ plot:
 """
 
 
+import sys
 import json
+import hashlib
 from collections import namedtuple
 from cStringIO import StringIO
 
@@ -58,17 +81,11 @@ import argparse
 # Issues with numpy and matplotlib.cm
 # pylint:disable=no-member
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.cm as cm
-import matplotlib.patches as patches
-# http://stackoverflow.com/a/26605247/395687
-# pip install --no-index -f http://dist.plone.org/thirdparty/ -U PIL
-# or 'apt-get install python-imaging'
-from PIL import Image
 
-import iotlabcli.robot
+# matplotlib, PIL and iotlabcli are imported when used, to start faster
 
 from . import common
+from . import cache
 
 
 PACKAGE = __name__.split('.')[0]
@@ -100,7 +117,25 @@ Map = namedtuple('Map', ['marker', 'file', 'ratio', 'sizex', 'sizey',
                          'offsetx', 'offsety'])
 
 MapInfo = namedtuple('MapInfo', ['image', 'ratio', 'offsetx', 'offsety',
-                                 'docks'])
+                                 'docks', 'levels'])
+# Map shown around trajectory and circuit, with this margin in meters
+MAP_MARGIN = 1.0
+# Smallest map image pyramid level size in pixels
+MAP_LEVEL_MIN = 256
+# Trajectory simplification tolerance in meters when there is no map,
+# else half a map pixel
+TRAJ_TOLERANCE = 0.01
+# Robot distance to a dock in meters to be considered docked
+DOCK_RADIUS = 0.5
+ANALYTICS_PERCENTILES = (50, 90, 99)
+# Points times circuit segments distances computed at once
+CIRCUIT_CHUNK_SIZE = 1 << 20
+# Occupancy grid cell size in meters, rounded to map pixels,
+# and longest interval between poses accounted as time spent in a cell
+OCCUPANCY_CELL = 0.25
+OCCUPANCY_MAX_GAP = 1.0
+# Occupancy grid cells limit without a site map
+OCCUPANCY_MAX_CELLS = 1 << 22
 Dock = namedtuple('Dock', ['x', 'y', 'theta'])
 
 # Selection variables
@@ -110,39 +145,91 @@ _ANGLE = 'angle'
 _TIME = 'time'
 
 
-def oml_load(filename):
+def oml_load(filename, cache_mode=cache.USE, start=None, stop=None):
     """ Load consumption oml file """
-    data = common.oml_load(filename, 'robot_pose', MEASURES_D.values())
+    data = common.oml_load(filename, 'robot_pose', MEASURES_D.values(),
+                           cache_mode=cache_mode, start=start, stop=stop)
     return data
 
 
-def get_site_map(site):
-    """ Load infos for site """
-    # Get map config and with cache
+def get_site_map(site, cache_mode=cache.USE, offline=False):
+    """ Load infos for site
+
+    Map config, docks and decoded image are cached. The cached map is used
+    for cache.MAP_TTL seconds, then checked again against the API, and
+    decoded again only if it changed. With cache.REBUILD, it is always
+    decoded again.
+    :param offline: only use cached map, even if outdated """
+    cached = None
+    if cache_mode == cache.USE or offline:
+        cached = cache.map_load(site)
+    if offline:
+        if cached is None:
+            raise ValueError("No cached map for site '%s'" % site)
+        return _mapinfo_from_meta(*cached[:2])
+    if cached and cached[2] < cache.MAP_TTL:
+        return _mapinfo_from_meta(*cached[:2])
+
+    import iotlabcli.robot
     map_cfg = iotlabcli.robot.robot_get_map(site)
-    map_info = _mapinfo_from_cfg(map_cfg)
+    meta = {'config': map_cfg['config'], 'dock': map_cfg['dock'],
+            'hash': _map_hash(map_cfg)}
+    if cached and cached[0]['hash'] == meta['hash']:
+        cache.map_touch(site)
+        return _mapinfo_from_meta(*cached[:2])
 
-    return map_info
+    image = _image_from_cfg(map_cfg)
+    if cache_mode != cache.BYPASS:
+        cache.map_store(site, meta, image)
+    return _mapinfo_from_meta(meta, image)
+
+
+def _map_hash(map_cfg):
+    """ Hash of 'map_cfg' content """
+    content = json.dumps([map_cfg['config'], map_cfg['dock']], sort_keys=True)
+    return hashlib.sha1(map_cfg['image'] + content).hexdigest()
 
 
-def _mapinfo_from_cfg(map_cfg):
-    """ MapInfo object from 'map_cfg' dict """
+def _image_from_cfg(map_cfg):
+    """ Decode 'map_cfg' image as grayscale array """
+    # http://stackoverflow.com/a/26605247/395687
+    # pip install --no-index -f http://dist.plone.org/thirdparty/ -U PIL
+    # or 'apt-get install python-imaging'
+    from PIL import Image
 
-    # Load Image
     image_fd = StringIO(map_cfg['image'])
-    image = Image.open(image_fd).convert('L')
+    return np.asarray(Image.open(image_fd).convert('L'))
 
+
+def _mapinfo_from_meta(meta, image):
+    """ MapInfo from map 'config' and 'dock' in 'meta' and 'image' """
     # Load Docks
-    docks = map_cfg['dock'].values()
+    docks = meta['dock'].values()
     docks = [Dock(d['x'], d['y'], d['theta']) for d in docks]
 
     # Create the whole MapInfo
-    cfg = map_cfg['config']
+    cfg = meta['config']
     map_info = MapInfo(image, cfg['ratio'], cfg['offset'][0], cfg['offset'][1],
-                       docks)
+                       docks, image_pyramid(image))
     return map_info
 
 
+def image_pyramid(image, min_size=MAP_LEVEL_MIN):
+    """ Grayscale 'image' halved resolutions, until 'min_size' pixels
+
+    Each pixel is the darkest of the 2x2 pixels it replaces, to keep thin
+    walls visible.
+    :returns: list of images, from 'image' full resolution """
+    levels = [image]
+    while max(levels[-1].shape) > min_size:
+        level = levels[-1]
+        pad = [(0, level.shape[0] % 2), (0, level.shape[1] % 2)]
+        level = np.pad(level, pad, 'edge')
+        height, width = level.shape[0] // 2, level.shape[1] // 2
+        levels.append(level.reshape(height, 2, width, 2).min(axis=(1, 3)))
+    return levels
+
+
 def circuit_load(filename):
     """ Load robot circuit file
 
@@ -174,17 +261,46 @@ def circuit_load(filename):
 
 PARSER = argparse.ArgumentParser(
     prog='plot_oml_traj', description="Plot iot-lab trajectory oml files")
-PARSER.add_argument('-i', '--input', dest='data', type=oml_load,
+PARSER.add_argument('-i', '--input', metavar='DATA',
                     help="Robot trajectory values")
 PARSER.add_argument('--circuit-file', dest='circuit', type=circuit_load,
                     help="Robot circuit file, '-' for stdin")
-PARSER.add_argument('--site-map', metavar='SITE', dest='mapinfo',
-                    type=get_site_map, help="Site map")
+PARSER.add_argument('--site-map', metavar='SITE', dest='site',
+                    help="Site map")
+PARSER.add_argument('--offline', action='store_true',
+                    help="Only use cached site map, without contacting "
+                         "the API")
 
 PARSER.add_argument('-l', '--label', dest='title', default=_TITLE,
                     help="Graph title")
 PARSER.add_argument('-b', '--begin', default=0, type=int, help="Sample start")
 PARSER.add_argument('-e', '--end', default=-1, type=int, help="Sample end")
+PARSER.add_argument('--start', metavar='TIME', type=common.time_arg,
+                    help="Time start, in seconds since experiment start "
+                         "or since epoch when starting with '@'")
+PARSER.add_argument('--stop', metavar='TIME', type=common.time_arg,
+                    help="Time stop, same format as start")
+PARSER.add_argument('--no-cache', dest='cache', action='store_const',
+                    const=cache.BYPASS, default=cache.USE,
+                    help="Do not use parsed files cache")
+PARSER.add_argument('--rebuild-cache', dest='cache', action='store_const',
+                    const=cache.REBUILD, help="Rebuild parsed files cache")
+PARSER.add_argument('-o', '--output', metavar='FILE',
+                    help="Save plots to file instead of showing them, "
+                         "format from extension")
+PARSER.add_argument('-s', '--stats', action='store_true',
+                    help="Only print time verification statistics, "
+                         "without plotting")
+PARSER.add_argument('--time-report', action='store_true',
+                    help="Only print time verification report as JSON, "
+                         "without plotting")
+PARSER.add_argument('--analytics', action='store_true',
+                    help="Only print trajectory distance, speed, docks dwell "
+                         "and circuit deviation report as JSON, "
+                         "without plotting")
+PARSER.add_argument('--occupancy', metavar='DATA', nargs='+',
+                    help="Plot time spent in each map cell by robots from "
+                         "all given trajectory files")
 
 _PLOT = PARSER.add_argument_group('plot', "Plot selection")
 _PLOT.add_argument('-t', '--traj', dest='plot', const=_TRAJ,
@@ -195,9 +311,24 @@ _PLOT.add_argument('-ti', '--time', dest='plot', const=_TIME,
                    action='append_const', help="Plot time verification")
 
 
-def trajectory_plot(data, title, mapinfo, circuit, selection):
-    """ Plot trajectories infos """
+def trajectory_plot(data, title,  # pylint:disable=too-many-arguments
+                    mapinfo, circuit, selection, output=None):
+    """ Plot trajectories figures, then show them or save them to 'output'
+    :returns: figures """
+    figures = trajectory_figures(data, title, mapinfo, circuit, selection)
+    if figures is None:
+        print "Nothing to plot"
+        return []
+
+    common.plot_output(figures, output)
+    return figures
+
 
+def trajectory_figures(data, title, mapinfo, circuit, selection):
+    """ Plot trajectories infos
+    :returns: figures, None if nothing to plot """
+    import matplotlib.pyplot as plt
+    fignums = plt.get_fignums()
     plot_data = False
 
     if _TRAJ in selection:
@@ -211,14 +342,14 @@ def trajectory_plot(data, title, mapinfo, circuit, selection):
     if _TIME in selection:
         plot_data |= common.oml_plot_clock(data)
 
-    if plot_data:
-        common.plot_show()
-    else:
-        print "Nothing to plot"
+    if not plot_data:
+        return None
+    return common.new_figures(fignums)
 
 
 def oml_plot_angle(data, title, xlabel=common.TIMESTAMP_LABEL):
     """ Plot data 'angel' field """
+    import matplotlib.pyplot as plt
     ylabel = MEASURES_D['theta'].label
     title = '%s %s' % (title, 'angle')
 
@@ -235,10 +366,10 @@ def _image_extent(mapinfo):
     """ Image 'imshow' extent values
     Place image in the robot coordinates """
     left = mapinfo.offsetx
-    right = mapinfo.offsetx + mapinfo.image.size[0] * mapinfo.ratio
+    right = mapinfo.offsetx + mapinfo.image.shape[1] * mapinfo.ratio
 
     bottom = mapinfo.offsety
-    top = mapinfo.offsety + mapinfo.image.size[1] * mapinfo.ratio
+    top = mapinfo.offsety + mapinfo.image.shape[0] * mapinfo.ratio
 
     return (left, right, bottom, top)
 
@@ -251,6 +382,7 @@ def oml_plot_map(data, title, mapinfo, circuit=None):
     :param mapinfo: MapInfo object
     :param circuit: circuit json
     """
+    import matplotlib.pyplot as plt
 
     if not (mapinfo or circuit or not common.array_empty(data)):
         return False  # nothing to graph
@@ -262,32 +394,97 @@ def oml_plot_map(data, title, mapinfo, circuit=None):
     plt.axes().set_aspect('equal', 'datalim')
 
     # Map and dock background
-    _plot_mapinfo(mapinfo)
+    _plot_mapinfo(mapinfo, _plot_bbox(data, circuit))
     # Plot theorical circuit
     _plot_circuit(circuit)
     # Plot actual robot trajectory
-    _plot_robot_traj(data)
+    tolerance = mapinfo.ratio / 2 if mapinfo else TRAJ_TOLERANCE
+    _plot_robot_traj(data, tolerance)
 
     return True
 
 
-def _plot_mapinfo(mapinfo):
-    """ Plot map and docks background """
+def _plot_bbox(data, circuit):
+    """ Trajectory and circuit bounding box (xmin, xmax, ymin, ymax)
+    :returns: None if both are empty """
+    x_values, y_values = [], []
+    if not common.array_empty(data):
+        x_values.append(data['x'])
+        y_values.append(data['y'])
+    if circuit is not None:
+        coords = [circuit['coordinates'][p] for p in circuit['points']]
+        x_values.append([c['x'] for c in coords])
+        y_values.append([c['y'] for c in coords])
+
+    x_values = np.concatenate(x_values or [[]]).astype(float)
+    y_values = np.concatenate(y_values or [[]]).astype(float)
+    finite = np.isfinite(x_values) & np.isfinite(y_values)
+    if not finite.any():
+        return None
+    x_values, y_values = x_values[finite], y_values[finite]
+    return x_values.min(), x_values.max(), y_values.min(), y_values.max()
+
+
+def map_view(mapinfo, bbox, width):
+    """ Map image part to show 'bbox' with MAP_MARGIN, at a resolution
+    for 'width' pixels, from 'mapinfo' image pyramid
+
+    :param bbox: (xmin, xmax, ymin, ymax), whole map if None
+    :returns: (image, extent), None if 'bbox' is out of the map """
+    left, right, bottom, top = _image_extent(mapinfo)
+    if bbox is not None:
+        left_, right_, bottom_, top_ = (
+            max(left, bbox[0] - MAP_MARGIN), min(right, bbox[1] + MAP_MARGIN),
+            max(bottom, bbox[2] - MAP_MARGIN), min(top, bbox[3] + MAP_MARGIN))
+    else:
+        left_, right_, bottom_, top_ = left, right, bottom, top
+    if left_ >= right_ or bottom_ >= top_:
+        return None
+
+    # Lowest resolution with at least 'width' pixels
+    pixels = (right_ - left_) / mapinfo.ratio
+    level = int(np.log2(max(pixels / width, 1)))
+    level = min(level, len(mapinfo.levels) - 1)
+    size = mapinfo.ratio * (1 << level)
+
+    # Clamped to the level image, extents are rounded up on image size
+    shape = mapinfo.levels[level].shape
+    cols = (int(np.floor((left_ - left) / size)),
+            min(int(np.ceil((right_ - left) / size)), shape[1]))
+    rows = (int(np.floor((top - top_) / size)),
+            min(int(np.ceil((top - bottom_) / size)), shape[0]))
+    image = mapinfo.levels[level][rows[0]:rows[1], cols[0]:cols[1]]
+    extent = (left + cols[0] * size, left + cols[1] * size,
+              top - rows[1] * size, top - rows[0] * size)
+    return image, extent
+
+
+def _plot_mapinfo(mapinfo, bbox=None):
+    """ Plot map and docks background, around 'bbox' if given """
+    import matplotlib.pyplot as plt
+    import matplotlib.cm as cm
     if mapinfo is None:
         return
+    view = map_view(mapinfo, bbox, common.figure_width())
+    if view is None:
+        return
 
     # Plot map image in background
-    extent = _image_extent(mapinfo)
-    arr = np.asarray(mapinfo.image)
-    plt.imshow(arr, cmap=cm.Greys_r, aspect='equal', extent=extent)
+    image, extent = view
+    plt.imshow(image, cmap=cm.Greys_r, aspect='equal', extent=extent,
+               vmin=0, vmax=255)
 
-    # Plot docks
+    # Plot docks on the shown map
     for dock in mapinfo.docks:
-        plt.scatter(dock.x, dock.y, **DOCK_PLT)
+        if extent[0] <= dock.x <= extent[1] and \
+                extent[2] <= dock.y <= extent[3]:
+            plt.scatter(dock.x, dock.y, **DOCK_PLT)
 
 
 def _plot_circuit(circuit):
     """ Plot circuit, scaled to map if available"""
+    import matplotlib.pyplot as plt
+    import matplotlib.patches as patches
     if circuit is None:
         return
 
@@ -307,25 +504,414 @@ def _plot_circuit(circuit):
     plt.plot(*coords, **CIRCUIT_POINT_PLT)
 
 
-def _plot_robot_traj(robot_traj):
-    """ Plot robot trajectory """
+def _plot_robot_traj(robot_traj, tolerance=TRAJ_TOLERANCE):
+    """ Plot robot trajectory, simplified with 'tolerance' """
+    import matplotlib.pyplot as plt
     if robot_traj is None:
         return
 
+    robot_traj = robot_traj[simplify_trajectory(robot_traj['x'],
+                                                robot_traj['y'], tolerance)]
     plt.plot(robot_traj['x'], robot_traj['y'])
     plt.xlabel('X (m)')
     plt.ylabel('Y (m)')
 
 
-def main():  # pylint:disable=too-many-statements
+def simplify_trajectory(x_values, y_values, tolerance):
+    """ Trajectory points to plot for a 'tolerance' distance error
+    Stationary runs are collapsed then the path is simplified with
+    Ramer-Douglas-Peucker algorithm, NaN positions are kept as breaks.
+
+    :returns: indices of the kept points """
+    x_values = np.asarray(x_values, dtype=float)
+    y_values = np.asarray(y_values, dtype=float)
+    index = _collapse_stationary(x_values, y_values)
+    keep = _rdp_keep(x_values[index], y_values[index], tolerance)
+    return index[keep]
+
+
+def _collapse_stationary(x_values, y_values):
+    """ Indices of points different from the previous one,
+    NaN runs are collapsed to their first point """
+    if not len(x_values):
+        return np.arange(0)
+    gap = ~(np.isfinite(x_values) & np.isfinite(y_values))
+    same = ((x_values[1:] == x_values[:-1]) &
+            (y_values[1:] == y_values[:-1])) | (gap[1:] & gap[:-1])
+    return np.flatnonzero(np.concatenate(([True], ~same)))
+
+
+def _rdp_keep(x_values, y_values, tolerance):
+    """ Ramer-Douglas-Peucker mask of points to keep
+
+    All segments are split at the same time, one level per iteration,
+    only points of segments not yet within 'tolerance' are processed. """
+    keep = np.zeros(len(x_values), dtype=bool)
+    if not len(x_values) or tolerance <= 0:
+        keep[:] = True
+        return keep
+
+    # Polyline ends, and NaN breaks with their neighbours
+    gap = ~(np.isfinite(x_values) & np.isfinite(y_values))
+    keep[[0, -1]] = True
+    keep |= gap
+    keep[1:] |= gap[:-1]
+    keep[:-1] |= gap[1:]
+
+    points = np.flatnonzero(~keep)
+    while len(points):
+        kept = np.flatnonzero(keep)
+        segment = np.searchsorted(kept, points) - 1
+        dist = _segment_distance(x_values, y_values, points,
+                                 kept[segment], kept[segment + 1])
+
+        # Split segments on their farthest point if it is out of tolerance
+        bounds = np.flatnonzero(np.diff(segment)) + 1
+        bounds = np.concatenate(([0], bounds))
+        seg_max = np.repeat(np.maximum.reduceat(dist, bounds),
+                            np.diff(np.append(bounds, len(dist))))
+        far = seg_max > tolerance
+        farthest = np.flatnonzero(far & (dist == seg_max))
+        _, first = np.unique(segment[farthest], return_index=True)
+        keep[points[farthest[first]]] = True
+
+        points = points[far & ~keep[points]]
+    return keep
+
+
+def _segment_distance(x_values, y_values, points, start, end):
+    """ Distance from 'points' to the [start, end] segments """
+    return _point_segment_distance(
+        x_values[points] - x_values[start], y_values[points] - y_values[start],
+        x_values[end] - x_values[start], y_values[end] - y_values[start])
+
+
+def _point_segment_distance(pt_x, pt_y, seg_x, seg_y):
+    """ Distance from points to segments starting at origin, broadcasted
+    :param pt_x, pt_y: points coordinates relative to segments start
+    :param seg_x, seg_y: segments vectors """
+    length2 = seg_x ** 2 + seg_y ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        proj = np.where(length2 > 0, (pt_x * seg_x + pt_y * seg_y) / length2,
+                        0)
+    proj = np.clip(proj, 0, 1)
+    return np.hypot(pt_x - proj * seg_x, pt_y - proj * seg_y)
+
+
+def circuit_distance(x_values, y_values, circuit,
+                     chunk_size=CIRCUIT_CHUNK_SIZE):
+    """ Distance from each (x, y) position to the circuit path
+    The path is closed when circuit 'loop' is set, a single point circuit
+    is a zero length segment.
+    Circuits have few segments, they are all checked for a chunk of points.
+
+    :returns: float array, NaN for NaN positions or without circuit points """
+    coords = [circuit['coordinates'][p] for p in circuit['points']]
+    if not coords:
+        return np.full(len(x_values), np.nan)
+    seg_x = np.array([c['x'] for c in coords], dtype=float)
+    seg_y = np.array([c['y'] for c in coords], dtype=float)
+    if circuit.get('loop') or len(coords) == 1:
+        seg_x, seg_y = np.append(seg_x, seg_x[0]), np.append(seg_y, seg_y[0])
+    start_x, start_y = seg_x[:-1], seg_y[:-1]
+    vec_x, vec_y = np.diff(seg_x), np.diff(seg_y)
+
+    x_values = np.asarray(x_values, dtype=float)
+    y_values = np.asarray(y_values, dtype=float)
+    dist = np.empty(len(x_values))
+    step = max(chunk_size // len(start_x), 1)
+    for first in range(0, len(x_values), step):
+        chunk = slice(first, first + step)
+        dist[chunk] = _point_segment_distance(
+            x_values[chunk, None] - start_x, y_values[chunk, None] - start_y,
+            vec_x, vec_y).min(axis=1)
+    return dist
+
+
+def dock_dwell(data, docks, radius=DOCK_RADIUS):
+    """ Time in seconds spent within 'radius' of each dock
+    An interval between two samples counts when both are near the dock.
+
+    :returns: float array, one value per dock """
+    if not docks or len(data) < 2:
+        return np.zeros(len(docks))
+    dock_x = np.array([d.x for d in docks], dtype=float)
+    dock_y = np.array([d.y for d in docks], dtype=float)
+    with np.errstate(invalid='ignore'):
+        near = np.hypot(data['x'][:, None] - dock_x,
+                        data['y'][:, None] - dock_y) <= radius
+    both = near[:-1] & near[1:]
+    return np.dot(np.diff(data['timestamp']), both)
+
+
+def _values_report(values, percentiles):
+    """ Summary of finite 'values', None if there are none """
+    values = values[np.isfinite(values)]
+    if not len(values):
+        return None
+    return {
+        'mean': float(values.mean()),
+        'min': float(values.min()),
+        'max': float(values.max()),
+        'percentiles': dict(('p%g' % perc, float(value)) for perc, value
+                            in zip(percentiles,
+                                   np.percentile(values, percentiles))),
+    }
+
+
+def trajectory_report(data, mapinfo=None, circuit=None,
+                      percentiles=ANALYTICS_PERCENTILES):
+    """ Trajectory analytics report, json serializable dict
+
+    Distances are in meters, speeds in m/s, angular speeds in rad/s.
+    'theta' is unwrapped before computing angular speed.
+    'docks' is the time spent near each 'mapinfo' dock, 'circuit' the
+    distance from each position to the circuit path.
+    :params data: oml_load returned array
+    """
+    time = data['timestamp']
+    delta = np.diff(time)
+    valid = delta > 0
+    step = np.hypot(np.diff(data['x']), np.diff(data['y']))
+    moving = np.isfinite(step)
+    distance = float(step[moving].sum())
+    duration = float(time[-1] - time[0]) if len(time) else 0.
+
+    theta = data['theta']
+    finite = np.isfinite(theta)
+    theta = np.unwrap(theta[finite])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        speed = np.where(valid, step / delta, np.nan)
+        turn = np.diff(theta) / np.diff(time[finite])
+
+    report = {
+        'count': len(time),
+        'duration': duration,
+        'distance': distance,
+        'speed': _values_report(speed, percentiles),
+        'mean_speed': distance / duration if duration > 0 else None,
+        'rotation': float(np.abs(np.diff(theta)).sum()),
+        'angular_speed': _values_report(np.abs(turn), percentiles),
+        'docks': None,
+        'circuit': None,
+    }
+    if mapinfo is not None:
+        dwell = dock_dwell(data, mapinfo.docks)
+        report['docks'] = [{'x': dock.x, 'y': dock.y, 'dwell': float(value)}
+                           for dock, value in zip(mapinfo.docks, dwell)]
+    if circuit is not None:
+        report['circuit'] = _values_report(
+            circuit_distance(data['x'], data['y'], circuit), percentiles)
+    return report
+
+
+def oml_occupancy(filenames, mapinfo=None, chunk_rows=common.OML_CHUNK_ROWS):
+    """ Time spent in each cell by robots in all 'filenames' runs
+    Grid is aligned with 'mapinfo' pixels and limited to the map if given.
+    Files are streamed by chunks, without loading them whole.
+
+    :returns: Occupancy """
+    if mapinfo is None:
+        occupancy = Occupancy(OCCUPANCY_CELL)
+    else:
+        pixels = int(max(round(OCCUPANCY_CELL / mapinfo.ratio), 1))
+        rows, cols = mapinfo.image.shape[:2]
+        occupancy = Occupancy(pixels * mapinfo.ratio,
+                              (mapinfo.offsetx, mapinfo.offsety),
+                              bounds=(0, (cols - 1) // pixels,
+                                      0, (rows - 1) // pixels))
+    for filename in filenames:
+        for chunk in common.iter_oml_chunks(filename, 'robot_pose',
+                                            MEASURES_D.values(), chunk_rows):
+            occupancy.update(chunk)
+        occupancy.end_run()
+    return occupancy
+
+
+class Occupancy(object):
+    """ Occupancy grid, time in seconds spent in each 'cell' meters square
+
+    The interval between two poses is accounted in the cell of the first
+    one. Intervals longer than 'max_gap' or with NaN poses are skipped.
+    The grid grows to contain the poses, cells are aligned on 'origin'.
+    Poses out of 'bounds' (col_min, col_max, row_min, row_max) cells are
+    counted in 'skipped'. Without 'bounds', they are centered on the first
+    poses, for a grid of at most OCCUPANCY_MAX_CELLS.
+    Updated incrementally with consecutive poses chunks of a run. """
+
+    def __init__(self, cell, origin=(0., 0.), max_gap=OCCUPANCY_MAX_GAP,
+                 bounds=None):
+        self.cell = cell
+        self.origin = origin
+        self.max_gap = max_gap
+        self.bounds = bounds
+        self.skipped = 0
+        self.grid = np.zeros((0, 0))
+        # (col, row) cell index of grid[0, 0]
+        self.start = (0, 0)
+        self._last = None
+
+    def update(self, data):
+        """ Update grid with 'data' poses """
+        if not len(data):
+            return
+        time = data['timestamp']
+        x_values = data['x'].astype(float)
+        y_values = data['y'].astype(float)
+
+        # Continue from previous chunk last pose
+        if self._last is not None:
+            time = np.r_[self._last[0], time]
+            x_values = np.r_[self._last[1], x_values]
+            y_values = np.r_[self._last[2], y_values]
+        self._last = (time[-1], x_values[-1], y_values[-1])
+
+        delta = np.diff(time)
+        cols = np.floor((x_values[:-1] - self.origin[0]) / self.cell)
+        rows = np.floor((y_values[:-1] - self.origin[1]) / self.cell)
+        with np.errstate(invalid='ignore'):
+            valid = ((delta > 0) & (delta <= self.max_gap) &
+                     np.isfinite(cols) & np.isfinite(rows))
+        if not valid.any():
+            return
+        cols, rows, delta = cols[valid], rows[valid], delta[valid]
+
+        if self.bounds is None:
+            self.bounds = self._default_bounds(cols, rows)
+        inside = ((cols >= self.bounds[0]) & (cols <= self.bounds[1]) &
+                  (rows >= self.bounds[2]) & (rows <= self.bounds[3]))
+        self.skipped += len(inside) - np.count_nonzero(inside)
+        if not inside.any():
+            return
+        cols = cols[inside].astype(np.int64)
+        rows = rows[inside].astype(np.int64)
+
+        self._grow(cols.min(), cols.max(), rows.min(), rows.max())
+        flat = ((rows - self.start[1]) * self.grid.shape[1] +
+                cols - self.start[0])
+        self.grid += np.bincount(flat, weights=delta[inside],
+                                 minlength=self.grid.size).reshape(
+                                     self.grid.shape)
+
+    @staticmethod
+    def _default_bounds(cols, rows):
+        """ Square of OCCUPANCY_MAX_CELLS cells around median cell """
+        side = int(np.sqrt(OCCUPANCY_MAX_CELLS))
+        col, row = int(np.median(cols)), int(np.median(rows))
+        return (col - side // 2, col - side // 2 + side - 1,
+                row - side // 2, row - side // 2 + side - 1)
+
+    def end_run(self):
+        """ Next update is a new run, not continuing the previous poses """
+        self._last = None
+
+    def _grow(self, col_min, col_max, row_min, row_max):
+        """ Grow grid to contain given cells """
+        if self.grid.size:
+            col_min = min(col_min, self.start[0])
+            row_min = min(row_min, self.start[1])
+            col_max = max(col_max, self.start[0] + self.grid.shape[1] - 1)
+            row_max = max(row_max, self.start[1] + self.grid.shape[0] - 1)
+        shape = (row_max - row_min + 1, col_max - col_min + 1)
+        if shape == self.grid.shape:
+            return
+        grid = np.zeros(shape)
+        row, col = self.start[1] - row_min, self.start[0] - col_min
+        grid[row:row + self.grid.shape[0], col:col + self.grid.shape[1]] = \
+            self.grid
+        self.grid, self.start = grid, (col_min, row_min)
+
+    def extent(self):
+        """ Grid (left, right, bottom, top) in meters, None if empty """
+        if not self.grid.size:
+            return None
+        left = self.origin[0] + self.start[0] * self.cell
+        bottom = self.origin[1] + self.start[1] * self.cell
+        return (left, left + self.grid.shape[1] * self.cell,
+                bottom, bottom + self.grid.shape[0] * self.cell)
+
+
+def occupancy_plot(occupancy, title, mapinfo=None, output=None):
+    """ Plot occupancy figure, then show it or save it to 'output'
+    :returns: figures """
+    import matplotlib.pyplot as plt
+    fignums = plt.get_fignums()
+    oml_plot_occupancy(occupancy, title, mapinfo)
+    figures = common.new_figures(fignums)
+    common.plot_output(figures, output)
+    return figures
+
+
+def oml_plot_occupancy(occupancy, title, mapinfo=None):
+    """ Plot occupancy grid over the site map, log colored """
+    import matplotlib.pyplot as plt
+    import matplotlib.colors as colors
+
+    plt.figure()
+    plt.title(title + ' occupancy')
+    plt.grid()
+    plt.axes().set_aspect('equal', 'datalim')
+    extent = occupancy.extent()
+    _plot_mapinfo(mapinfo, extent)
+    if extent is not None:
+        grid = np.ma.masked_less_equal(occupancy.grid, 0)
+        plt.imshow(grid, origin='lower', extent=extent, alpha=0.8,
+                   interpolation='nearest', norm=colors.LogNorm())
+        plt.colorbar().set_label('Time (s)')
+    plt.xlabel('X (m)')
+    plt.ylabel('Y (m)')
+
+
+def main():  # pylint:disable=too-many-statements,too-many-branches
     """ Main command """
     opts = PARSER.parse_args()
     # default to plot traj/map
     selection = opts.plot or ('traj')
-    # select samples
-    data = opts.data[opts.begin:opts.end] if opts.data is not None else None
-
-    trajectory_plot(data, opts.title, opts.mapinfo, opts.circuit, selection)
+    data = None
+    if (opts.stats or opts.time_report or opts.analytics) and \
+            opts.input is None:
+        PARSER.error('--stats/--time-report/--analytics require an input '
+                     'file')
+    if opts.input is not None:
+        try:
+            start, stop = common.oml_time_range(opts.input, opts.start,
+                                                opts.stop)
+            data = oml_load(opts.input, opts.cache, start, stop)
+        except ValueError as err:
+            PARSER.error(str(err))
+        # select samples
+        data = data[opts.begin:opts.end]
+
+    if opts.stats:
+        common.oml_print_clock(data)
+        return
+    if opts.time_report:
+        print json.dumps(common.clock_report(data), indent=2, sort_keys=True)
+        return
+    mapinfo = None
+    if opts.site is not None:
+        try:
+            mapinfo = get_site_map(opts.site, opts.cache, opts.offline)
+        except ValueError as err:
+            PARSER.error(str(err))
+    if opts.analytics:
+        report = trajectory_report(data, mapinfo, opts.circuit)
+        print json.dumps(report, indent=2, sort_keys=True)
+        return
+    if opts.output:
+        common.plot_headless()
+    if opts.occupancy:
+        try:
+            occupancy = oml_occupancy(opts.occupancy, mapinfo)
+        except ValueError as err:
+            PARSER.error(str(err))
+        if occupancy.skipped:
+            print >> sys.stderr, ("Skipped %d poses out of the occupancy "
+                                  "grid" % occupancy.skipped)
+        occupancy_plot(occupancy, opts.title, mapinfo, opts.output)
+        return
+    trajectory_plot(data, opts.title, mapinfo, opts.circuit, selection,
+                    opts.output)
 
 
 if __name__ == "__main__":
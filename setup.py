@@ -43,7 +43,8 @@ def get_version(package):
                 return eval(line.split('=')[-1])  # pylint:disable=eval-used
 
 
-SCRIPTS = ['plot_oml_consum', 'plot_oml_radio', 'plot_oml_traj']
+SCRIPTS = ['plot_oml_consum', 'plot_oml_radio', 'plot_oml_traj',
+           'plot_oml_batch']
 
 INSTALL_REQUIRES = ['argparse', 'numpy', 'matplotlib', 'Pillow']
 INSTALL_REQUIRES += ['iotlabcli>=2.0.0']